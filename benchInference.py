@@ -0,0 +1,73 @@
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from models.agent_ddqn import AgentDoubleDQN
+from models.env.board import legal_moves
+from models.env.encoding import one_hot_torch
+from models.env.vec_board import VecBoard
+from models.train_ppo_base import AgentPPO
+
+# per-move latency of the agents' action selection, before and after the inference runtime
+
+def sample_boards(num_boards=2000, seed=0):
+    '''returns num_boards (4,4) exponent boards reached by random play, from early and late game'''
+    rng = np.random.default_rng(seed)
+    envs = VecBoard(num_boards, seed=seed)
+    for _ in range(rng.integers(10, 150)):
+        legal = envs.legal_actions()
+        actions = np.array([rng.choice(np.flatnonzero(row)) if row.any() else 0 for row in legal])
+        envs.move(actions)
+    return envs.state.copy()
+
+def eager_choose_action(model, obs, state):
+    '''the previous action selection: a train-mode forward pass that records an autograd graph'''
+    legal = legal_moves(state)
+    one_hot_torch(state, out=obs)
+    out = model(obs)
+    out = (out[0] if isinstance(out, tuple) else out).squeeze(0)
+    if legal.any():
+        out = out.masked_fill(torch.from_numpy(~legal), -float('inf'))
+    return torch.argmax(out).item()
+
+def time_moves(choose, boards):
+    '''returns the latency of every call choose(board) in microseconds'''
+    latencies = np.empty(len(boards))
+    for i, board in enumerate(boards):
+        start = time.perf_counter()
+        choose(board)
+        latencies[i] = time.perf_counter() - start
+    return latencies * 1e6
+
+def report(name, latencies):
+    p50, p99 = np.percentile(latencies, [50, 99])
+    print(f"{name:<34} {latencies.mean():9.1f} {p50:9.1f} {p99:9.1f}")
+
+if __name__ == "__main__":
+    NUM_BOARDS = 2000
+    BATCH_SIZE = 256
+
+    # one intra-op thread, as in the simulator's worker processes
+    torch.set_num_threads(1)
+    boards = sample_boards(NUM_BOARDS)
+
+    ddqn = AgentDoubleDQN(num_threads=1)
+    ppo = AgentPPO(obs_space_size=16*18, act_space_size=4, hidden_layer_size=256, num_shared_layers=1,
+                   activation_function=nn.Tanh(), device='cpu', num_threads=1,
+                   model_path='submission/ppo/final-model-2048/ppo-trainedmodel.pt')
+
+    print(f"{'agent / runtime':<34} {'mean us':>9} {'p50 us':>9} {'p99 us':>9}")
+    for name, agent, model in (('ddqn', ddqn, ddqn.Q_net), ('ppo', ppo, ppo.model)):
+        obs = torch.zeros(1, 16*18)
+        model.train()
+        report(f"{name} eager, autograd", time_moves(lambda s: eager_choose_action(model, obs, s), boards))
+        model.eval()
+        report(f"{name} runtime (traced: {agent.runtime.traced})", time_moves(agent.choose_action, boards))
+
+        # batched selection, latency per board
+        batches = boards[:len(boards) // BATCH_SIZE * BATCH_SIZE].reshape(-1, BATCH_SIZE, 4, 4)
+        report(f"{name} runtime batch {BATCH_SIZE}, per board", time_moves(agent.choose_actions, batches) / BATCH_SIZE)
+
+        # the runtime has to pick the same moves as the eager model
+        same = np.mean([agent.choose_action(b) == eager_choose_action(model, obs, b) for b in boards[:200]])
+        print(f"{'':<34} same moves as eager: {same:.0%}")
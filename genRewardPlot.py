@@ -1,22 +1,22 @@
-import json
 import numpy as np 
 import matplotlib.pyplot as plt
 
+from models.utils.metrics import read_metrics
+
 def plot_2048_training(stats_file='models/ppo_2048_stats_rewardfinal.json', w_size=5000, dpi=300):
     """
     Generate a line plot of the average reward over the number of steps taken during training.
     
     Args:
-    stats_file (str): The file path to the JSON file containing the training statistics.
+    stats_file (str): The file path to the metrics log (.jsonl, .csv, or legacy .json) containing the training statistics.
     w_size (int): The window size used for the rolling average calculation.
     dpi (int): The resolution of the saved figure in dots per inch.
 
     Returns:
     None
     """
-    # Load the JSON file with the training statistics
-    with open(stats_file, "r") as f:
-        stats = json.load(f)
+    # Load the training statistics
+    stats = read_metrics(stats_file)
 
     # Calculate the rolling average
     window_size = w_size 
@@ -34,4 +34,4 @@ def plot_2048_training(stats_file='models/ppo_2048_stats_rewardfinal.json', w_si
     plt.show()
 
 # Example usage of the function
-plot_2048_training('models/ppo_2048_stats_rewardfinal15.json')
+plot_2048_training('models/ppo_2048_stats_rewardfinal15.jsonl')
@@ -1,10 +1,11 @@
 import time 
 import torch.nn as nn 
 # import multiprocessing as mp
-from models.env.board import Board
+from models.env.board import Board, TILE_VALUES
 from models.agent_random import AgentRandom
 from models.train_ppo_base import AgentPPO
 from models.utils.plotting import Plotter
+from models.utils.trajectory import TrajectoryRecorder
 import matplotlib.pyplot as plt
 import pandas as pd
 import os
@@ -25,11 +26,12 @@ class Simulator():
         # self.max_scores = mp.Manager().dict() 
         # self.num_steps = mp.Manager().dict()
 
-        # stores a tensor of the game states
-        self.gameplay_tensor = None
+        # records the boards, moves, scores and spawns of the current game
+        self.recorder = TrajectoryRecorder()
 
-        # a tensor with the score at the time and the last move. Stores rows of score, last move
-        self.game_stats = torch.zeros([1, 2])
+        # copy of the trajectory of the highest scoring game so far, and its score
+        self.trajectory = None
+        self.best_score = 0
     
     def run_episode(self):
 
@@ -37,16 +39,15 @@ class Simulator():
 
         n_steps = 0 
 
-        current_game = torch.from_numpy(game.get_state().copy()).reshape([1, 4, 4])
-        current_stats = torch.tensor([[0, -1]])
-        done = False
+        # the first frame is the initial board, with no move
+        self.recorder.reset(game.get_state())
 
         # runs an episode until termination 
         while not game.is_terminal_state():
 
             # gets state, and makes action based on state
             state = game.get_state() 
-            action = self.agent.choose_action(state)
+            action = self.agent.choose_action(state, game.legal_actions())
 
             # updates game board steps
             game.move(action)
@@ -55,16 +56,13 @@ class Simulator():
             # plot and save image of game at that time from board game function
             # game.visualize_board_save(n_steps)
 
-            # Save a tensor in the game sequence
-            newStats = torch.tensor([game.get_score(), game.get_last_move()]).reshape([1, 2])
-            current_stats = torch.cat((current_stats, newStats), dim = 0)
+            # Record the board after the move, with the move, the score and where the new tile spawned
+            self.recorder.record(game.get_state(), action, game.get_score(), game.last_spawn)
 
-            newState = torch.from_numpy(state).reshape([1, 4, 4])
-            current_game = torch.cat((current_game, newState), dim = 0)
-        if game.get_score() > float(self.game_stats[-1, 0]):
-            self.gameplay_tensor = current_game
-            self.game_stats = current_stats
-        # print(self.gameplay_tensor)
+        # only the best game is kept, so its frames are copied out of the recorder
+        if game.get_score() > self.best_score:
+            self.best_score = game.get_score()
+            self.trajectory = {key: frames.copy() for key, frames in self.recorder.trajectory().items()}
         # updates simulation info dictionaries 
         '''
         self.num_steps[n_steps] = self.num_steps.get(n_steps, 0) + 1
@@ -119,33 +117,33 @@ class Simulator():
             path = Path('figure' + str(num) + '.png')
     
     # function for visualizing a single state and saving as a png
-    def visualize_board_simulator_single(self, num, stateTensor, score, last_move):
-        stateTensor = stateTensor.reshape([4, 4])
+    def visualize_board_simulator_single(self, num, state, score, last_move):
+        tiles = TILE_VALUES[state.reshape([4, 4])]
         plt.rcParams['figure.figsize'] = [3.00, 3.00]
         plt.rcParams['figure.autolayout'] = True
         fig, ax = plt.subplots(facecolor ='white')
         ax.axis('off')
-        df = pd.DataFrame(stateTensor.numpy(), columns = ['0', '1', '2', '3'])
+        df = pd.DataFrame(tiles, columns = ['0', '1', '2', '3'])
         table = ax.table(cellText = df.values, loc = 'center', cellLoc='center')
         fig.tight_layout()
         max_number = 0
         for i in range(4):
             for j in range(4):
-                data = float(stateTensor[i, j])
+                data = tiles[i, j]
                 max_number = max(data, max_number)
                 color = Board.CELL_BACKGROUND_COLOR_DICT[data]
                 table[(i, j)].set_facecolor(color)
         ax.text(self.VISUAL_X_COORD, .8, 'Current Score: ' + str(float(score)), transform = ax.transAxes, color = 'black')
         ax.text(self.VISUAL_X_COORD, .7, 'Max Number: ' + str(max_number), transform = ax.transAxes, color = 'black')
-        ax.text(self.VISUAL_X_COORD, .2, 'Last Move: ' + Board.MOVEMENT_DICT[float(last_move)], transform = ax.transAxes, color = 'black')
+        ax.text(self.VISUAL_X_COORD, .2, 'Last Move: ' + Board.MOVEMENT_DICT[int(last_move)], transform = ax.transAxes, color = 'black')
         plt.rc('savefig', dpi=300)
         plt.savefig('figure' + str(num) + '.png')
         plt.close()
 
     # loop for visualizing all states of gameplay
-    def visualize_gameplay(self, gameplayTensor, statsTensor):
-        for i in range(gameplayTensor.size(dim=0)):
-            self.visualize_board_simulator_single(i, gameplayTensor[i, :, :], statsTensor[i, 0], statsTensor[i, 1])
+    def visualize_gameplay(self, trajectory):
+        for i in range(len(trajectory['boards'])):
+            self.visualize_board_simulator_single(i, trajectory['boards'][i], trajectory['scores'][i], trajectory['actions'][i])
     
     #Plots and saves the Data
     def plt_sim(self):
@@ -172,6 +170,6 @@ if __name__ == "__main__":
 
     S1 = Simulator(ppo_agent)
     S1.run_episodes_worker(1000)
-    S1.visualize_gameplay(S1.gameplay_tensor, S1.game_stats)
+    S1.visualize_gameplay(S1.trajectory)
     S1.visualize_board_video()
 
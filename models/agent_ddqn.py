@@ -2,13 +2,21 @@ import os
 import numpy as np
 import torch
 from .ddqn_base import DoubleDQN
+from .env.board import legal_moves
+from .env.encoding import OBS_SIZE, one_hot, one_hot_torch
+from .env.vec_board import legal_moves_batch
+from .utils.inference import InferenceRuntime
 
 SAVE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'submission', 'ddqn', 'successful-model-2048', 'all_parameters', 'Test4_5_active_final.pt')
 
 class AgentDoubleDQN():
-    def __init__(self):
+    def __init__(self, sparse_input=False, precision='fp32', num_threads=None, trace=True):
         '''
         Initializes actions agents can take. Includes other standard components as we build base class. 
+        With sparse_input the saved dense weights are converted to the exponent embedding input layer.
+        With precision='bf16' the Q network runs under CPU bfloat16 autocast.
+        The network runs through an InferenceRuntime: eval mode, inference mode and, with trace, a frozen
+        traced graph. num_threads pins torch's intra-op threads, use 1 in simulator worker processes.
 
         0 : up
         1 : down
@@ -16,36 +24,66 @@ class AgentDoubleDQN():
         3 : right
         '''
         self.actions = np.array([0,1,2,3])
-        self.Q_net = DoubleDQN(n_observations=288, n_actions=4, arch=(1,256))
+        self.sparse_input = sparse_input
+        self.Q_net = DoubleDQN(n_observations=OBS_SIZE, n_actions=4, arch=(1,256), sparse_input=sparse_input)
         self.load_params() # load saved weights (if available)
-        self.prev_state = None
-        self.count = 0
+
+        # preallocated network input, and the batched one of choose_actions that grows with the batch
+        self.obs = torch.zeros(1, 16, dtype=torch.long) if sparse_input else torch.zeros(1, OBS_SIZE)
+        self.batch_obs = self.obs
+        self.runtime = InferenceRuntime(self.Q_net, self.obs, trace=trace, num_threads=num_threads, precision=precision)
     
-    def choose_action(self, state=None):
+    def choose_action(self, state=None, legal=None):
         '''
         Given an observation state, select an action.
         For the baseline random agent, no action is given.
         For all other agents, override this method to include observation.
+        Moves that would not change the board are masked out so the agent never gets stuck.
+        `legal` is the optional mask of those moves (e.g. Board.legal_actions()), computed if not given.
         '''
-        if self.prev_state is not None and (self.prev_state == state).all():
-           self.count += 1
+        if legal is None:
+          legal = legal_moves(state)
+
+        #feed the exponents directly, or convert them to one-hot encoding
+        if self.sparse_input:
+          self.obs.copy_(torch.from_numpy(state.reshape(1, 16)))
         else:
-           self.prev_state = state.copy()
-           self.count = 0
-        
-        if self.count > 5: # if stuck for more than 5 iterations, choose a random action
-          return np.random.choice(self.actions) 
+          one_hot_torch(state, out=self.obs)
+        q_values = self.runtime(self.obs)[0].numpy()
+        if legal.any():
+          q_values = np.where(legal, q_values, -np.inf)
+        return int(np.argmax(q_values))
+
+    def choose_actions(self, states, legal=None):
+        '''
+        Batched choose_action: one forward pass selects the actions of all (M,4,4) boards in `states`.
+        `legal` is the optional (M,4) mask of the moves that change each board, computed if not given.
+        Returns an (M,) array of actions.
+        '''
+        states = np.asarray(states)
+        m = len(states)
+        if legal is None:
+          legal = legal_moves_batch(states)
+
+        # grow the input buffer to the largest batch seen so far, then encode into its first m rows
+        if len(self.batch_obs) < m:
+          self.batch_obs = self.obs.new_zeros((m,) + self.obs.shape[1:])
+        obs = self.batch_obs[:m]
+        if self.sparse_input:
+          obs.numpy()[:] = states.reshape(m, 16)
         else:
-          #convert state to one-hot encoding
-          state = np.log2(state, out=np.zeros_like(state), where=(state != 0)).reshape(-1).astype(int)
-          state = np.eye(18)[state]
-          state = torch.tensor(state.flatten(), dtype=torch.float32).unsqueeze(0)
-          return torch.argmax(self.Q_net(state)).item()
+          one_hot(states, out=obs.numpy())
+
+        q_values = self.runtime(obs).numpy()
+
+        # boards without a legal move keep all actions, as in choose_action
+        mask = ~legal & legal.any(axis=1, keepdims=True)
+        return np.where(mask, -np.inf, q_values).argmax(axis=1)
         
     def load_params(self):
       if (os.path.exists(SAVE_PATH) and os.path.getsize(SAVE_PATH) > 0 ):
         print('Weights found, loading weights...')
-        self.Q_net.load_state_dict(torch.load(SAVE_PATH))
+        self.Q_net.load_dense_state_dict(torch.load(SAVE_PATH, map_location='cpu'))
       else:
         #if no weights are found, create a file to indicate that no weights are found
         raise Exception('No weights found')
\ No newline at end of file
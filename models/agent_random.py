@@ -15,7 +15,7 @@ class AgentRandom():
         '''
         self.actions = np.array([0,1,2,3])
     
-    def choose_action(self, state=None):
+    def choose_action(self, state=None, legal=None):
         '''
         given an observation state, select an action.
         for the baseline random agent, no action is given.
@@ -23,4 +23,10 @@ class AgentRandom():
         '''
         return np.random.choice(self.actions)
 
+    def choose_actions(self, states, legal=None):
+        '''
+        batched choose_action, returns one random action for every board in states.
+        '''
+        return np.random.choice(self.actions, size=len(states))
+
 
@@ -0,0 +1,133 @@
+# standard imports
+import time
+import numpy as np
+
+# deep learning modules
+import torch
+import torch.nn as nn
+
+# internal modules
+from ddqn_base import DDQNTrainer
+from env.encoding import OBS_SIZE, one_hot
+from env.vec_board import VecBoard
+from ppo_wrapper import EnvironmentWrapper
+from train_ppo_base import ActorCritic, PPO_Buffer, PPO_Trainer, RolloutStorage
+from utils.precision import autocast
+
+def evaluate(model, precision, num_games=200, seed=0):
+    """
+    Plays num_games greedy games with `model` in lockstep and returns their final scores and max tiles.
+    Illegal moves are masked out, a model returning (logits, values) is played on its logits.
+
+    Args:
+    - model (nn.Module): a DoubleDQN or ActorCritic with the one-hot input
+    - precision (str): the compute precision of the forward passes, 'fp32' or 'bf16'
+    - num_games (int): the number of games to play (default: 200)
+    - seed (int): the seed of the tile spawns (default: 0)
+
+    Returns:
+    - scores (np.ndarray): the final score of every game
+    - max_tiles (np.ndarray): the max tile of every game
+    - steps_per_second (float): the number of moves played per second
+    """
+    envs = VecBoard(num_games, seed=seed)
+    obs = torch.zeros((num_games, OBS_SIZE), dtype=torch.float32)
+    running = np.ones(num_games, dtype=bool)
+    scores = np.zeros(num_games, dtype=np.int64)
+    max_tiles = np.zeros(num_games)
+    n_moves = 0
+
+    start = time.perf_counter()
+    while running.any():
+        one_hot(envs.state, out=obs.numpy())
+        with torch.no_grad(), autocast(precision):
+            out = model(obs)
+        out = (out[0] if isinstance(out, tuple) else out).float()
+        out = out.masked_fill(torch.from_numpy(~envs.legal_actions()), -float('inf'))
+        _, dones = envs.move(out.argmax(dim=1).numpy())
+        n_moves += int(running.sum())
+
+        # a finished game keeps its result, the board is restarted but no longer counted
+        finished = dones & running
+        scores[finished] = envs.score[finished]
+        max_tiles[finished] = envs.get_max()[finished]
+        running &= ~dones
+        envs.reset(dones)
+    return scores, max_tiles, n_moves / (time.perf_counter() - start)
+
+def bench_ddqn(precision, num_steps=2000, num_envs=16, seed=0):
+    """
+    Times num_steps lockstep DDQNTrainer steps (num_envs transitions and num_envs gradient updates each)
+    after the replay buffer holds one batch.
+
+    Returns:
+    - trainer (DDQNTrainer): the trained trainer
+    - transitions_per_second (float): the number of environment transitions per second, updates included
+    """
+    torch.manual_seed(seed)
+    trainer = DDQNTrainer(num_envs=num_envs, capacity=50000, batch_size=128, prioritized=True, seed=seed, precision=precision)
+    while trainer.replay.get_replay_buffer_length() < trainer.batch_size:
+        trainer.step()
+
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        trainer.step()
+    return trainer, num_steps * num_envs / (time.perf_counter() - start)
+
+def bench_ppo(precision, num_iterations=20, num_rollouts=16, max_steps=1000, seed=0):
+    """
+    Times num_iterations PPO iterations, each one batched rollout collection into a RolloutStorage followed by
+    a minibatched fused update.
+
+    Returns:
+    - model (ActorCritic): the trained model
+    - steps_per_second (float): the number of collected environment steps per second, updates included
+    """
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    model = ActorCritic(obs_size=OBS_SIZE, act_size=4, hidden_layer_size=256, num_shared_layers=1, activation_function=nn.Tanh())
+    trainer = PPO_Trainer(model, ppo_lr=1e-4, val_lr=1e-3, num_minibatches=8, update_epochs=4, entropy_coef=0.01, precision=precision)
+    buffer = PPO_Buffer(precision=precision)
+    envs = [EnvironmentWrapper() for _ in range(num_rollouts)]
+    storage = RolloutStorage(num_rollouts * max_steps, device='cpu')
+
+    num_steps = 0
+    start = time.perf_counter()
+    for _ in range(num_iterations):
+        storage, _ = buffer.generate_batched_rollouts(model, envs, max_steps=max_steps, storage=storage, device='cpu')
+        trainer.train_fused(storage)
+        num_steps += storage.size
+    return model, num_steps / (time.perf_counter() - start)
+
+def summarize(name, precision, throughput, scores, max_tiles, eval_speed):
+    # One line of throughput and score percentiles, followed by the max tile distribution
+    p10, p50, p90 = np.percentile(scores, [10, 50, 90])
+    print(f"{name:<14} {precision:<5} {throughput:10.0f} {eval_speed:10.0f} {scores.mean():9.0f} {p10:7.0f} {p50:7.0f} {p90:7.0f}")
+    tiles, counts = np.unique(max_tiles.astype(np.int64), return_counts=True)
+    print(" " * 21 + "max tiles: " + ", ".join(f"{t}: {c / len(max_tiles):.0%}" for t, c in zip(tiles, counts)))
+
+if __name__ == "__main__":
+
+    # benchmark settings, every precision trains from the same seed and is evaluated on the same games
+    PRECISIONS = ['fp32', 'bf16']
+    DDQN_STEPS = 2000
+    PPO_ITERATIONS = 20
+    EVAL_GAMES = 200
+
+    print(f"bfloat16 autocast on CPU, torch {torch.__version__}, {torch.get_num_threads()} threads")
+    print(f"{'run':<14} {'prec':<5} {'train st/s':>10} {'eval st/s':>10} {'mean':>9} {'p10':>7} {'p50':>7} {'p90':>7}")
+
+    ddqn_models = {}
+    for precision in PRECISIONS:
+        trainer, throughput = bench_ddqn(precision, num_steps=DDQN_STEPS)
+        ddqn_models[precision] = trainer.Q_online
+        summarize("ddqn train", precision, throughput, *evaluate(trainer.Q_online, precision, EVAL_GAMES))
+
+    for precision in PRECISIONS:
+        model, throughput = bench_ppo(precision, num_iterations=PPO_ITERATIONS)
+        summarize("ppo train", precision, throughput, *evaluate(model, precision, EVAL_GAMES))
+
+    # the same float32-trained weights played at every precision isolate the effect of bf16 inference
+    for precision in PRECISIONS:
+        scores, max_tiles, eval_speed = evaluate(ddqn_models['fp32'], precision, EVAL_GAMES)
+        summarize("ddqn fp32 inf", precision, float('nan'), scores, max_tiles, eval_speed)
@@ -0,0 +1,300 @@
+import os
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+# internal modules, importable both from the repo root and from inside models/
+try:
+  from .ddqn_base import DEVICE, DDQNTrainer, DoubleDQN, epsilon_greedy, n_step_accumulator, replay_buffer, transition_arrays
+  from .env.encoding import OBS_SIZE, one_hot
+  from .env.vec_board import VecBoard
+  from .utils.precision import autocast
+except ImportError:
+  from ddqn_base import DEVICE, DDQNTrainer, DoubleDQN, epsilon_greedy, n_step_accumulator, replay_buffer, transition_arrays
+  from env.encoding import OBS_SIZE, one_hot
+  from env.vec_board import VecBoard
+  from utils.precision import autocast
+
+# columns of the per-actor statistics table
+TRANSITIONS, EPISODES, SCORE_SUM, MAX_TILE = range(4)
+
+class shared_transition_arrays(transition_arrays):
+  def __init__(self, capacity, ctx):
+    """
+    transition_arrays whose storage lives in shared memory, so actor processes can write
+    transitions that the learner samples. Writes and reads are serialized by a lock.
+
+    Parameters
+    ----------
+    capacity : int
+      Number of transitions stored before the oldest ones are overwritten
+    ctx : multiprocessing context
+      Context the lock is created from
+    """
+    self.capacity = capacity
+    self.lock = ctx.Lock()
+    self.tensors = {
+      'states': torch.zeros((capacity, 16), dtype=torch.uint8),
+      'next_states': torch.zeros((capacity, 16), dtype=torch.uint8),
+      'actions': torch.zeros(capacity, dtype=torch.int8),
+      'rewards': torch.zeros(capacity, dtype=torch.float32),
+      'dones': torch.zeros((capacity + 7) // 8, dtype=torch.uint8),
+      # position and size of the ring
+      'counters': torch.zeros(2, dtype=torch.int64),
+    }
+    for tensor in self.tensors.values():
+      tensor.share_memory_()
+    self._make_views()
+
+  def _make_views(self):
+    """
+    Exposes the shared tensors as the numpy arrays transition_arrays works on.
+    """
+    for name, tensor in self.tensors.items():
+      setattr(self, name, tensor.numpy())
+
+  def __getstate__(self):
+    return {'capacity': self.capacity, 'lock': self.lock, 'tensors': self.tensors}
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._make_views()
+
+  @property
+  def position(self):
+    return int(self.counters[0])
+
+  @position.setter
+  def position(self, value):
+    self.counters[0] = value
+
+  @property
+  def size(self):
+    return int(self.counters[1])
+
+  @size.setter
+  def size(self, value):
+    self.counters[1] = value
+
+  def push_batch(self, states, actions, rewards, next_states, dones):
+    with self.lock:
+      super(shared_transition_arrays, self).push_batch(states, actions, rewards, next_states, dones)
+
+  def get(self, idx):
+    with self.lock:
+      return super(shared_transition_arrays, self).get(idx)
+
+class shared_replay_buffer(replay_buffer):
+  def __init__(self, capacity, ctx, sparse_input=False, device=DEVICE):
+    """
+    Uniform replay buffer backed by shared_transition_arrays. Actors push straight into
+    `self.replay_buffer`, there is no long-term memory.
+    """
+    super(shared_replay_buffer, self).__init__(0, longterm=0, sparse_input=sparse_input, device=device)
+    self.capacity = capacity
+    self.replay_buffer = shared_transition_arrays(capacity, ctx)
+
+def actor_process(actor_id, shared_model, weights_lock, version, transitions, stats, stop, epsilon,
+                  num_envs, flush_every, n_steps, gamma, arch, sparse_input, precision, seed):
+  """
+  Plays num_envs games in lockstep with a local copy of the learner's network and pushes the
+  transitions to the shared replay every flush_every steps. The local copy is refreshed whenever
+  the learner publishes a new weights version. Transitions are accumulated into n-step transitions
+  before they are pushed. The forward passes run at the learner's precision.
+  """
+  torch.set_num_threads(1)
+  rng = np.random.default_rng(seed)
+  envs = VecBoard(num_envs, seed=seed)
+  model = DoubleDQN(n_observations=OBS_SIZE, n_actions=4, arch=arch, sparse_input=sparse_input)
+  model.eval()
+  local_tensors = list(model.state_dict().values())
+  shared_tensors = list(shared_model.state_dict().values())
+  local_version = -1
+  n_step = n_step_accumulator(n_steps, num_envs, gamma)
+
+  if sparse_input:
+    obs = torch.zeros((num_envs, 16), dtype=torch.long)
+  else:
+    obs = torch.zeros((num_envs, OBS_SIZE), dtype=torch.float32)
+  pending = []
+
+  while not stop.is_set():
+    # pull the latest weights from the learner
+    if version.value != local_version:
+      with weights_lock:
+        torch._foreach_copy_(local_tensors, shared_tensors)
+        local_version = version.value
+
+    if sparse_input:
+      obs.numpy()[:] = envs.state.reshape(num_envs, 16)
+    else:
+      one_hot(envs.state, out=obs.numpy())
+    with torch.no_grad(), autocast(precision):
+      actions = epsilon_greedy(model(obs).float(), envs.legal_actions(), epsilon, rng)
+
+    states = envs.state.copy()
+    _, dones = envs.move(actions)
+
+    # the reward is the number of empty cells after the move
+    rewards = np.count_nonzero(envs.state.reshape(num_envs, 16) == 0, axis=1)
+    pending.append(n_step.push(states, actions, rewards, envs.state, dones))
+
+    if dones.any():
+      stats[actor_id, EPISODES] += int(dones.sum())
+      stats[actor_id, SCORE_SUM] += float(envs.score[dones].sum())
+      stats[actor_id, MAX_TILE] = max(float(stats[actor_id, MAX_TILE]), float(envs.get_max()[dones].max()))
+      envs.reset(dones)
+
+    if len(pending) == flush_every:
+      # n-step accumulation completes a varying number of transitions per step, so the pushed ones are counted
+      batch = [np.concatenate(column) for column in zip(*pending)]
+      transitions.push_batch(*batch)
+      stats[actor_id, TRANSITIONS] += len(batch[0])
+      pending = []
+
+def check_actors(actors):
+  '''
+  raises if an actor process has exited, actors only stop when the learner tells them to, so an exit
+  means it crashed. An exception in an actor prints its traceback to stderr
+  '''
+  for i, actor in enumerate(actors):
+    if actor.exitcode is not None:
+      raise RuntimeError(f'actor {i} exited with code {actor.exitcode}')
+
+def actor_epsilons(num_actors, epsilon=0.4, alpha=7):
+  """
+  Exploration rate of every actor, eps_i = epsilon ** (1 + alpha * i / (num_actors - 1)) as in Ape-X.
+  """
+  if num_actors == 1:
+    return [epsilon]
+  return [epsilon ** (1 + alpha * i / (num_actors - 1)) for i in range(num_actors)]
+
+def train_apex(num_updates, num_actors=4, envs_per_actor=8, flush_every=8, broadcast_every=50, min_replay=10000,
+               report_every=10.0, save_path=None, save_every=5000, arch=(1, 256), sparse_input=False, **trainer_kwargs):
+  """
+  Ape-X style training: num_actors processes generate transitions into a shared replay buffer
+  while the learner in this process trains on it continuously.
+
+  Parameters
+  ----------
+  num_updates : int
+    Number of gradient updates the learner runs
+  num_actors : int
+    Number of actor processes
+  envs_per_actor : int
+    Number of games every actor plays in lockstep
+  flush_every : int
+    Number of actor steps buffered locally before they are written to the shared replay
+  broadcast_every : int
+    Number of learner updates between weight broadcasts to the actors
+  min_replay : int
+    Number of transitions collected before the learner starts
+  report_every : float
+    Seconds between throughput reports
+  save_path : str
+    Optional path the online network is saved to every save_every updates
+  trainer_kwargs : dict
+    Remaining DDQNTrainer arguments (capacity, batch_size, lr, gamma, tau, ...)
+
+  Returns
+  -------
+  DDQNTrainer
+    The learner
+
+  Raises
+  ------
+  RuntimeError
+    If an actor process dies, the remaining actors are stopped
+  """
+  ctx = mp.get_context('spawn')
+  capacity = trainer_kwargs.pop('capacity', 50000)
+  device = trainer_kwargs.get('device', DEVICE)
+  n_steps = trainer_kwargs.get('n_steps', 1)
+  gamma = trainer_kwargs.get('gamma', 0.99)
+  precision = trainer_kwargs.get('precision', 'fp32')
+  replay = shared_replay_buffer(capacity, ctx, sparse_input=sparse_input, device=device)
+  trainer = DDQNTrainer(num_envs=1, replay=replay, arch=arch, sparse_input=sparse_input, **trainer_kwargs)
+
+  # weights published to the actors, with a version counter they poll
+  shared_model = DoubleDQN(n_observations=OBS_SIZE, n_actions=4, arch=arch, sparse_input=sparse_input)
+  shared_model.share_memory()
+  shared_tensors = list(shared_model.state_dict().values())
+  online_tensors = list(trainer.Q_online.state_dict().values())
+  weights_lock = ctx.Lock()
+  version = ctx.Value('q', 0)
+
+  def broadcast():
+    with weights_lock:
+      torch._foreach_copy_(shared_tensors, [t.detach().cpu() for t in online_tensors])
+      version.value += 1
+
+  broadcast()
+  stats = torch.zeros((num_actors, 4), dtype=torch.float64).share_memory_()
+  stop = ctx.Event()
+  actors = [ctx.Process(target=actor_process, daemon=True,
+                        args=(i, shared_model, weights_lock, version, replay.replay_buffer, stats, stop, eps,
+                              envs_per_actor, flush_every, n_steps, gamma, arch, sparse_input, precision, 1000 + i))
+            for i, eps in enumerate(actor_epsilons(num_actors))]
+  for actor in actors:
+    actor.start()
+
+  try:
+    while len(replay.replay_buffer) < min_replay:
+      check_actors(actors)
+      time.sleep(0.1)
+
+    start = last_report = time.perf_counter()
+    last_transitions = stats[:, TRANSITIONS].sum().item()
+    last_updates = 0
+    for update in range(1, num_updates + 1):
+      check_actors(actors)
+      trainer.optimize()
+      if update % broadcast_every == 0:
+        broadcast()
+      if save_path is not None and update % save_every == 0:
+        torch.save(trainer.Q_online.state_dict(), save_path)
+
+      now = time.perf_counter()
+      if now - last_report >= report_every:
+        transitions = stats[:, TRANSITIONS].sum().item()
+        episodes = stats[:, EPISODES].sum().item()
+        mean_score = stats[:, SCORE_SUM].sum().item() / max(episodes, 1)
+        print(f'{now - start:7.1f}s | actors {(transitions - last_transitions) / (now - last_report):8.0f} transitions/s '
+              f'| learner {(update - last_updates) / (now - last_report):6.1f} updates/s '
+              f'({(update - last_updates) * trainer.batch_size / (now - last_report):8.0f} samples/s) '
+              f'| {int(episodes)} games, mean score {mean_score:.0f}, max tile {stats[:, MAX_TILE].max().item():.0f}')
+        last_report, last_transitions, last_updates = now, transitions, update
+  finally:
+    stop.set()
+    for actor in actors:
+      actor.join(timeout=10)
+      if actor.is_alive():
+        actor.terminate()
+
+  if save_path is not None:
+    torch.save(trainer.Q_online.state_dict(), save_path)
+  return trainer
+
+if __name__ == "__main__":
+  # Define save path for model checkpoints
+  SAVE_PATH = os.path.join(os.path.dirname(__file__), 'data', 'Checkpoints', 'Apex.pt')
+  os.makedirs(os.path.dirname(SAVE_PATH), exist_ok=True)
+
+  # Define hyperparameters
+  NUM_ACTORS = max(1, (os.cpu_count() or 2) - 1)
+  ENVS_PER_ACTOR = 8
+  NUM_UPDATES = 200000
+  CAPACITY = 50000
+  BATCH_SIZE = 128
+  LR = 1e-5
+  GAMMA = 0.99
+  TAU = 0.001
+
+  # Number of rewards summed into every transition before bootstrapping, 1 is the plain DDQN target.
+  # Try 3 for faster credit assignment
+  N_STEPS = 1
+
+  train_apex(NUM_UPDATES, num_actors=NUM_ACTORS, envs_per_actor=ENVS_PER_ACTOR, save_path=SAVE_PATH,
+             capacity=CAPACITY, batch_size=BATCH_SIZE, lr=LR, gamma=GAMMA, n_steps=N_STEPS, tau=TAU, prioritized=False)
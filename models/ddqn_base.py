@@ -1,9 +1,7 @@
 import copy
 import os
-import random
 import shutil
-from collections import deque, namedtuple
-from itertools import count
+import time
 
 import matplotlib
 import matplotlib.pyplot as plt
@@ -12,13 +10,112 @@ import torch
 import torch.optim as optim
 from torch import nn
 
+# internal modules, importable both from the repo root and from inside models/
+try:
+  from .env.board import Board
+  from .env.encoding import OBS_SIZE, one_hot
+  from .env.vec_board import VecBoard
+  from .utils.checkpoint import CheckpointManager, rng_state, set_rng_state
+  from .utils.layers import ExponentEmbedding, convert_dense_state_dict
+  from .utils.metrics import MetricsWriter, read_metrics, rotate_metrics
+  from .utils.precision import autocast, check_precision
+except ImportError:
+  from env.board import Board
+  from env.encoding import OBS_SIZE, one_hot
+  from env.vec_board import VecBoard
+  from utils.checkpoint import CheckpointManager, rng_state, set_rng_state
+  from utils.layers import ExponentEmbedding, convert_dense_state_dict
+  from utils.metrics import MetricsWriter, read_metrics, rotate_metrics
+  from utils.precision import autocast, check_precision
+
 DEVICE  = "cuda" if torch.cuda.is_available() else "cpu"
 print(f'Using {DEVICE} device')
 
+class transition_arrays():
+  def __init__(self, capacity):
+    """
+    Ring buffer of transitions kept in contiguous preallocated arrays.
+
+    Parameters
+    ----------
+    capacity : int
+      Number of transitions stored before the oldest ones are overwritten
+    """
+    self.capacity = capacity
+    self.states = np.zeros((capacity, 16), dtype=np.uint8)
+    self.next_states = np.zeros((capacity, 16), dtype=np.uint8)
+    self.actions = np.zeros(capacity, dtype=np.int8)
+    self.rewards = np.zeros(capacity, dtype=np.float32)
+    # one bit per transition, set when the next state is terminal
+    self.dones = np.zeros((capacity + 7) // 8, dtype=np.uint8)
+    self.position = 0
+    self.size = 0
+
+  def push_batch(self, states, actions, rewards, next_states, dones):
+    """
+    Writes a batch of transitions at the head of the ring.
+
+    Parameters
+    ----------
+    states, next_states : np.ndarray
+      Board exponents of shape (n, 4, 4) or (n, 16)
+    actions, rewards, dones : np.ndarray
+      Arrays of shape (n,)
+    """
+    dones = np.asarray(dones, dtype=bool)
+    n = len(dones)
+    if n == 0 or self.capacity == 0:
+      return
+    idx = (self.position + np.arange(n)) % self.capacity
+    self.states[idx] = np.asarray(states).reshape(n, 16)
+    self.next_states[idx] = np.asarray(next_states).reshape(n, 16)
+    self.actions[idx] = actions
+    self.rewards[idx] = rewards
+
+    # clear the done bits of the overwritten slots, then set the new ones
+    byte, bit = idx >> 3, (1 << (idx & 7)).astype(np.uint8)
+    np.bitwise_and.at(self.dones, byte, ~bit)
+    np.bitwise_or.at(self.dones, byte[dones], bit[dones])
+
+    self.position = (self.position + n) % self.capacity
+    self.size = min(self.size + n, self.capacity)
+
+  def get(self, idx):
+    """
+    Gathers the transitions at the given indices.
+
+    Returns
+    -------
+    tuple(np.ndarray)
+      states, actions, rewards, next_states and dones of the selected transitions
+    """
+    dones = (self.dones[idx >> 3] >> (idx & 7)) & 1
+    return self.states[idx], self.actions[idx], self.rewards[idx], self.next_states[idx], dones
+
+  def __len__(self):
+    return self.size
+
+  def state_dict(self):
+    """
+    Returns the stored transitions and ring counters.
+    """
+    return {'states': self.states, 'next_states': self.next_states, 'actions': self.actions, 'rewards': self.rewards,
+            'dones': self.dones, 'position': self.position, 'size': self.size}
+
+  def load_state_dict(self, state_dict):
+    """
+    Restores transitions saved with state_dict into the preallocated arrays.
+    """
+    for name in ('states', 'next_states', 'actions', 'rewards', 'dones'):
+      getattr(self, name)[...] = state_dict[name]
+    self.position = state_dict['position']
+    self.size = state_dict['size']
+
 class replay_buffer():
-  def __init__(self, capacity, longterm = 0.1):
+  def __init__(self, capacity, longterm = 0.1, sparse_input=False, device=DEVICE):
     """
     Initialize the replay buffer with given capacity and long-term memory percentage.
+    Transitions are stored as uint8 board exponents in preallocated arrays.
     
     Parameters
     ----------
@@ -26,47 +123,84 @@ class replay_buffer():
       Capacity of the replay buffer
     longterm : float
       Percentage of the replay buffer that is saved to longterm memory
+    sparse_input : bool
+      Default False, if True sampled states are exponent tensors instead of one-hot vectors
+    device : str
+      Device the sampled batch tensors are placed on
     """
     self.capacity = capacity
-    # Initialize the replay buffer with deque object, which is a double-ended queue that can add and remove elements from both ends
-    self.replay_buffer = deque(maxlen=capacity)
+    self.sparse_input = sparse_input
+    self.device = device
+    self.rng = np.random.default_rng()
+    self.replay_buffer = transition_arrays(capacity)
 
     self.longterm = longterm
     # Calculate the maximum number of experiences that can be stored in long-term memory
     self.longterm_capacity = int(capacity * longterm)
-    # Initialize the long-term memory with deque object
-    self.longterm_buffer = deque(maxlen=self.longterm_capacity)
+    self.longterm_buffer = transition_arrays(self.longterm_capacity)
 
     # Initialize the counter for the number of experiences that have been added to the replay buffer to add to long-term memory periodically
     self.count = 0
 
-  def push(self, *args):
+  def push(self, state, action, reward, next_state, done):
     """
-    Adds new experiences to the replay buffer and long-term memory
+    Adds a new experience to the replay buffer and long-term memory.
+    States are the 4x4 uint8 board exponents.
+    """
+    self.push_batch(np.asarray(state).reshape(1, 16), [action], [reward], np.asarray(next_state).reshape(1, 16), [done])
+
+  def push_batch(self, states, actions, rewards, next_states, dones):
     """
+    Adds a batch of experiences to the replay buffer and long-term memory
+    """
+    n = len(dones)
+
     # Add experiences to the long-term buffer periodically
-    if self.count < self.longterm_capacity * self.longterm:
-      self.longterm_buffer.append(TRANSITION(*args))
-    self.count += 1
-    if self.count > int(self.capacity / 2):
-      self.count = 0
-    
-    #save transition to replay buffer
-    self.replay_buffer.append(TRANSITION(*args))
+    counts = (self.count + np.arange(n)) % (int(self.capacity / 2) + 1)
+    keep = counts < self.longterm_capacity * self.longterm
+    if keep.any():
+      self.longterm_buffer.push_batch(np.asarray(states)[keep], np.asarray(actions)[keep], np.asarray(rewards)[keep],
+                                      np.asarray(next_states)[keep], np.asarray(dones)[keep])
+    self.count = (self.count + n) % (int(self.capacity / 2) + 1)
+
+    #save transitions to replay buffer
+    self.replay_buffer.push_batch(states, actions, rewards, next_states, dones)
 
   def sample(self, batch_size):
     """
-    Samples a random size N minibatch from replay memory
+    Samples a random size N minibatch from replay memory, with 10% drawn from long-term memory once the buffer is full.
+
+    Returns
+    -------
+    tuple(tensor)
+      state batch, action batch (N, 1), reward batch (N,), next state batch and done batch (N,)
     """
-    if len(self.replay_buffer) == self.capacity:
+    idx = self.rng.integers(len(self.replay_buffer), size=batch_size)
+    batch = self.replay_buffer.get(idx)
+
+    if len(self.replay_buffer) == self.capacity and len(self.longterm_buffer) > 0:
       long_mem_size = int(batch_size / 10)
-      batch_size -= long_mem_size
-      # sameples batch_size experiences from replay buffer and long-term memory
-      return random.sample(self.replay_buffer, batch_size) + random.sample(self.replay_buffer, long_mem_size)
-    
-    # sameples batch_size experiences from replay buffer
-    return random.sample(self.replay_buffer, batch_size)
+      long_idx = self.rng.integers(len(self.longterm_buffer), size=long_mem_size)
+      long_batch = self.longterm_buffer.get(long_idx)
+      batch = [np.concatenate((recent[:batch_size - long_mem_size], old)) for recent, old in zip(batch, long_batch)]
+
+    return self.to_tensors(*batch)
 
+  def to_tensors(self, states, actions, rewards, next_states, dones):
+    """
+    Converts sampled arrays into batch tensors ready for the Q networks.
+    """
+    if self.sparse_input:
+      states = torch.from_numpy(states).long()
+      next_states = torch.from_numpy(next_states).long()
+    else:
+      states = torch.from_numpy(one_hot(states))
+      next_states = torch.from_numpy(one_hot(next_states))
+    return (states.to(self.device),
+            torch.from_numpy(actions).long().unsqueeze(1).to(self.device),
+            torch.from_numpy(rewards).to(self.device),
+            next_states.to(self.device),
+            torch.from_numpy(dones).float().to(self.device))
 
   def get_replay_buffer(self):
     """
@@ -79,10 +213,269 @@ class replay_buffer():
     Returns the length of the replay buffer.
     """
     return len(self.replay_buffer)
+
+  def state_dict(self):
+    """
+    Returns the contents of the replay buffer and long-term memory, for checkpoints.
+    """
+    return {'replay_buffer': self.replay_buffer.state_dict(), 'longterm_buffer': self.longterm_buffer.state_dict(),
+            'count': self.count, 'rng': self.rng.bit_generator.state}
+
+  def load_state_dict(self, state_dict):
+    """
+    Restores a replay buffer saved with state_dict.
+    """
+    self.replay_buffer.load_state_dict(state_dict['replay_buffer'])
+    self.longterm_buffer.load_state_dict(state_dict['longterm_buffer'])
+    self.count = state_dict['count']
+    self.rng.bit_generator.state = state_dict['rng']
   
+class sum_tree():
+  def __init__(self, capacity):
+    """
+    Array-based binary sum tree over `capacity` leaf priorities.
+    Node i has children 2i and 2i+1, the root is node 1 and leaf j is node `size + j`.
+
+    Parameters
+    ----------
+    capacity : int
+      Number of leaves
+    """
+    self.capacity = capacity
+    self.size = 1
+    while self.size < capacity:
+      self.size *= 2
+    self.depth = self.size.bit_length() - 1
+    self.tree = np.zeros(2 * self.size, dtype=np.float64)
+
+  def total(self):
+    """
+    Returns the sum of all priorities.
+    """
+    return self.tree[1]
+
+  def get(self, idx):
+    """
+    Returns the priorities of the given leaves.
+    """
+    return self.tree[self.size + idx]
+
+  def update(self, idx, priorities):
+    """
+    Sets the priorities of a batch of leaves and recomputes their ancestors one tree level at a time,
+    so a batch update costs O(log n) vectorized steps.
+
+    Parameters
+    ----------
+    idx : np.ndarray
+      Leaf indices
+    priorities : np.ndarray
+      New priorities of those leaves
+    """
+    nodes = self.size + np.asarray(idx)
+    self.tree[nodes] = priorities
+    for _ in range(self.depth):
+      nodes = np.unique(nodes >> 1)
+      self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+  def find(self, values):
+    """
+    Finds, for every value in [0, total), the leaf whose prefix-sum interval contains it.
+    All values descend the tree together, one level per step.
+
+    Parameters
+    ----------
+    values : np.ndarray
+      Prefix-sum values to look up
+
+    Returns
+    -------
+    np.ndarray
+      Leaf indices
+    """
+    values = np.array(values, dtype=np.float64)
+    nodes = np.ones(len(values), dtype=np.int64)
+    for _ in range(self.depth):
+      left = self.tree[2 * nodes]
+      go_right = values >= left
+      values -= left * go_right
+      nodes = 2 * nodes + go_right
+    return nodes - self.size
+
+class prioritized_replay_buffer(replay_buffer):
+  def __init__(self, capacity, alpha=0.6, beta=0.4, beta_steps=100000, eps=1e-5, **kwargs):
+    """
+    Replay buffer that samples transitions proportionally to their TD error (Schaul et al. 2015).
+    Storage and long-term memory are the same as in replay_buffer, priorities are kept in a sum tree.
+
+    Parameters
+    ----------
+    capacity : int
+      Capacity of the replay buffer
+    alpha : float
+      How strongly priorities skew sampling, 0 is uniform
+    beta : float
+      Initial importance-sampling exponent, annealed linearly to 1
+    beta_steps : int
+      Number of sample calls over which beta reaches 1
+    eps : float
+      Added to every TD error so no transition gets zero priority
+    """
+    super(prioritized_replay_buffer, self).__init__(capacity, **kwargs)
+    self.tree = sum_tree(capacity)
+    self.alpha = alpha
+    self.beta = beta
+    self.beta_increment = (1.0 - beta) / beta_steps
+    self.eps = eps
+    self.max_priority = 1.0
+
+  def push_batch(self, states, actions, rewards, next_states, dones):
+    """
+    Adds a batch of experiences, new transitions get the highest priority seen so far
+    """
+    idx = np.unique((self.replay_buffer.position + np.arange(len(dones))) % self.capacity)
+    super(prioritized_replay_buffer, self).push_batch(states, actions, rewards, next_states, dones)
+    self.tree.update(idx, np.full(len(idx), self.max_priority))
+
+  def sample(self, batch_size):
+    """
+    Samples a size N minibatch with probability proportional to priority. The priority mass is
+    split into equal segments and one transition is drawn from each. As in replay_buffer.sample,
+    10% of the batch is drawn uniformly from long-term memory once the buffer is full, those
+    transitions have weight 1 and index -1.
+
+    Returns
+    -------
+    tuple(tensor)
+      state, action, reward, next state and done batches as in replay_buffer.sample,
+      followed by the importance-sampling weights (N,) and the sampled indices as np.ndarray
+    """
+    long_mem_size = 0
+    if len(self.replay_buffer) == self.capacity and len(self.longterm_buffer) > 0:
+      long_mem_size = int(batch_size / 10)
+    n = batch_size - long_mem_size
+
+    total = self.tree.total()
+    values = (np.arange(n) + self.rng.random(n)) * (total / n)
+    idx = np.minimum(self.tree.find(values), len(self.replay_buffer) - 1)
+
+    # importance-sampling weights, normalized by the largest weight in the batch
+    self.beta = min(1.0, self.beta + self.beta_increment)
+    probs = self.tree.get(idx) / total
+    weights = (len(self.replay_buffer) * probs) ** -self.beta
+    weights = (weights / weights.max()).astype(np.float32)
+    batch = self.replay_buffer.get(idx)
+
+    if long_mem_size:
+      long_idx = self.rng.integers(len(self.longterm_buffer), size=long_mem_size)
+      batch = [np.concatenate((recent, old)) for recent, old in zip(batch, self.longterm_buffer.get(long_idx))]
+      weights = np.concatenate((weights, np.ones(long_mem_size, dtype=np.float32)))
+      idx = np.concatenate((idx, np.full(long_mem_size, -1)))
+
+    return self.to_tensors(*batch) + (torch.from_numpy(weights).to(self.device), idx)
+
+  def update_priorities(self, idx, td_errors):
+    """
+    Sets the priorities of sampled transitions from their new absolute TD errors.
+    Long-term memory transitions (index -1) have no priority and are skipped.
+
+    Parameters
+    ----------
+    idx : np.ndarray
+      Indices returned by sample
+    td_errors : np.ndarray or tensor
+      TD errors of those transitions
+    """
+    if torch.is_tensor(td_errors):
+      td_errors = td_errors.detach().cpu().numpy()
+    keep = idx >= 0
+    idx, td_errors = idx[keep], td_errors[keep]
+    priorities = (np.abs(td_errors) + self.eps) ** self.alpha
+    self.max_priority = max(self.max_priority, priorities.max())
+    self.tree.update(idx, priorities)
+
+  def state_dict(self):
+    state_dict = super(prioritized_replay_buffer, self).state_dict()
+    state_dict.update({'tree': self.tree.tree, 'max_priority': self.max_priority, 'beta': self.beta})
+    return state_dict
+
+  def load_state_dict(self, state_dict):
+    super(prioritized_replay_buffer, self).load_state_dict(state_dict)
+    self.tree.tree[...] = state_dict['tree']
+    self.max_priority = state_dict['max_priority']
+    self.beta = state_dict['beta']
+
+class n_step_accumulator():
+  def __init__(self, n, num_envs, gamma):
+    """
+    Turns the 1-step transitions of N lockstep games into n-step transitions.
+    Every game keeps a window of its last n pending transitions, stored as (n, N) ring arrays.
+
+    Parameters
+    ----------
+    n : int
+      Number of steps summed into every reward before bootstrapping
+    num_envs : int
+      Number of games pushed per call
+    gamma : float
+      Discount factor
+    """
+    self.n = n
+    self.num_envs = num_envs
+    self.discounts = gamma ** np.arange(n + 1, dtype=np.float32)
+    self.states = np.zeros((n, num_envs, 16), dtype=np.uint8)
+    self.actions = np.zeros((n, num_envs), dtype=np.int8)
+    self.returns = np.zeros((n, num_envs), dtype=np.float32)
+    # number of rewards already summed into every pending transition
+    self.ages = np.zeros((n, num_envs), dtype=np.int64)
+    self.pending = np.zeros((n, num_envs), dtype=bool)
+    self.t = 0
+
+  def push(self, states, actions, rewards, next_states, dones):
+    """
+    Adds one step of every game and returns the transitions completed by it.
+    A transition is complete once n rewards have been summed, or when its game ends; then it is
+    emitted with the partial return and done set, so nothing bootstraps across episodes.
+
+    Returns
+    -------
+    tuple(np.ndarray)
+      states, actions, n-step discounted rewards, bootstrap states and dones of the completed transitions
+    """
+    slot = self.t % self.n
+    self.t += 1
+    self.states[slot] = np.asarray(states).reshape(self.num_envs, 16)
+    self.actions[slot] = actions
+    self.returns[slot] = 0
+    self.ages[slot] = 0
+    self.pending[slot] = True
+
+    # every pending transition of a game gets the new reward, discounted by its age
+    self.returns += self.pending * self.discounts[self.ages] * np.asarray(rewards, dtype=np.float32)
+    self.ages += self.pending
+
+    dones = np.asarray(dones, dtype=bool)
+    complete = self.pending & ((self.ages == self.n) | dones)
+    slots, envs = np.nonzero(complete)
+    self.pending[complete] = False
+    next_states = np.asarray(next_states).reshape(self.num_envs, 16)
+    return self.states[slots, envs], self.actions[slots, envs], self.returns[slots, envs], next_states[envs], dones[envs]
+
+  def state_dict(self):
+    """
+    Returns the pending transitions of every game.
+    """
+    return {'states': self.states, 'actions': self.actions, 'returns': self.returns, 'ages': self.ages,
+            'pending': self.pending, 't': self.t}
+
+  def load_state_dict(self, state_dict):
+    for name in ('states', 'actions', 'returns', 'ages', 'pending'):
+      getattr(self, name)[...] = state_dict[name]
+    self.t = state_dict['t']
+
 class DoubleDQN(nn.Module):
 
-  def __init__(self, n_observations, n_actions, arch=(2, 32), drop=False, batch_norm=False):
+  def __init__(self, n_observations, n_actions, arch=(2, 32), drop=False, batch_norm=False, sparse_input=False):
     """
     Initializes the Double DQN model with the specified architecture.
 
@@ -98,8 +491,11 @@ class DoubleDQN(nn.Module):
       Default False, indicating if dropout is wanted
     batch_norm : bool
       Default False, indicating if batch normalization is wanted
+    sparse_input : bool
+      Default False, if True the network takes the 16 board exponents instead of the one-hot vector
     """
     super(DoubleDQN, self).__init__()
+    self.sparse_input = sparse_input
     self.Q_net = self.build_Q_net(n_observations, n_actions, arch=arch, drop=drop, batch_norm=batch_norm)
 
   def forward(self, x):
@@ -109,7 +505,7 @@ class DoubleDQN(nn.Module):
     Parameters
     ----------
     x : tensor
-      Input tensor of shape (batch_size, n_observations)
+      Input tensor of shape (batch_size, n_observations), or (batch_size, 16) exponents with sparse_input
 
     Returns
     -------
@@ -142,7 +538,10 @@ class DoubleDQN(nn.Module):
     """
     layers = []
     cl, lw = arch
-    layers.append(nn.Linear(n_observations, lw))
+    if self.sparse_input:
+      layers.append(ExponentEmbedding(lw, n_exponents=n_observations // 16))
+    else:
+      layers.append(nn.Linear(n_observations, lw))
     layers.append(nn.ReLU())
     for _ in range(cl):
       layers.append(nn.Linear(lw, lw))
@@ -156,6 +555,90 @@ class DoubleDQN(nn.Module):
     layers.append(nn.Linear(lw, n_actions))
     return nn.Sequential(*layers)
 
+  def load_dense_state_dict(self, state_dict):
+    """
+    Loads a checkpoint saved with the dense one-hot input layer, converting it when sparse_input is set.
+
+    Parameters
+    ----------
+    state_dict : dict
+      State dict of a dense DoubleDQN, e.g. loaded from Test4_5_active_final.pt
+    """
+    if self.sparse_input:
+      state_dict = convert_dense_state_dict(state_dict, 'Q_net.0')
+    self.load_state_dict(state_dict)
+
+class TargetNetworkUpdater():
+  def __init__(self, online, target, tau=0.001, every=1, hard=False):
+    """
+    Keeps a target network in sync with an online network with in-place multi-tensor updates,
+    no state dicts are built or loaded.
+
+    Parameters
+    ----------
+    online : nn.Module
+      Network being trained
+    target : nn.Module
+      Network updated towards the online network, with the same architecture
+    tau : float
+      Soft update rate per environment step
+    every : int
+      Only update every `every` steps. Soft updates then use 1 - (1 - tau)**every so the
+      target moves as far as it would with one update per step
+    hard : bool
+      Default False, if True the online weights are copied into the target every `every` steps
+    """
+    self.tau = tau
+    self.every = every
+    self.hard = hard
+    self.effective_tau = 1.0 - (1.0 - tau) ** every
+
+    # floating point tensors are interpolated, integer buffers (e.g. batch norm counters) are copied
+    online_tensors = list(online.parameters()) + list(online.buffers())
+    target_tensors = list(target.parameters()) + list(target.buffers())
+    self.online_float = [o for o in online_tensors if o.is_floating_point()]
+    self.target_float = [t for t in target_tensors if t.is_floating_point()]
+    self.online_other = [o for o in online_tensors if not o.is_floating_point()]
+    self.target_other = [t for t in target_tensors if not t.is_floating_point()]
+
+    self.steps = 0
+    self.updates = 0
+    self.update_time = 0.0
+
+  @torch.no_grad()
+  def step(self):
+    """
+    Call once per environment step, updates the target network when due.
+
+    Returns
+    -------
+    bool
+      Whether the target network was updated
+    """
+    self.steps += 1
+    if self.steps % self.every != 0:
+      return False
+
+    start = time.perf_counter()
+    if self.hard:
+      torch._foreach_copy_(self.target_float, self.online_float)
+    else:
+      torch._foreach_lerp_(self.target_float, self.online_float, self.effective_tau)
+    if self.online_other:
+      torch._foreach_copy_(self.target_other, self.online_other)
+    self.update_time += time.perf_counter() - start
+    self.updates += 1
+    return True
+
+  def stats(self):
+    """
+    Returns the number of updates and the time spent in them.
+    """
+    return {'steps': self.steps,
+            'updates': self.updates,
+            'update_time': self.update_time,
+            'us_per_update': 1e6 * self.update_time / max(self.updates, 1)}
+
 class EnvironmentWrapper():
   """
   A wrapper for the 2048 game board, to be used for reinforcement learning.
@@ -167,16 +650,15 @@ class EnvironmentWrapper():
       self.board = Board()
 
       # Set the size of the observation space
-      state = np.log2(self.board.state, out=np.zeros_like(self.board.state), where=(self.board.state != 0)).reshape(-1).astype(int)
-      state = np.eye(18)[state].flatten()
-      self.observation_space_len = state.shape[0]
+      self.observation_space_len = OBS_SIZE
 
       # Set the size of the action space
       self.action_space_len = 4
 
-  def reset(self):
+  def reset(self, out=None):
       """
       Resets the game board and returns the initial state of the game.
+      If `out` is given the one-hot state is written into that preallocated (288,) buffer.
       """
       # Reset the board
       self.board.init_board()
@@ -187,22 +669,20 @@ class EnvironmentWrapper():
       # Reset score back to 0
       self.board.score = 0
 
-      # Return the state and flatten it so that it can be passed to the network as a vector
-      state = np.log2(self.board.state, out=np.zeros_like(self.board.state), where=(self.board.state != 0)).reshape(-1).astype(int)
-      state = np.eye(18)[state].flatten()
-      return state
+      # Return the one-hot state as a flat vector so that it can be passed to the network
+      return one_hot(self.board.state, out=out)
   
-  def step(self, action):
+  def step(self, action, out=None):
       """
       Takes a step in the game based on the chosen action and returns the new state,
       reward, and whether the game is over or not.
+      If `out` is given the one-hot next state is written into that preallocated (288,) buffer.
       """
       # Move the game board based on the chosen action
       self.board.move(action)
 
       # Get the next state of the game board
-      next_state = np.log2(self.board.state, out=np.zeros_like(self.board.state), where=(self.board.state != 0)).reshape(-1).astype(int)
-      next_state = (np.eye(18)[next_state]).flatten()
+      next_state = one_hot(self.board.state, out=out)
 
       # Get the reward for taking the step
       reward = self.get_reward(self.board.state)
@@ -227,22 +707,331 @@ class EnvironmentWrapper():
     reward = empty_spots
     return reward
     
+def epsilon_greedy(q_values, legal, epsilon, rng):
+  """
+  Picks the best legal action of every game, or a uniformly random legal action with probability epsilon.
+
+  Parameters
+  ----------
+  q_values : tensor
+    Q values of shape (N, n_actions)
+  legal : np.ndarray
+    Boolean mask of shape (N, n_actions) of the moves that change each board
+  epsilon : float
+    Exploration rate
+  rng : np.random.Generator
+    Random generator of the exploration draws
+
+  Returns
+  -------
+  np.ndarray
+    The chosen actions, shape (N,)
+  """
+  q_values = q_values.masked_fill(torch.from_numpy(~legal).to(q_values.device), -float('inf'))
+  actions = q_values.argmax(dim=1).cpu().numpy()
+
+  # explore with a uniformly random legal move in the games whose draw is below epsilon
+  explore = rng.random(len(actions)) < epsilon
+  if explore.any():
+    random_actions = np.argmax(rng.random(legal.shape) * legal, axis=1)
+    actions = np.where(explore, random_actions, actions)
+  return actions
+
+class DDQNTrainer():
+  """
+  Double DQN training on N games stepped in lockstep.
+  Owns the online and target networks, the optimizer, the replay buffer and the games.
+  """
+
+  def __init__(self, num_envs=16, capacity=50000, batch_size=128, lr=1e-5, gamma=0.99, n_steps=1, tau=0.001, target_update_every=1,
+               clipping=1000, eps_start=0.02, eps_end=0.01, eps_decay=10000, update_to_data=1.0, prioritized=False,
+               alpha=0.6, beta=0.4, arch=(1, 256), sparse_input=False, device=DEVICE, seed=None, replay=None, precision='fp32'):
+    """
+    Parameters
+    ----------
+    num_envs : int
+      Number of games played side by side
+    capacity : int
+      Capacity of the replay buffer
+    batch_size : int
+      Minibatch size of every gradient update
+    lr : float
+      Learning rate of the AdamW optimizer
+    gamma : float
+      Discount factor
+    n_steps : int
+      Number of rewards summed into every transition, the target bootstraps with gamma**n_steps
+    tau : float
+      Soft update rate of the target network per gradient update
+    target_update_every : int
+      Number of gradient updates between target network updates
+    clipping : float
+      Gradient clipping value
+    eps_start, eps_end, eps_decay : float
+      Exploration rate schedule over environment transitions
+    update_to_data : float
+      Gradient updates per environment transition, one lockstep step gives num_envs transitions
+    prioritized : bool
+      Default False, if True transitions are sampled by TD error
+    alpha, beta : float
+      Prioritized replay exponents
+    arch : tuple
+      Architecture of the Q networks, see DoubleDQN
+    sparse_input : bool
+      Default False, if True the Q networks take the 16 cell exponents instead of the one-hot vector
+    device : str
+      Device of the networks
+    seed : int
+      Optional seed of the games and of the exploration
+    replay : replay_buffer
+      Optional replay buffer to train from instead of building one from capacity, prioritized, alpha and beta
+    precision : str
+      Default 'fp32', with 'bf16' the forward passes and the loss run under bfloat16 autocast
+      while the weights and the optimizer state stay float32
+    """
+    self.num_envs = num_envs
+    self.batch_size = batch_size
+    self.gamma = gamma
+    self.n_steps = n_steps
+    self.bootstrap_discount = gamma ** n_steps
+    self.clipping = clipping
+    self.eps_start = eps_start
+    self.eps_end = eps_end
+    self.eps_decay = eps_decay
+    self.update_to_data = update_to_data
+    self.sparse_input = sparse_input
+    self.device = device
+    self.precision = check_precision(precision)
+    self.rng = np.random.default_rng(seed)
+
+    self.envs = VecBoard(num_envs, seed=seed)
+    self.n_actions = 4
+    self.n_step = n_step_accumulator(n_steps, num_envs, gamma)
+
+    # Initialize the online and target Q-networks
+    self.Q_online = DoubleDQN(n_observations=OBS_SIZE, n_actions=self.n_actions, arch=arch, sparse_input=sparse_input).to(device)
+    self.Q_target = copy.deepcopy(self.Q_online)
+    self.target_updater = TargetNetworkUpdater(self.Q_online, self.Q_target, tau=tau, every=target_update_every)
+
+    # Define optimizer and replay buffer
+    self.optimizer = optim.AdamW(self.Q_online.parameters(), lr=lr, amsgrad=True)
+    if replay is not None:
+      self.replay = replay
+    elif prioritized:
+      self.replay = prioritized_replay_buffer(capacity, alpha=alpha, beta=beta, sparse_input=sparse_input, device=device)
+    else:
+      self.replay = replay_buffer(capacity, sparse_input=sparse_input, device=device)
+    self.prioritized = isinstance(self.replay, prioritized_replay_buffer)
+    self.criterion = nn.SmoothL1Loss(reduction='none')
+
+    # observations of all games, overwritten in place every step
+    if sparse_input:
+      self.obs = torch.zeros((num_envs, 16), dtype=torch.long)
+    else:
+      self.obs = torch.zeros((num_envs, OBS_SIZE), dtype=torch.float32)
+
+    self.steps_done = 0
+    self.updates_done = 0
+    self.update_credit = 0.0
+
+    # score and max tile of every finished game, in the order they finished
+    self.episode_scores = []
+    self.episode_max_tiles = []
+
+  def load_weights(self, state_dict):
+    """
+    Loads online network weights and copies them to the target network.
+    """
+    self.Q_online.load_state_dict(state_dict)
+    self.Q_target.load_state_dict(state_dict)
+
+  def state_dict(self):
+    """
+    Returns the complete training state: networks, optimizer moments, step counters, replay buffer, pending n-step
+    transitions, the games in progress and every random generator, so training resumes exactly where it stopped.
+    """
+    return {
+      'Q_online': self.Q_online.state_dict(),
+      'Q_target': self.Q_target.state_dict(),
+      'optimizer': self.optimizer.state_dict(),
+      'replay': self.replay.state_dict(),
+      'n_step': self.n_step.state_dict(),
+      'envs': {'state': self.envs.state, 'score': self.envs.score, 'n_steps': self.envs.n_steps,
+               'terminal': self.envs.terminal, 'rng': self.envs.rng.bit_generator.state},
+      'target_updater': {'steps': self.target_updater.steps, 'updates': self.target_updater.updates},
+      'steps_done': self.steps_done,
+      'updates_done': self.updates_done,
+      'update_credit': self.update_credit,
+      'episode_scores': self.episode_scores,
+      'episode_max_tiles': self.episode_max_tiles,
+      'rng': self.rng.bit_generator.state,
+      'global_rng': rng_state(),
+    }
+
+  def load_state_dict(self, state_dict):
+    """
+    Restores a training state saved with state_dict.
+    """
+    self.Q_online.load_state_dict(state_dict['Q_online'])
+    self.Q_target.load_state_dict(state_dict['Q_target'])
+    self.optimizer.load_state_dict(state_dict['optimizer'])
+    self.replay.load_state_dict(state_dict['replay'])
+    self.n_step.load_state_dict(state_dict['n_step'])
+    for name in ('state', 'score', 'n_steps', 'terminal'):
+      getattr(self.envs, name)[...] = state_dict['envs'][name]
+    self.envs.rng.bit_generator.state = state_dict['envs']['rng']
+    self.target_updater.steps = state_dict['target_updater']['steps']
+    self.target_updater.updates = state_dict['target_updater']['updates']
+    self.steps_done = state_dict['steps_done']
+    self.updates_done = state_dict['updates_done']
+    self.update_credit = state_dict['update_credit']
+    self.episode_scores = list(state_dict['episode_scores'])
+    self.episode_max_tiles = list(state_dict['episode_max_tiles'])
+    self.rng.bit_generator.state = state_dict['rng']
+    set_rng_state(state_dict['global_rng'])
+
+  def epsilon(self):
+    """
+    Returns the current exploration rate.
+    """
+    return self.eps_end + (self.eps_start - self.eps_end) * np.exp(-1. * self.steps_done / self.eps_decay)
+
+  def observe(self):
+    """
+    Encodes the states of all games into the preallocated observation tensor.
+    """
+    if self.sparse_input:
+      self.obs.numpy()[:] = self.envs.state.reshape(self.num_envs, 16)
+    else:
+      one_hot(self.envs.state, out=self.obs.numpy())
+    return self.obs.to(self.device)
+
+  def select_actions(self):
+    """
+    Epsilon-greedy actions for all games from a single batched forward pass.
+    Moves that would not change a board are never chosen.
+    """
+    with torch.no_grad(), autocast(self.precision, self.device):
+      q_values = self.Q_online(self.observe()).float()
+    return epsilon_greedy(q_values, self.envs.legal_actions(), self.epsilon(), self.rng)
+
+  def step(self):
+    """
+    Advances every game by one move, stores the transitions and runs the gradient updates they pay for.
+
+    Returns
+    -------
+    np.ndarray
+      Boolean mask of the games that finished on this step
+    """
+    states = self.envs.state.copy()
+    actions = self.select_actions()
+    _, dones = self.envs.move(actions)
+
+    # the reward is the number of empty cells after the move
+    next_states = self.envs.state
+    rewards = np.count_nonzero(next_states.reshape(self.num_envs, 16) == 0, axis=1)
+    self.replay.push_batch(*self.n_step.push(states, actions, rewards, next_states, dones))
+    self.steps_done += self.num_envs
+
+    if dones.any():
+      self.episode_scores.extend(self.envs.score[dones].tolist())
+      self.episode_max_tiles.extend(self.envs.get_max()[dones].tolist())
+      self.envs.reset(dones)
+
+    # gradient updates per lockstep step follow the update-to-data ratio, fractions carry over
+    self.update_credit += self.update_to_data * self.num_envs
+    while self.update_credit >= 1:
+      self.update_credit -= 1
+      self.optimize()
+    return dones
+
+  def optimize(self):
+    """
+    One gradient update of the online network on a replay minibatch, followed by the target network update.
+
+    Returns
+    -------
+    float
+      The loss, or None while the buffer holds less than one batch
+    """
+    if self.replay.get_replay_buffer_length() < self.batch_size:
+      return None
+    if self.prioritized:
+      state_batch, action_batch, reward_batch, next_state_batch, done_batch, weights, indices = self.replay.sample(self.batch_size)
+    else:
+      state_batch, action_batch, reward_batch, next_state_batch, done_batch = self.replay.sample(self.batch_size)
+
+    # Compute Q(s_t, a) - the model computes Q(s_t), then we select the action already taken.
+    # The forward passes run at the trainer's precision, the targets and the loss in float32
+    with autocast(self.precision, self.device):
+      state_action_values = self.Q_online(state_batch).float().gather(dim=1, index=action_batch).squeeze(1)
+
+      with torch.no_grad():
+        # Compute V(s_{t+1}) for all next states, terminal next states are masked to 0
+        next_best_actions = self.Q_online(next_state_batch).float().argmax(dim=1).unsqueeze(1)
+        next_state_values = self.Q_target(next_state_batch).float().gather(dim=1, index=next_best_actions).squeeze(1)
+
+    with torch.no_grad():
+      expected_state_action_values = reward_batch + self.bootstrap_discount * next_state_values * (1 - done_batch)
+
+    # compute loss using Smooth L1 loss, weighted per transition by the importance-sampling weights
+    losses = self.criterion(state_action_values, expected_state_action_values)
+    if self.prioritized:
+      loss = (weights * losses).mean()
+      self.replay.update_priorities(indices, expected_state_action_values - state_action_values)
+    else:
+      loss = losses.mean()
+
+    # zero the gradients, backpropagate the loss, and clip the gradients
+    self.optimizer.zero_grad()
+    loss.backward()
+    torch.nn.utils.clip_grad_value_(self.Q_online.parameters(), self.clipping)
+    self.optimizer.step()
+
+    self.target_updater.step()
+    self.updates_done += 1
+    return loss.item()
+
+  def train(self, num_episodes, callback=None):
+    """
+    Steps all games until `num_episodes` games have finished.
+
+    Parameters
+    ----------
+    num_episodes : int
+      Number of finished games to train for
+    callback : function
+      Optional, called as callback(trainer, n_finished) after every step on which games finished
+
+    Returns
+    -------
+    list
+      Scores of the finished games
+    """
+    start = len(self.episode_scores)
+    while len(self.episode_scores) - start < num_episodes:
+      dones = self.step()
+      if callback is not None and dones.any():
+        callback(self, int(dones.sum()))
+    return self.episode_scores[start:]
+
 if __name__ == "__main__":
-  from env.board import Board
   is_ipython = 'inline' in matplotlib.get_backend()
   if is_ipython: from IPython import display
-  plt.ion()
   
   # Define save path for model checkpoints
   SAVE_PATH = os.path.join(os.path.dirname(__file__), 'data', 'Checkpoints', 'Test4_5_active_final.pt')
-  
-  # Define named tuple for storing transition data
-  TRANSITION = namedtuple('Transition', ('state', 'action', 'reward', 'next_state'))
 
-  # Initialize the environment
-  env = EnvironmentWrapper()
+  # Define directory of the full training checkpoints, the last KEEP_CHECKPOINTS are kept
+  CHECKPOINT_DIR = os.path.join(os.path.dirname(__file__), 'data', 'Checkpoints', 'ddqn_trainer')
+  KEEP_CHECKPOINTS = 3
+
+  # Define path of the per-episode metrics log, appended to while training and plotted afterwards
+  METRICS_PATH = os.path.join(os.path.dirname(__file__), 'data', 'JSON', 'ddqn_metrics.jsonl')
 
   # Define hyperparameters
+  NUM_ENVS = 16
   CAPACITY = 50000
   BATCH_SIZE = 128
   CLIPPING = 1000
@@ -250,87 +1039,71 @@ if __name__ == "__main__":
   EPS_END = 0.01
   EPS_DECAY = 10000
   GAMMA = 0.99
+
+  # Number of rewards summed into every transition before bootstrapping, 1 is the plain DDQN target
+  # the checkpoints were trained with. Try 3 for faster credit assignment on a fresh run
+  N_STEPS = 1
   TAU = 0.001
+  TARGET_UPDATE_EVERY = 1
   LR = 1e-5
 
-  # Get the number of actions and the number of observations from the environment
-  n_actions = env.action_space_len
-  state = env.reset()
-  n_observations = len(state)
+  # Gradient updates per environment transition
+  UPDATE_TO_DATA = 1.0
+
+  # Sample transitions by TD error instead of uniformly
+  PRIORITIZED = False
+  ALPHA = 0.6
+  BETA = 0.4
+
+  # Compute precision of the forward passes, 'bf16' runs them under CPU bfloat16 autocast with float32 weights
+  PRECISION = 'fp32'
+
+  trainer = DDQNTrainer(num_envs=NUM_ENVS, capacity=CAPACITY, batch_size=BATCH_SIZE, lr=LR, gamma=GAMMA, n_steps=N_STEPS, tau=TAU,
+                        target_update_every=TARGET_UPDATE_EVERY, clipping=CLIPPING, eps_start=EPS_START, eps_end=EPS_END,
+                        eps_decay=EPS_DECAY, update_to_data=UPDATE_TO_DATA, prioritized=PRIORITIZED, alpha=ALPHA, beta=BETA,
+                        precision=PRECISION)
+
+  checkpoints = CheckpointManager(CHECKPOINT_DIR, prefix='ddqn', keep=KEEP_CHECKPOINTS)
 
   # Define function for loading model weights
-  def load_params(net):
+  def load_params(trainer):
     """
-    Load the weights of the network from the checkpoint file if it exists and is not empty.
-    Otherwise, create an empty file to indicate that no weights are found.
+    Resume from the latest full training checkpoint if there is one. Otherwise load the weights of the network
+    from the checkpoint file if it exists and is not empty.
+    Returns the number of metrics records logged up to the checkpoint if training resumed from one, else None.
     """
-    if (os.path.exists(SAVE_PATH) and os.path.getsize(SAVE_PATH) > 0 ):
+    if checkpoints.latest() is not None:
+      print(f'Resuming training from {checkpoints.latest()}...')
+      state = checkpoints.load(map_location=DEVICE)
+      trainer.load_state_dict(state)
+
+      # one record is logged per episode, which older checkpoints without the count fall back to
+      return state.get('metrics_records', len(trainer.episode_scores))
+    elif (os.path.exists(SAVE_PATH) and os.path.getsize(SAVE_PATH) > 0 ):
       print('Previous weights found, loading weights...')
-      net.load_state_dict(torch.load(SAVE_PATH))
+      trainer.load_weights(torch.load(SAVE_PATH, map_location=DEVICE))
        
       #if loading weights succesdful, make a backup
       shutil.copy(SAVE_PATH, SAVE_PATH[0:-3] + 'BackUp.pt')
     else:
       #if no weights are found, create a file to indicate that no weights are found
       print('No weights found')
+    return None
 
-  # Initialize the online and target Q-networks
-  Q_online = DoubleDQN(n_observations=n_observations, n_actions=n_actions, arch=(1, 256)).to(DEVICE)
-  load_params(Q_online)
-  Q_target = copy.deepcopy(Q_online).to(DEVICE) 
-
-  # Define optimizer and replay buffer
-  optimizer = optim.AdamW(Q_online.parameters(), lr=LR, amsgrad=True) 
-  replay = replay_buffer(CAPACITY)
+  # a resumed run continues the metrics log, a fresh run starts a new one and keeps the old log aside
+  metrics_records = load_params(trainer)
+  if metrics_records is None:
+    rotated = rotate_metrics(METRICS_PATH)
+    if rotated is not None:
+      print(f'Previous metrics log moved to {rotated}')
 
-  # Initialize step count
-  steps_done = 0
-
-  # Initialize variables for detecting when the agent is choosing an action with no change in state
-  prev_state = None
-  no_change_count = 0
-
-  # Define function for selecting an action
-  def select_action(state):
-    global steps_done
-    global prev_state
-    global no_change_count
-    
-    # Increment step count
-    steps_done += 1
-
-    # Calculate exploration rate
-    eps_threshold = EPS_END + (EPS_START - EPS_END) * np.exp(-1. * steps_done / EPS_DECAY)
-
-    # Check if current state is the same as the previous state
-    if prev_state is not None and (prev_state == state).all():
-      no_change_count += 1
-    else:
-      prev_state = state.clone().detach()
-      no_change_count = 0
-
-    # Choose action based on epsilon-greedy policy
-    if np.random.uniform() > eps_threshold and no_change_count < 5:
-      with torch.no_grad():
-        return Q_online(state).max(1)[1].view(1, 1)
-    else:
-      return torch.tensor([[np.random.choice(n_actions)]], device=DEVICE, dtype=torch.long)
-
-  episode_scores = []
-
-  # function to plot episode scores
-  def plot_scores(show_results=False):
+  # function to plot the episode scores of the metrics log
+  def plot_scores():
     plt.figure(1)
 
     # convert episode scores to a tensor
-    scores_t = torch.tensor(episode_scores, dtype=torch.float32)
-
-    # set title based on whether we are showing results or training
-    if show_results:
-      plt.title('Results')
-    else:
-      plt.clf()
-      plt.title('Training...')
+    scores_t = torch.tensor(read_metrics(METRICS_PATH)['score'], dtype=torch.float32)
+    plt.title('Results')
 
     # set x and y labels
     plt.xlabel('Episode')
@@ -345,114 +1118,47 @@ if __name__ == "__main__":
       mean_scores = torch.cat((torch.zeros(99), mean_scores))
       plt.plot(mean_scores.numpy(), label='score average')
     
-    # pause a bit so that plots are updated
-    plt.pause(0.001)
-
     # display the figure if using IPython
     if is_ipython:
-      if not show_results:
-        display.display(plt.gcf())
-        display.clear_output(wait=True)
-      else:
-        display.display(plt.gcf())
-
-  # function to optimize the model
-  def optimize_model():
-    if replay.get_replay_buffer_length() < BATCH_SIZE:
-      return
-    transitions = replay.sample(BATCH_SIZE)
-    batch = TRANSITION(*zip(*transitions))
-
-    #get mask of non final states 
-    non_done_masks = torch.tensor(tuple(map(lambda s: s is not None,
-                                            batch.next_state)), device=DEVICE, dtype=torch.bool)
-    
-    #get non final next states
-    non_done_next_states = torch.cat([s for s in batch.next_state if s is not None])
-    
-    state_batch = torch.cat(batch.state)
-    action_batch = torch.cat(batch.action)
-    reward_batch = torch.cat(batch.reward)
-
-    # Compute Q(s_t, a) - the model computes Q(s_t), then we select the action already taken
-    state_action_values = Q_online(state_batch).gather(dim=1, index=action_batch)
-
-    next_state_values = torch.zeros(BATCH_SIZE, device=DEVICE)
-    with torch.no_grad():
-      # Compute V(s_{t+1}) for all next states.
-      next_best_actions = Q_online(non_done_next_states).argmax(dim=1).unsqueeze(1)
-      next_state_values[non_done_masks] = Q_target(non_done_next_states).gather(dim=1, index=next_best_actions).squeeze(1)
-
-      expected_state_action_values = reward_batch + GAMMA * next_state_values
-
-    # compute loss using Smooth L1 loss
-    criterion = nn.SmoothL1Loss()
-    loss = criterion(state_action_values, expected_state_action_values.unsqueeze(1))
-
-    # zero the gradients, backpropagate the loss, and clip the gradients
-    optimizer.zero_grad()
-    loss.backward()
-    torch.nn.utils.clip_grad_value_(Q_online.parameters(), CLIPPING)
-    optimizer.step()
-
+      display.display(plt.gcf())
 
   # set the number of episodes to train for
   num_episodes = 20000
 
-  # run the training loop
-  for i_episode in range(num_episodes):
-
-    # reset environment and convert state to tensor
-    state = env.reset()
-    state = torch.tensor(state, device=DEVICE, dtype=torch.float32).unsqueeze(0)
-
-    #run episode
-    for t in count():
-      
-      # select an action using the online Q network
-      action = select_action(state)
-
-      # take the action and observe the next state, reward, and done flag
-      next_state, reward, done = env.step(action.item())
-
-      # convert the reward to a tensor
-      reward = torch.tensor([reward], device=DEVICE, dtype=torch.float32)
-
-      # if the episode is not done, convert the next state to a tensor and add it to the replay buffer
-      if not done:
-        next_state = torch.tensor(next_state, device=DEVICE, dtype=torch.float32).unsqueeze(0)
-      else:
-        next_state = None
-
-      # add the current state, action, reward, and next state to the replay buffer
-      replay.push(state, action, reward, next_state)
-
-      # set the current state to the next state
-      state = next_state
-
-      # optimize the online Q network by sampling from the replay buffer
-      optimize_model()
-
-      # update the target Q network by copying the online Q network with a soft update
-      Q_target_state_dict = Q_target.state_dict()
-      Q_online_state_dict = Q_online.state_dict()
-      for key in Q_online_state_dict:
-        Q_target_state_dict[key] = TAU * Q_online_state_dict[key] + Q_target_state_dict[key] * (1.0 - TAU)
-        Q_target.load_state_dict(Q_target_state_dict)
-
-      # if the episode is done, record the score, save the online Q network, plot the scores, and break out of the loop
-      if done:
-        episode_scores.append(env.get_score())
-        if i_episode % 10 == 0:
-          print(f'Episode {i_episode} finished after {t+1} steps with score {env.get_score()}')
-          torch.save(Q_online.state_dict(), SAVE_PATH)
-        plot_scores()
-        break
+  # every finished game is logged and reported every 10 games. The online Q network is exported and a full
+  # training checkpoint is taken at the same time, both written in the background
+  metrics = MetricsWriter(METRICS_PATH)
+
+  # the episodes logged after the checkpoint are played again, so their records are dropped
+  if metrics_records is not None:
+    metrics.truncate(metrics_records)
+
+  def on_episodes_done(trainer, n_finished):
+    save = False
+    for i_episode in range(len(trainer.episode_scores) - n_finished, len(trainer.episode_scores)):
+      metrics.write(episode=i_episode, score=float(trainer.episode_scores[i_episode]),
+                    max_tile=float(trainer.episode_max_tiles[i_episode]), num_steps=trainer.steps_done)
+      if i_episode % 10 == 0:
+        print(f'Episode {i_episode} finished with score {trainer.episode_scores[i_episode]}, '
+              f'target update {trainer.target_updater.stats()["us_per_update"]:.1f} us')
+        save = True
+
+    # the checkpoint is taken after every record of the step's episodes, with the number of records it covers,
+    # which are flushed so the log holds all of them
+    if save:
+      checkpoints.write(trainer.Q_online.state_dict(), SAVE_PATH)
+      state = trainer.state_dict()
+      state['metrics_records'] = metrics.num_records
+      checkpoints.save(state, trainer.steps_done)
+      metrics.flush()
 
+  # run the training loop
+  trainer.train(num_episodes - len(trainer.episode_scores), callback=on_episodes_done)
+  metrics.close()
+  checkpoints.close()
 
   print('Complete')
-  plot_scores(show_results=True)
-  plt.ioff()
+  plot_scores()
   plt.show()
 else:
-  pass
\ No newline at end of file
+  pass
@@ -0,0 +1,279 @@
+import random
+import time
+
+import numpy as np
+
+from .board import TILE_VALUES
+
+ROW_MASK = 0xFFFF
+MAX_EXPONENT = 15
+
+# keyboard keys accepted by move(), as typed in terminal.py
+KEY_ACTIONS = {'W': 0, 'S': 1, 'A': 2, 'D': 3}
+
+
+def _row_to_exps(row):
+    '''unpacks a 16-bit row into its four 4-bit exponents (nibble 0 is column 0)'''
+    return [(row >> (4 * c)) & 0xF for c in range(4)]
+
+
+def _exps_to_row(exps):
+    '''packs four exponents back into a 16-bit row'''
+    row = 0
+    for c, e in enumerate(exps):
+        row |= e << (4 * c)
+    return row
+
+
+def _merge_left(exps):
+    '''
+    slides and merges one row towards column 0, returns (new exponents, score gained).
+    follows Board: a merged tile can merge again with the next tile, so [2, 2, 4] gives [8].
+    a merge that would pass MAX_EXPONENT is refused, since the exponent would not fit in its nibble.
+    '''
+    merged, score = [], 0
+    for e in exps:
+        if e == 0:
+            continue
+        if merged and merged[-1] == e and e < MAX_EXPONENT:
+            merged[-1] += 1
+            score += 2 ** merged[-1]
+        else:
+            merged.append(e)
+    return merged + [0] * (4 - len(merged)), score
+
+
+def _unpack_col(row):
+    '''spreads a 16-bit row into a 64-bit column (nibble k goes to row k of column 0)'''
+    col = 0
+    for k in range(4):
+        col |= ((row >> (4 * k)) & 0xF) << (16 * k)
+    return col
+
+
+def _build_tables():
+    '''
+    precomputes the result of every possible move on every possible 16-bit row.
+    moves are stored as xor deltas so that applying a move is a lookup and an xor.
+    '''
+    row_left, row_right = [0] * 65536, [0] * 65536
+    col_up, col_down = [0] * 65536, [0] * 65536
+    score_left, score_right = [0] * 65536, [0] * 65536
+
+    for row in range(65536):
+        exps = _row_to_exps(row)
+
+        left, left_score = _merge_left(exps)
+        right, right_score = _merge_left(exps[::-1])
+        right = right[::-1]
+
+        left_row, right_row = _exps_to_row(left), _exps_to_row(right)
+        row_left[row] = row ^ left_row
+        row_right[row] = row ^ right_row
+        col_up[row] = _unpack_col(row) ^ _unpack_col(left_row)
+        col_down[row] = _unpack_col(row) ^ _unpack_col(right_row)
+        score_left[row] = left_score
+        score_right[row] = right_score
+
+    return row_left, row_right, col_up, col_down, score_left, score_right
+
+
+ROW_LEFT, ROW_RIGHT, COL_UP, COL_DOWN, SCORE_LEFT, SCORE_RIGHT = _build_tables()
+
+
+def transpose(board):
+    '''transposes a packed 4x4 board of nibbles'''
+    a1 = board & 0xF0F00F0FF0F00F0F
+    a2 = board & 0x0000F0F00000F0F0
+    a3 = board & 0x0F0F00000F0F0000
+    a = a1 | (a2 << 12) | (a3 >> 12)
+    b1 = a & 0xFF00FF0000FF00FF
+    b2 = a & 0x00FF00FF00000000
+    b3 = a & 0x00000000FF00FF00
+    return b1 | (b2 >> 24) | (b3 << 24)
+
+
+def empty_mask(board):
+    '''returns a mask with the lowest bit of every empty nibble set'''
+    x = board | (board >> 1)
+    x |= x >> 2
+    return ~x & 0x1111111111111111
+
+
+def pack_exps(exps):
+    '''packs a 4x4 (or 16) array of exponents into a single 64-bit int'''
+    exps = np.asarray(exps, dtype=np.uint8).reshape(16)
+    return int.from_bytes((exps[0::2] | (exps[1::2] << 4)).tobytes(), 'little')
+
+
+def unpack_exps(board):
+    '''unpacks a 64-bit board into a 4x4 uint8 array of exponents'''
+    raw = np.frombuffer(board.to_bytes(8, 'little'), dtype=np.uint8)
+    exps = np.empty(16, dtype=np.uint8)
+    exps[0::2] = raw & 0xF
+    exps[1::2] = raw >> 4
+    return exps.reshape(4, 4)
+
+
+class BitBoard():
+    '''
+    2048 game engine that stores the whole board in one 64-bit int of 4-bit log2 exponents.
+    Moves are resolved with the precomputed row/column tables above instead of numpy loops.
+    Exposes the same interface and merge rules as Board, except that tiles are capped at 2**15: two 2**15
+    tiles do not merge, where Board would make a 2**16.
+    Like Board, get_state returns the 4x4 log2 exponents, get_tiles returns the tile values.
+    '''
+
+    def __init__(self):
+        self.init_board()
+        self.score = 0
+        self.max_number = 0
+        self.last_move = None
+        self.terminal = False
+
+    def init_board(self, rows=4, cols=4):
+        '''initializes empty board with two random tiles'''
+        self.board = 0
+        self.init_tile()
+        self.init_tile()
+
+    def init_tile(self, p=0.9):
+        '''
+        randomly spawns tile of 2 (p=.9) or 4 (p=.1) in free space, or returns if there is no free space.
+        the cell it spawned in (4 * row + col, -1 if none) is kept in last_spawn.
+        '''
+        self.last_spawn = -1
+        empty = empty_mask(self.board)
+        n_empty = empty.bit_count()
+        if n_empty == 0:
+            return
+        # drop the lowest k empty cells, the spawn goes into the next one
+        for _ in range(int(random.random() * n_empty)):
+            empty &= empty - 1
+        shift = (empty & -empty).bit_length() - 1
+        self.board |= (1 if random.random() < p else 2) << shift
+        self.last_spawn = shift // 4
+
+    def set_state(self, state):
+        '''loads a 4x4 array of exponents into the board'''
+        self.board = pack_exps(state)
+
+    def get_state(self):
+        '''returns the current state of the game as a 4x4 uint8 array of log2 exponents'''
+        return unpack_exps(self.board)
+
+    def get_tiles(self):
+        '''returns the tile values of the current state, for display'''
+        return TILE_VALUES[unpack_exps(self.board)]
+
+    def get_spawn_tile_locations(self):
+        '''returns all [i j] in the current state where a new tile can spawn.'''
+        return np.argwhere(unpack_exps(self.board) == 0)
+
+    def get_tilesum(self):
+        '''returns sum of tile values in current game state'''
+        return self.get_tiles().sum()
+
+    def get_max(self):
+        '''returns the max tile value in current game state.'''
+        return TILE_VALUES[unpack_exps(self.board).max()]
+
+    def get_score(self):
+        '''returns the current score of the game'''
+        return self.score
+
+    def get_last_move(self):
+        '''returns the last move made in the game'''
+        return self.last_move
+
+    def legal_actions(self):
+        '''returns a boolean mask over (up, down, left, right) of the moves that change the board'''
+        board, t = self.board, transpose(self.board)
+        rows = [(board >> shift) & ROW_MASK for shift in (0, 16, 32, 48)]
+        cols = [(t >> shift) & ROW_MASK for shift in (0, 16, 32, 48)]
+        return np.array([
+            any(COL_UP[col] for col in cols),
+            any(COL_DOWN[col] for col in cols),
+            any(ROW_LEFT[row] for row in rows),
+            any(ROW_RIGHT[row] for row in rows),
+        ])
+
+    def is_terminal_state(self):
+        '''
+        episode is over if board is full and no tiles can merge.
+        returns 1 if terminal state, 0 otherwise.
+        '''
+        board = self.board
+        if empty_mask(board):
+            return 0
+        # on a full board a row can slide iff two neighbours can merge
+        t = transpose(board)
+        for shift in (0, 16, 32, 48):
+            if ROW_LEFT[(board >> shift) & ROW_MASK] or ROW_LEFT[(t >> shift) & ROW_MASK]:
+                return 0
+        return 1
+
+    def _move_rows(self, deltas, scores):
+        '''applies a left or right move to all four rows'''
+        board = self.board
+        r0, r1 = board & ROW_MASK, (board >> 16) & ROW_MASK
+        r2, r3 = (board >> 32) & ROW_MASK, board >> 48
+        self.board = board ^ (deltas[r0] | (deltas[r1] << 16) | (deltas[r2] << 32) | (deltas[r3] << 48))
+        self.score += scores[r0] + scores[r1] + scores[r2] + scores[r3]
+
+    def _move_cols(self, deltas, scores):
+        '''applies an up or down move to all four columns'''
+        t = transpose(self.board)
+        c0, c1 = t & ROW_MASK, (t >> 16) & ROW_MASK
+        c2, c3 = (t >> 32) & ROW_MASK, t >> 48
+        self.board ^= deltas[c0] | (deltas[c1] << 4) | (deltas[c2] << 8) | (deltas[c3] << 12)
+        self.score += scores[c0] + scores[c1] + scores[c2] + scores[c3]
+
+    def move(self, action):
+        '''move the game up/down/left/right, returns whether the move changed the board'''
+        board = self.board
+        action = KEY_ACTIONS.get(action, action)
+        if action == 0: self._move_cols(COL_UP, SCORE_LEFT)
+        elif action == 1: self._move_cols(COL_DOWN, SCORE_RIGHT)
+        elif action == 2: self._move_rows(ROW_LEFT, SCORE_LEFT)
+        elif action == 3: self._move_rows(ROW_RIGHT, SCORE_RIGHT)
+        self.last_move = action
+        changed = self.board != board
+
+        # spawn a new tile
+        self.init_tile()
+
+        # check to see if the game state is terminal
+        if self.is_terminal_state():
+            self.terminal = True
+        return changed
+
+    def print_game(self):
+        '''prints out the state of the game'''
+        print("------------------------")
+        print(f"Current Game Score: {self.score}")
+        print("------------------------")
+        print(self.get_tiles())
+
+
+def benchmark(engine, seconds=2.0):
+    '''plays random games with the given engine class and returns the number of moves per second'''
+    actions = [random.randrange(4) for _ in range(4096)]
+    game, n_steps, start = engine(), 0, time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for action in actions:
+            game.move(action)
+            if game.terminal:
+                game = engine()
+        n_steps += len(actions)
+    return n_steps / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    # run from models/ with: python -m env.bitboard
+    from .board import Board
+
+    board_speed = benchmark(Board)
+    bitboard_speed = benchmark(BitBoard)
+    print(f"Board:    {board_speed:,.0f} steps/s")
+    print(f"BitBoard: {bitboard_speed:,.0f} steps/s ({bitboard_speed / board_speed:.1f}x)")
@@ -6,6 +6,35 @@ import numpy as np
 import pandas as pd
 
 
+# exponent -> tile value, the board stores log2 exponents and 0 is an empty cell
+TILE_VALUES = np.array([0.0] + [float(2 ** e) for e in range(1, 18)])
+
+
+def legal_moves(state):
+    '''
+    returns a boolean mask over (up, down, left, right) of the moves that change a 4x4 board.
+    the board can hold either tile values or exponents, 0 is an empty cell.
+    '''
+    rows = np.asarray(state).tolist()
+    cols = list(zip(*rows))
+    up = down = left = right = False
+
+    # a move is legal if some tile has an empty or equal neighbour in that direction
+    for line in rows:
+        for a, b in zip(line, line[1:]):
+            if a == b:
+                if a: left = right = True
+            elif a == 0: left = True
+            elif b == 0: right = True
+    for line in cols:
+        for a, b in zip(line, line[1:]):
+            if a == b:
+                if a: up = down = True
+            elif a == 0: up = True
+            elif b == 0: down = True
+    return np.array([up, down, left, right])
+
+
 class Board():
 
     EMPTY_CELL_COLOR = '#9e948a'
@@ -44,18 +73,24 @@ class Board():
 
     def init_board(self, rows=4, cols=4):
         '''initializes board of 0s with two random tiles'''
-        self.state = np.zeros((rows,cols))
+        self.state = np.zeros((rows,cols), dtype=np.uint8)
         self.init_tile()
         self.init_tile() 
+        self.legal = legal_moves(self.state)
 
     def init_tile(self, p=0.9):
-        '''randomly spawns tile of 2 (p=.9) or 4 (p=.1) in free space, or returns if there is no free space'''
+        '''
+        randomly spawns tile of 2 (p=.9) or 4 (p=.1) in free space, or returns if there is no free space.
+        the cell it spawned in (4 * row + col, -1 if none) is kept in last_spawn.
+        '''
+        self.last_spawn = -1
         new_spawn_spots = self.get_spawn_tile_locations()
         if len(new_spawn_spots) == 0:
             return
         new_tile_idx = np.random.choice(new_spawn_spots.shape[0], size=1, replace=False)
         new_row, new_col = new_spawn_spots[new_tile_idx].squeeze()
-        self.state[new_row, new_col] = 2 if np.random.random() < p else 4
+        self.state[new_row, new_col] = 1 if np.random.random() < p else 2
+        self.last_spawn = 4 * int(new_row) + int(new_col)
 
     def get_spawn_tile_locations(self):
         '''returns all [i j] in the current state where a new tile can spawn.'''
@@ -63,15 +98,19 @@ class Board():
 
     def get_tilesum(self):
         '''returns sum of tile values in current game state'''
-        return self.state.sum() 
+        return self.get_tiles().sum() 
 
     def get_max(self):
         '''returns the max tile value in current game state.'''
-        return np.max(self.state)
+        return TILE_VALUES[np.max(self.state)]
     
     def get_state(self):
-        '''returns the current state of the game'''
+        '''returns the current state of the game as a 4x4 uint8 array of log2 exponents'''
         return self.state
+
+    def get_tiles(self):
+        '''returns the tile values of the current state, for display'''
+        return TILE_VALUES[self.state]
     
     def get_score(self):
         '''returns the current score of the game'''
@@ -81,34 +120,28 @@ class Board():
         '''returns the last move made in the game'''
         return self.last_move
 
+    def legal_actions(self):
+        '''returns the cached boolean mask over (up, down, left, right) of the moves that change the board'''
+        return self.legal
+
     def is_terminal_state(self):
         '''
-        episode is over is board is full.
+        episode is over if no move can change the board.
         returns 1 if terminal state, 0 otherwise. 
         '''
-        
-        if len(self.get_spawn_tile_locations()) > 0:
-            return 0
-        # Check if any combinations can be made if the board is full
-        for i in range(3):
-            for j in range(3):
-                if (self.state[i][j] == self.state[i+1][j] or self.state[i][j] == self.state[i][j+1]):
-                    return 0
-        for i in range(3):
-            if (self.state[i][3] == self.state[i+1][3]):
-                return 0
-        for j in range(3):
-            if (self.state[3][j] == self.state[3][j+1]):
-                return 0
-        return 1
+        return 0 if self.legal.any() else 1
 
     def _move_up(self):
-        '''Shifts and merges all tiles in the up direction.'''
+        '''
+        Shifts and merges all tiles in the up direction.
+        A merged tile can merge again with the next tile in the same move, so [2, 2, 4] moves up to [8]
+        (+4 and +8). BitBoard and VecBoard follow the same rule.
+        '''
 
         # Loop over each column of the game board
         for col in range(self.state.shape[1]):
             col_arr = self.state[:, col]
-            new_col_arr = np.zeros(col_arr.shape[0])
+            new_col_arr = np.zeros(col_arr.shape[0], dtype=np.uint8)
             new_col_arr_idx = 0
 
             # Loop over each element in the column
@@ -119,11 +152,11 @@ class Board():
                     # If the current element is non-zero
                     if new_col_arr[new_col_arr_idx - 1] == col_arr[row] and new_col_arr_idx > 0:
 
-                        # If it can be merged with the previous element, double the value of the previous element
-                        new_col_arr[new_col_arr_idx - 1] *= 2
+                        # If it can be merged with the previous element, double the previous tile by bumping its exponent
+                        new_col_arr[new_col_arr_idx - 1] += 1
 
                         # Update the score after the merge
-                        self.score += new_col_arr[new_col_arr_idx - 1]
+                        self.score += TILE_VALUES[new_col_arr[new_col_arr_idx - 1]]
 
                     else:
 
@@ -158,27 +191,29 @@ class Board():
         self.last_move = 3
 
     def move(self, action):
-        '''move the game up/down/left/right'''
+        '''move the game up/down/left/right, returns whether the move changed the board'''
         # move the board up/down/left/right
-        if action == 'W' or action == 0: self._move_up() 
-        elif action =='S' or action == 1: self._move_down() 
-        elif action == 'A' or action == 2: self._move_left()
-        elif action == 'D' or action == 3: self._move_right()
+        changed = False
+        if action == 'W' or action == 0: changed = self.legal[0]; self._move_up() 
+        elif action =='S' or action == 1: changed = self.legal[1]; self._move_down() 
+        elif action == 'A' or action == 2: changed = self.legal[2]; self._move_left()
+        elif action == 'D' or action == 3: changed = self.legal[3]; self._move_right()
 
-        # spawn a new tile 
+        # spawn a new tile and update the legal moves of the new board
         self.init_tile() 
+        self.legal = legal_moves(self.state)
 
         # check to see if the game state is terminal
         if self.is_terminal_state():
             self.terminal = True 
-            return self.score, self.get_max(), self.get_tilesum()
+        return bool(changed)
 
     def print_game(self):
         '''prints out the state of the game'''
         print("------------------------")
         print(f"Current Game Score: {self.score}")
         print("------------------------")
-        print(self.state)
+        print(self.get_tiles())
 
     def visualize_board(self):
         """
@@ -200,7 +235,8 @@ class Board():
         ax.axis('off')
 
         # Create a Pandas DataFrame from the game state
-        df = pd.DataFrame(self.state, columns=['0', '1', '2', '3'])
+        tiles = self.get_tiles()
+        df = pd.DataFrame(tiles, columns=['0', '1', '2', '3'])
 
         # Create a table from the DataFrame and add it to the axis
         table = ax.table(cellText=df.values, loc='center', cellLoc='center')
@@ -211,7 +247,7 @@ class Board():
         # Set the color of each cell according to its value
         for i in range(4):
             for j in range(4):
-                data = self.state[i][j]
+                data = tiles[i][j]
                 self.max_number = max(data, self.max_number)
                 color = self.CELL_BACKGROUND_COLOR_DICT[data]
                 table[(i, j)].set_facecolor(color)
@@ -245,7 +281,8 @@ class Board():
         ax.axis('off')
 
         # Create a Pandas DataFrame from the game state
-        df = pd.DataFrame(self.state, columns=['0', '1', '2', '3'])
+        tiles = self.get_tiles()
+        df = pd.DataFrame(tiles, columns=['0', '1', '2', '3'])
 
         # Create a table from the DataFrame and add it to the axis
         table = ax.table(cellText=df.values, loc='center', cellLoc='center')
@@ -256,7 +293,7 @@ class Board():
         # Set the color of each cell according to its value
         for i in range(4):
             for j in range(4):
-                data = self.state[i][j]
+                data = tiles[i][j]
                 self.max_number = max(data, self.max_number)
                 color = self.CELL_BACKGROUND_COLOR_DICT[data]
                 table[(i, j)].set_facecolor(color)
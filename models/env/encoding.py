@@ -0,0 +1,70 @@
+import numpy as np
+import torch
+
+NUM_CELLS = 16
+NUM_EXPONENTS = 18
+OBS_SIZE = NUM_CELLS * NUM_EXPONENTS
+
+_EXPONENTS = np.arange(NUM_EXPONENTS, dtype=np.uint8)
+
+
+def _batch_shape(exps):
+    '''returns the leading batch dimensions of a (..., 4, 4) or (..., 16) exponent array'''
+    if exps.shape[-2:] == (4, 4):
+        return exps.shape[:-2]
+    return exps.shape[:-1]
+
+
+def one_hot(exps, out=None):
+    '''
+    One-hot encodes board exponents into the 288-dim observation used by both agents.
+
+    Parameters
+    ----------
+    exps : np.ndarray
+      Exponents of one board (4x4 or 16) or of a batch of boards (N,4,4 or N,16)
+    out : np.ndarray
+      Optional contiguous float array of shape (288,) or (N,288) that is overwritten in place,
+      so encoding into a preallocated buffer allocates nothing
+
+    Returns
+    -------
+    np.ndarray
+      The observation(s), `out` if it was given
+    '''
+    exps = np.asarray(exps)
+    batch = _batch_shape(exps)
+    if out is None:
+        out = np.empty(batch + (OBS_SIZE,), dtype=np.float32)
+
+    # cell i holds exponent e  <=>  entry 18*i + e is 1, written with one broadcast comparison
+    np.equal(exps.reshape(batch + (NUM_CELLS, 1)), _EXPONENTS,
+             out=out.reshape(batch + (NUM_CELLS, NUM_EXPONENTS)), casting='unsafe')
+    return out
+
+
+def one_hot_torch(exps, out=None, device='cpu'):
+    '''
+    Torch version of one_hot, returns a float32 tensor of shape (288,) or (N,288).
+
+    Parameters
+    ----------
+    exps : np.ndarray or tensor
+      Exponents of one board or of a batch of boards
+    out : tensor
+      Optional contiguous float tensor that is overwritten in place
+    device : str
+      Device of the returned tensor when `out` is not given
+    '''
+    batch = _batch_shape(exps)
+    if out is None:
+        out = torch.empty(batch + (OBS_SIZE,), dtype=torch.float32, device=device)
+
+    # cpu tensors share memory with numpy, so the numpy encoder writes straight into them
+    if out.device.type == 'cpu' and isinstance(exps, np.ndarray):
+        one_hot(exps, out=out.numpy())
+        return out
+
+    exps = torch.as_tensor(exps, device=out.device).reshape(batch + (NUM_CELLS, 1))
+    out.view(batch + (NUM_CELLS, NUM_EXPONENTS)).zero_().scatter_(-1, exps.long(), 1.0)
+    return out
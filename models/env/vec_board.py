@@ -0,0 +1,156 @@
+import numpy as np
+
+from .bitboard import ROW_LEFT, SCORE_LEFT
+from .board import TILE_VALUES
+
+
+def _build_left_tables():
+    '''turns the bitboard row tables into numpy tables indexed by a packed 16-bit row'''
+    rows = np.arange(65536)
+    results = rows ^ np.array(ROW_LEFT)
+    shifts = 4 * np.arange(4)
+    left_exps = ((results[:, None] >> shifts) & 0xF).astype(np.uint8)
+    left_score = np.array(SCORE_LEFT, dtype=np.int64)
+    left_legal = results != rows
+    return left_exps, left_score, left_legal
+
+
+LEFT_EXPS, LEFT_SCORE, LEFT_LEGAL = _build_left_tables()
+
+# weights that pack four exponents into the 16-bit table index
+ROW_WEIGHTS = np.array([1, 16, 256, 4096])
+
+# for every action, the flat cell indices that rotate the board so the move becomes a left move
+_CELLS = np.arange(16).reshape(4, 4)
+PERMUTATIONS = np.stack([
+    _CELLS.T.reshape(-1),               # 0 : up
+    _CELLS[::-1].T.reshape(-1),         # 1 : down
+    _CELLS.reshape(-1),                 # 2 : left
+    _CELLS[:, ::-1].reshape(-1),        # 3 : right
+])
+
+
+def legal_moves_batch(states):
+    '''
+    returns an (N,4) boolean mask over (up, down, left, right) of the moves that change each of
+    the (N,4,4) or (N,16) boards of exponents, the batched version of board.legal_moves.
+    '''
+    flat = np.asarray(states).reshape(-1, 16)
+    rows = flat[:, PERMUTATIONS].reshape(len(flat), 4, 4, 4).astype(np.int64) @ ROW_WEIGHTS
+    return LEFT_LEGAL[rows].any(axis=2)
+
+
+class VecBoard():
+    '''
+    N games of 2048 stored as one (N,4,4) uint8 array of log2 exponents.
+    A single move call shifts, merges, spawns and checks termination for every game
+    with vectorized table lookups, so there is no python loop over games.
+    '''
+
+    def __init__(self, num_games, auto_reset=False, seed=None):
+        '''
+        Parameters
+        ----------
+        num_games : int
+          Number of games played side by side
+        auto_reset : bool
+          Default False, if True finished games are restarted inside move
+        seed : int
+          Optional seed of the random generator used for tile spawns
+        '''
+        self.num_games = num_games
+        self.auto_reset = auto_reset
+        self.rng = np.random.default_rng(seed)
+        self._games = np.arange(num_games)
+
+        self.state = np.zeros((num_games, 4, 4), dtype=np.uint8)
+        self.score = np.zeros(num_games, dtype=np.int64)
+        self.n_steps = np.zeros(num_games, dtype=np.int64)
+        self.terminal = np.zeros(num_games, dtype=bool)
+
+        # score and max tile of the games that finished during the last move (only set with auto_reset)
+        self.final_scores = np.zeros(num_games, dtype=np.int64)
+        self.final_max = np.zeros(num_games)
+
+        self.reset()
+
+    def reset(self, mask=None):
+        '''restarts the games selected by the boolean mask (all games by default) with two random tiles'''
+        if mask is None:
+            mask = np.ones(self.num_games, dtype=bool)
+        self.state[mask] = 0
+        self.score[mask] = 0
+        self.n_steps[mask] = 0
+        self.terminal[mask] = False
+        self.init_tiles(mask)
+        self.init_tiles(mask)
+
+    def init_tiles(self, mask=None, p=0.9):
+        '''spawns a 2 (p=.9) or 4 (p=.1) in a random free cell of every selected game that has one'''
+        flat = self.state.reshape(self.num_games, 16)
+        empty = flat == 0
+        n_empty = empty.sum(axis=1)
+        spawn = n_empty > 0 if mask is None else mask & (n_empty > 0)
+
+        # the k-th empty cell is the number of cells whose running empty count is still <= k
+        k = (self.rng.random(self.num_games) * n_empty).astype(np.int64)
+        cells = (np.cumsum(empty, axis=1) <= k[:, None]).sum(axis=1)
+        exps = np.where(self.rng.random(self.num_games) < p, 1, 2).astype(np.uint8)
+        flat[self._games[spawn], cells[spawn]] = exps[spawn]
+
+    def legal_actions(self):
+        '''returns an (N,4) boolean mask of the moves that change each board'''
+        return legal_moves_batch(self.state)
+
+    def move(self, actions):
+        '''
+        Applies one action per game (0 : up, 1 : down, 2 : left, 3 : right).
+
+        Returns
+        -------
+        (np.ndarray, np.ndarray)
+          Score gained by every game and whether every game is now terminal
+        '''
+        actions = np.asarray(actions)
+        flat = self.state.reshape(self.num_games, 16)
+        games = self._games[:, None]
+
+        # rotate every board so its move is a left move, then look every row up at once
+        cells = PERMUTATIONS[actions]
+        rows = flat[games, cells].reshape(self.num_games, 4, 4).astype(np.int64) @ ROW_WEIGHTS
+        flat[games, cells] = LEFT_EXPS[rows].reshape(self.num_games, 16)
+        gains = LEFT_SCORE[rows].sum(axis=1)
+        self.score += gains
+        self.n_steps += 1
+
+        # spawn a new tile in every game, then check which games are over
+        self.init_tiles()
+        self.terminal = ~self.legal_actions().any(axis=1)
+        dones = self.terminal.copy()
+
+        if self.auto_reset and dones.any():
+            self.final_scores[dones] = self.score[dones]
+            self.final_max[dones] = self.get_max()[dones]
+            self.reset(dones)
+
+        return gains, dones
+
+    def get_state(self):
+        '''returns the state of every game as an (N,4,4) uint8 array of log2 exponents'''
+        return self.state
+
+    def get_tiles(self):
+        '''returns the tile values of every game as an (N,4,4) array, for display'''
+        return TILE_VALUES[self.state]
+
+    def get_score(self):
+        '''returns the current score of every game'''
+        return self.score
+
+    def get_max(self):
+        '''returns the max tile value of every game'''
+        return TILE_VALUES[self.state.reshape(self.num_games, 16).max(axis=1)]
+
+    def is_terminal_state(self):
+        '''returns 1 for every game with no legal move left, 0 otherwise'''
+        return (~self.legal_actions().any(axis=1)).astype(int)
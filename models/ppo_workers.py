@@ -0,0 +1,145 @@
+# standard imports
+import copy
+import queue
+import traceback
+import numpy as np
+
+# pytorch deep learning framework
+import torch
+import torch.multiprocessing as mp
+
+# internal modules
+from ppo_wrapper import EnvironmentWrapper
+from train_ppo_base import DEVICE, PPO_Buffer, RolloutStorage
+
+def rollout_worker(worker_id, shared_model, storage, tasks, results, envs_per_worker, max_steps, seed, precision='fp32'):
+    """
+    Worker process loop. Owns envs_per_worker EnvironmentWrapper instances and, for every task it receives,
+    collects one batched rollout per environment with the shared-memory policy into its shared-memory storage.
+    Only the number of steps and the average reward are sent back.
+
+    Args:
+    - worker_id (int): index of the worker, sent back with its results
+    - shared_model (ActorCritic): the policy in shared memory, updated in place by the learner
+    - storage (RolloutStorage): shared-memory storage the worker fills
+    - tasks (Queue): receives True to collect rollouts and None to stop
+    - results (Queue): receives (worker_id, number of steps, average reward) after every collection, or
+      (worker_id, None, traceback) if the worker failed
+    - envs_per_worker (int): the number of environments the worker plays
+    - max_steps (int): the maximum number of steps per rollout
+    - seed (int): the seed of the worker's tile spawns and action sampling
+    - precision (str): the compute precision of the worker's forward passes, 'fp32' or 'bf16' (default: 'fp32')
+    """
+    torch.set_num_threads(1)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    try:
+        envs = [EnvironmentWrapper() for _ in range(envs_per_worker)]
+        buffer = PPO_Buffer(precision)
+
+        # the shared policy and the worker's storage live on the CPU, whatever the learner's device
+        while tasks.get() is not None:
+            storage, reward = buffer.generate_batched_rollouts(shared_model, envs, max_steps=max_steps, storage=storage,
+                                                               device='cpu')
+            results.put((worker_id, storage.size, reward))
+    except Exception:
+        # the learner waits for a result from every worker, so a failure is reported instead of lost
+        results.put((worker_id, None, traceback.format_exc()))
+
+class RolloutWorkerPool():
+    """
+    Pool of worker processes that collect PPO rollouts in parallel for train_ppo.
+
+    The policy is kept in shared memory and workers run CPU inference on it directly. The learner publishes
+    its weights before each collection, so workers never read weights while they are being written. Every
+    worker fills its own shared-memory RolloutStorage, and only step counts and rewards go through the queues.
+
+    Methods:
+    - publish(model): copies the learner's weights into the shared policy
+    - collect() -> (RolloutStorage, float): runs one collection on all workers and gathers their steps
+    - close(): stops the workers
+    """
+    def __init__(self, model, num_workers=4, envs_per_worker=4, max_steps=1000, device=DEVICE, seed=0, precision='fp32'):
+        """
+        Args:
+        - model (ActorCritic): the learner's model, a CPU copy of it is placed in shared memory
+        - num_workers (int): the number of worker processes (default: 4)
+        - envs_per_worker (int): the number of environments, i.e. rollouts per collection, of every worker (default: 4)
+        - max_steps (int): the maximum number of steps per rollout (default: 1000)
+        - device (str): the device of the gathered storage the learner trains on
+        - seed (int): base seed of the workers (default: 0)
+        - precision (str): the compute precision of the workers' forward passes, 'fp32' or 'bf16' (default: 'fp32')
+        """
+        ctx = mp.get_context('spawn')
+        sparse_input = getattr(model, 'sparse_input', False)
+        self.shared_model = copy.deepcopy(model).cpu().share_memory()
+        self.shared_tensors = list(self.shared_model.state_dict().values())
+
+        capacity = envs_per_worker * max_steps
+        self.storages = [RolloutStorage(capacity, device='cpu', sparse_input=sparse_input).share_memory_() for _ in range(num_workers)]
+        self.storage = RolloutStorage(num_workers * capacity, device=device, sparse_input=sparse_input)
+
+        self.tasks = [ctx.Queue() for _ in range(num_workers)]
+        self.results = ctx.Queue()
+        self.workers = [ctx.Process(target=rollout_worker, daemon=True,
+                                    args=(i, self.shared_model, self.storages[i], self.tasks[i], self.results,
+                                          envs_per_worker, max_steps, seed + i, precision))
+                        for i in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def publish(self, model):
+        # Copy the learner's current weights into the shared policy in place
+        with torch.no_grad():
+            torch._foreach_copy_(self.shared_tensors, [t.detach().cpu() for t in model.state_dict().values()])
+
+    def collect(self):
+        """
+        Runs one collection on every worker and gathers their steps into one storage.
+
+        Returns:
+        - storage (RolloutStorage): the gathered steps with returns and advantages
+        - reward (float): the average cumulative reward per rollout
+
+        Raises:
+        - RuntimeError: if a worker fails or dies, with the worker's traceback. All workers are stopped
+        """
+        for task in self.tasks:
+            task.put(True)
+
+        sizes, rewards = {}, {}
+        while len(sizes) < len(self.workers):
+            try:
+                worker_id, size, reward = self.results.get(timeout=1.0)
+            except queue.Empty:
+                # a worker killed without raising (e.g. out of memory) never reports, so check on the processes
+                for worker_id, worker in enumerate(self.workers):
+                    if worker_id not in sizes and not worker.is_alive():
+                        self._stop_workers()
+                        raise RuntimeError(f"rollout worker {worker_id} exited with code {worker.exitcode}")
+                continue
+            if size is None:
+                self._stop_workers()
+                raise RuntimeError(f"rollout worker {worker_id} failed:\n{reward}")
+            sizes[worker_id], rewards[worker_id] = size, reward
+
+        # The worker's size lives in its own process, so it is set from the result before copying
+        self.storage.reset()
+        for worker_id, worker_storage in enumerate(self.storages):
+            worker_storage.size = sizes[worker_id]
+            self.storage.append(worker_storage)
+        return self.storage, float(np.mean([rewards[i] for i in range(len(self.workers))]))
+
+    def _stop_workers(self):
+        # The remaining workers are stopped, since the collection they are part of is abandoned
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+    def close(self):
+        # Stop and join all workers
+        for task in self.tasks:
+            task.put(None)
+        for worker in self.workers:
+            worker.join()
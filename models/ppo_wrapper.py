@@ -1,7 +1,6 @@
 import numpy as np 
 from env.board import Board
-
-from env.board import Board
+from env.encoding import OBS_SIZE, one_hot
 
 class EnvironmentWrapper():
 
@@ -17,15 +16,18 @@ class EnvironmentWrapper():
         - num_steps_max_tile_did_not_change (int): the number of steps the maximum tile value did not change
         """
         self.board = Board()
-        self.observation_space_len = self.board.state.flatten().shape[0] * 18 
+        self.observation_space_len = OBS_SIZE
         self.action_space_len = 4
         self.prev_max_tile = 2
         self.num_steps_max_tile_did_not_change = 1
 
-    def reset(self):
+    def reset(self, out=None):
         """
         Resets the game board and environment variables.
 
+        Args:
+        - out (numpy.ndarray): optional preallocated (288,) buffer the state is written into
+
         Returns:
         - state (numpy.ndarray): the flattened state of the game board
         """
@@ -33,17 +35,16 @@ class EnvironmentWrapper():
         self.board.init_board()
         self.prev_max_tile = 2
         self.num_steps_max_tile_did_not_change = 1
-        state = np.log2(self.board.state, out=np.zeros_like(self.board.state), where=(self.board.state != 0)).reshape(-1).astype(int)
-        state = np.eye(18)[state].flatten()
-        return state
+        return one_hot(self.board.state, out=out)
     
-    def step(self, action, r1 = True):
+    def step(self, action, r1 = True, out=None):
         """
         Performs one step of the game.
 
         Args:
         - action (int): the action to be taken
         - r1 (bool): flag for whether to use reward function 1
+        - out (numpy.ndarray): optional preallocated (288,) buffer the next state is written into
 
         Returns:
         - next_state (numpy.ndarray): the flattened state of the game board after the step
@@ -68,7 +69,7 @@ class EnvironmentWrapper():
             Returns:
             - reward (float): the reward obtained from reward function 1
             """
-            getHigherTiles = np.log2(self.board.max_number)
+            getHigherTiles = float(self.board.state.max())
             moreQuickly = 1 / self.num_steps_max_tile_did_not_change
             withBigScoreGain = self.board.score - current_score
             return (getHigherTiles**(moreQuickly)) * withBigScoreGain
@@ -107,8 +108,7 @@ class EnvironmentWrapper():
             reward = reward_final()
 
         # Get the next state
-        next_state = np.log2(self.board.state, out=np.zeros_like(self.board.state), where=(self.board.state != 0)).reshape(-1).astype(int)
-        next_state = np.eye(18)[next_state].flatten()
+        next_state = one_hot(self.board.state, out=out)
 
         # Get the done flag
         done = self.board.terminal
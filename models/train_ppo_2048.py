@@ -5,24 +5,23 @@ import torch.nn as nn
 # plotting / utility modules 
 import numpy as np 
 import matplotlib.pyplot as plt
-import json
 
 # internal modules 
 from ppo_wrapper import EnvironmentWrapper
 from train_ppo_base import * 
+from ppo_workers import RolloutWorkerPool
 
-def plot_2048_training(stats_file='ppo_2048_stats.json', w_size=20, dpi=300):
+def plot_2048_training(stats_file='ppo_2048_stats.jsonl', w_size=20, dpi=300):
     """
     Generates a line plot of the average reward over the number of steps taken during training.
 
     Args:
-    - stats_file (str): the path to the JSON file containing the training statistics (default: 'ppo_2048_stats.json')
+    - stats_file (str): the path to the metrics log containing the training statistics, legacy .json files are read too (default: 'ppo_2048_stats.jsonl')
     - w_size (int): the size of the rolling window used for smoothing the plot (default: 20)
     - dpi (int): the resolution of the saved image file (default: 300)
     """
     # Load the training statistics from the specified file
-    with open(stats_file, "r") as f:
-        stats = json.load(f)
+    stats = read_metrics(stats_file)
 
     # Smooth the data using a rolling average with the specified window size
     window_size = w_size 
@@ -49,18 +48,33 @@ if __name__ == "__main__":
     PPO_CLIP_VAL = 0.20
     PPO_POLICY_LR = 1e-5
     PPO_VALUE_LR = 1e-4
+    KL_TARGET = 0.02
+
+    # update mode: None keeps the separate policy and value updates below (PPO_EPOCHS / VAL_EPOCHS full-batch
+    # epochs with two optimizers), a number such as 8 switches to the fused minibatch update instead, with one
+    # optimizer and UPDATE_EPOCHS passes over NUM_MINIBATCHES minibatches
+    NUM_MINIBATCHES = None
     PPO_EPOCHS = 60
     VAL_EPOCHS = 60
-    KL_TARGET = 0.02
+    UPDATE_EPOCHS = 4
+
+    # weight of the entropy bonus of the fused update, 0 leaves the objective unchanged (e.g. 0.01 to turn it on)
+    ENTROPY_COEF = 0.0
     N_EPISODES = 20000
     PRINT_FREQ = 1
     NUM_ROLLOUTS = 16
     SAVE_FREQ = 50
+    # rollout worker processes, 1 collects in this process (parallel scaling has not been benchmarked yet)
+    NUM_WORKERS = 1
+
+    # compute precision of the forward passes, 'bf16' runs them under CPU bfloat16 autocast with float32 weights
+    PRECISION = 'fp32'
 
     ###  TRAINS MODEL USING PROXIMAL POLICY OPTIMIZATION FOR 2048 ###
 
-    # set up environment
-    env = EnvironmentWrapper() 
+    # set up environments, one per rollout so the rollouts are collected in one batch
+    envs = [EnvironmentWrapper() for _ in range(NUM_ROLLOUTS)]
+    env = envs[0]
 
     # set up model
     model = ActorCritic(
@@ -82,14 +96,31 @@ if __name__ == "__main__":
         val_lr = PPO_VALUE_LR,
         ppo_epochs = PPO_EPOCHS, 
         val_epochs = VAL_EPOCHS,
-        kl_earlystopping = KL_TARGET
+        kl_earlystopping = KL_TARGET,
+        num_minibatches = NUM_MINIBATCHES,
+        update_epochs = UPDATE_EPOCHS,
+        entropy_coef = ENTROPY_COEF,
+        precision = PRECISION
     )
 
-    # set up buffer
-    ppobuffer = PPO_Buffer() 
+    # set up buffer and the preallocated storage the rollouts are written into
+    ppobuffer = PPO_Buffer(precision=PRECISION)
+    storage = RolloutStorage(NUM_ROLLOUTS * 1000, device=DEVICE)
+
+    # with several workers the rollouts are collected in parallel worker processes instead,
+    # every worker plays the same number of rollouts
+    if NUM_WORKERS > 1:
+        if NUM_ROLLOUTS % NUM_WORKERS:
+            raise ValueError(f"NUM_ROLLOUTS ({NUM_ROLLOUTS}) must be a multiple of NUM_WORKERS ({NUM_WORKERS})")
+        envs = RolloutWorkerPool(model, num_workers=NUM_WORKERS, envs_per_worker=NUM_ROLLOUTS // NUM_WORKERS, device=DEVICE,
+                                 precision=PRECISION)
     
-    # train the model with PPO
-    train_ppo(env=env, model=model, ppo_trainer=ppo, ppo_buffer = ppobuffer,n_episodes=N_EPISODES, num_rollouts=NUM_ROLLOUTS, print_freq=PRINT_FREQ, save_freq=SAVE_FREQ, save_model=True, model_path="ppo_2048_model_rewardfinal15", stats_path ="ppo_2048_stats_rewardfinal15.json", load_from_checkpoint=True)
+    # train the model with PPO, and stop the worker processes however training ends
+    try:
+        train_ppo(env=envs, model=model, ppo_trainer=ppo, ppo_buffer = ppobuffer,n_episodes=N_EPISODES, num_rollouts=NUM_ROLLOUTS, print_freq=PRINT_FREQ, save_freq=SAVE_FREQ, save_model=True, model_path="ppo_2048_model_rewardfinal15", stats_path ="ppo_2048_stats_rewardfinal15.jsonl", load_from_checkpoint=True, storage=storage)
+    finally:
+        if isinstance(envs, RolloutWorkerPool):
+            envs.close()
     
 
 
@@ -9,9 +9,31 @@ import torch.optim as optim
 from torch.distributions.categorical import Categorical 
 
 # logging imports 
-import json
+import os
 import matplotlib.pyplot as plt
 
+# internal modules, importable both from the repo root and from inside models/
+try:
+    from .env.board import legal_moves
+    from .env.vec_board import legal_moves_batch
+    from .env.encoding import OBS_SIZE, one_hot, one_hot_torch
+    from .utils.advantages import compute_gae, discounted_cumsum
+    from .utils.checkpoint import CheckpointManager, rng_state, set_rng_state
+    from .utils.inference import InferenceRuntime
+    from .utils.layers import ExponentEmbedding, convert_dense_state_dict
+    from .utils.metrics import MetricsWriter, read_metrics, rotate_metrics
+    from .utils.precision import autocast, check_precision
+except ImportError:
+    from env.board import legal_moves
+    from env.vec_board import legal_moves_batch
+    from env.encoding import OBS_SIZE, one_hot, one_hot_torch
+    from utils.advantages import compute_gae, discounted_cumsum
+    from utils.checkpoint import CheckpointManager, rng_state, set_rng_state
+    from utils.inference import InferenceRuntime
+    from utils.layers import ExponentEmbedding, convert_dense_state_dict
+    from utils.metrics import MetricsWriter, read_metrics, rotate_metrics
+    from utils.precision import autocast, check_precision
+
 # Hyperparameters for model
 SHARED_HIDDEN_LAYER_SIZE= 64
 NUM_SHARED_LAYERS = 1
@@ -39,6 +61,7 @@ class ActorCritic(nn.Module):
         hidden_layer_size=128,
         num_shared_layers=2,
         activation_function=nn.Tanh(),
+        sparse_input=False,
     ):
         super().__init__()
         
@@ -47,12 +70,18 @@ class ActorCritic(nn.Module):
         self.num_shared_layers = num_shared_layers
         self.activation_function = activation_function
 
+        # With sparse_input the network takes the 16 board exponents instead of the one-hot vector
+        self.sparse_input = sparse_input
+
         # Create shared layers
         shared_layers = []
         for i in range(num_shared_layers):
             in_size = obs_size if i == 0 else hidden_layer_size
             out_size = hidden_layer_size
-            shared_layers.append(nn.Linear(in_size, out_size))
+            if i == 0 and sparse_input:
+                shared_layers.append(ExponentEmbedding(out_size, n_exponents=obs_size // 16))
+            else:
+                shared_layers.append(nn.Linear(in_size, out_size))
             shared_layers.append(self.activation_function)
         self.shared_layers = nn.Sequential(*shared_layers)
 
@@ -78,28 +107,63 @@ class ActorCritic(nn.Module):
         return self.value_layers(self.shared_layers(state))
 
     def forward(self, state):
-        # Compute both policy and value outputs
-        return self.policy_function(state), self.value_function(state)
+        # Compute both policy and value outputs, running the shared layers once
+        shared = self.shared_layers(state)
+        return self.policy_layers(shared), self.value_layers(shared)
+
+    def load_dense_state_dict(self, state_dict):
+        # Load a checkpoint saved with the dense one-hot input layer, converting it when sparse_input is set
+        if self.sparse_input:
+            state_dict = convert_dense_state_dict(state_dict, 'shared_layers.0')
+        self.load_state_dict(state_dict)
 
 # sets up PPO trainer that updates the weights of Actor Critic
 class PPO_Trainer():
 
-  def __init__(self, actor_critic, ppo_clip_val = 0.2, ppo_lr = 3e-4, val_lr = 1e-3, ppo_epochs=16, val_epochs=16, kl_earlystopping=0.01):
+  def __init__(self, actor_critic, ppo_clip_val = 0.2, ppo_lr = 3e-4, val_lr = 1e-3, ppo_epochs=16, val_epochs=16, kl_earlystopping=0.01,
+               num_minibatches=None, update_epochs=4, value_coef=0.5, entropy_coef=0.0, precision='fp32'):
     
     # Initialize instance variables
     self.actor_critic = actor_critic
+    self.device = next(actor_critic.parameters()).device
     self.ppo_clip_val = ppo_clip_val 
     self.ppo_epochs = ppo_epochs
     self.val_epochs = val_epochs 
     self.kl_bound = kl_earlystopping 
 
-    # Set up optimizers
+    # Minibatched fused updates (train_fused) are used when num_minibatches is set
+    self.num_minibatches = num_minibatches
+    self.update_epochs = update_epochs
+    self.value_coef = value_coef
+    self.entropy_coef = entropy_coef
+
+    # With 'bf16' the forward passes run under bfloat16 autocast, the weights and optimizer state stay float32
+    self.precision = check_precision(precision)
+
+    # Set up only the optimizers of the configured update mode
     policy_params = list(self.actor_critic.shared_layers.parameters()) + list(self.actor_critic.policy_layers.parameters())
     value_params = list(self.actor_critic.shared_layers.parameters()) + list(self.actor_critic.value_layers.parameters())
 
-    self.policy_optim = optim.Adam(policy_params, lr=ppo_lr)
-    self.value_optim = optim.Adam(value_params, lr=val_lr)
+    if num_minibatches:
+      # Single optimizer of the fused loss, the value head keeps its own learning rate
+      self.optimizers = {'optim': optim.Adam([
+        {'params': policy_params, 'lr': ppo_lr},
+        {'params': self.actor_critic.value_layers.parameters(), 'lr': val_lr},
+      ])}
+      self.optim = self.optimizers['optim']
+    else:
+      self.optimizers = {'policy_optim': optim.Adam(policy_params, lr=ppo_lr), 'value_optim': optim.Adam(value_params, lr=val_lr)}
+      self.policy_optim = self.optimizers['policy_optim']
+      self.value_optim = self.optimizers['value_optim']
   
+  def state_dict(self):
+    # Optimizer moments of the configured update mode, for full training checkpoints
+    return {name: optimizer.state_dict() for name, optimizer in self.optimizers.items()}
+
+  def load_state_dict(self, state_dict):
+    for name, optimizer in self.optimizers.items():
+      optimizer.load_state_dict(state_dict[name])
+
   def train_policy(self, states, actions, old_log_probs, gaes):
     
     # Train the policy network using PPO
@@ -107,7 +171,8 @@ class PPO_Trainer():
       self.policy_optim.zero_grad() 
 
       # Compute new log probabilities and ratios
-      new_logits = self.actor_critic.policy_function(states)
+      with autocast(self.precision, self.device):
+        new_logits = self.actor_critic.policy_function(states).float()
       new_logits = Categorical(logits=new_logits)
       new_log_probs = new_logits.log_prob(actions)
       ratio = torch.exp(new_log_probs - old_log_probs)
@@ -130,57 +195,85 @@ class PPO_Trainer():
       self.value_optim.zero_grad() 
 
       # Compute value loss and take an optimization step
-      values = self.actor_critic.value_function(states)
+      with autocast(self.precision, self.device):
+        values = self.actor_critic.value_function(states).float().squeeze(-1)
       value_loss = (returns - values).pow(2).mean()
       value_loss.backward()
       self.value_optim.step()
 
-# sets up PPO buffer to collect data and enable agent to act in MDP
-class PPO_Buffer():
-
-  def compute_discounted_rewards(self, rewards, gamma=0.99):
-    """
-    Computes the discounted rewards for a given sequence of rewards using the specified discount factor.
+  def train_fused(self, data):
     """
+    Minibatched PPO update with one loss per minibatch: clipped policy loss, value loss weighted by value_coef and
+    an entropy bonus weighted by entropy_coef, all from one forward pass through the shared layers and one optimizer.
+    Runs update_epochs passes over num_minibatches shuffled minibatches and stops as soon as a minibatch's
+    approximate KL divergence exceeds the bound.
 
-    # Initialize the list of discounted rewards with the reward obtained at the last time step.
-    new_rewards = [float(rewards[-1])]
+    Args:
+    - data (RolloutStorage or tuple): the storage, or (states, actions, returns, gaes, log_probs) tensors
 
-    # Iterate over the time steps in reverse order, starting from the second to last time step.
-    for i in reversed(range(len(rewards)-1)):
+    Returns:
+    - num_updates (int): the number of minibatch updates made
+    """
+    num_updates = 0
+    for _ in range(self.update_epochs):
+      if isinstance(data, RolloutStorage):
+        minibatches = data.minibatches(self.num_minibatches)
+      else:
+        index = torch.randperm(len(data[0]), device=data[0].device).chunk(self.num_minibatches)
+        minibatches = ([x[i] for x in data] for i in index)
+
+      for states, actions, returns, gaes, old_log_probs in minibatches:
+        with autocast(self.precision, self.device):
+          logits, values = self.actor_critic(states)
+        logits, values = logits.float(), values.float()
+        act_distribution = Categorical(logits=logits)
+        new_log_probs = act_distribution.log_prob(actions)
+        ratio = torch.exp(new_log_probs - old_log_probs)
+
+        # Compute the fused loss and take an optimization step
+        clipped_ratio = ratio.clamp(1-self.ppo_clip_val, 1+self.ppo_clip_val)
+        ppo_loss = -torch.min(ratio*gaes, clipped_ratio*gaes).mean()
+        value_loss = (returns - values.squeeze(-1)).pow(2).mean()
+        loss = ppo_loss + self.value_coef * value_loss
+        if self.entropy_coef:
+          loss = loss - self.entropy_coef * act_distribution.entropy().mean()
+
+        self.optim.zero_grad()
+        loss.backward()
+        self.optim.step()
+        num_updates += 1
+
+        # Check early stopping condition on this minibatch
+        approx_kl_div = (old_log_probs - new_log_probs).mean()
+        if self.kl_bound < approx_kl_div:
+          return num_updates
+    return num_updates
 
-        # Compute the discounted reward for the current time step by adding the reward obtained at the current time step
-        # to the discounted reward obtained at the next time step, multiplied by the discount factor gamma.
-        discounted_reward = float(rewards[i]) + gamma * new_rewards[-1]
+# sets up PPO buffer to collect data and enable agent to act in MDP
+class PPO_Buffer():
 
-        # Append the computed discounted reward to the list of discounted rewards.
-        new_rewards.append(discounted_reward)
+  def __init__(self, precision='fp32'):
+    # Compute precision of the rollout forward passes, 'fp32' or 'bf16'
+    self.precision = check_precision(precision)
 
-    # Reverse the order of the list of discounted rewards and convert it to a numpy array.
-    return np.array(new_rewards[::-1])
+  def compute_discounted_rewards(self, rewards, dones=None, gamma=0.99):
+    """
+    Computes the discounted rewards for a given sequence of rewards using the specified discount factor.
+    Returns restart after every step flagged in `dones`, by default the whole sequence is one episode.
+    """
+    return discounted_cumsum(rewards, gamma, dones)
 
-  def compute_advantages_gae(self, rewards, values, gamma=0.99, decay=0.95):
+  def compute_advantages_gae(self, rewards, values, dones=None, gamma=0.99, decay=0.95):
     """
     Calculate the Generalized Advantage Estimation (GAE) for a given sequence of rewards and corresponding predicted values.
+    Advantages restart after every step flagged in `dones`, by default the whole sequence is one episode.
     """
-
-    # Calculate the predicted value of the next state for each time step.
-    next_values = np.concatenate([values[1:], [0]])
-
-    # Compute the temporal difference (TD) errors for each time step.
-    deltas = [rew + gamma * next_val - val for rew, val, next_val in zip(rewards, values, next_values)]
-
-    # Compute the GAEs for each time step.
-    gaes = [deltas[-1]]
-    for i in reversed(range(len(deltas)-1)):
-        gaes.append(deltas[i] + decay * gamma * gaes[-1])
-
-    # Return the computed GAEs as a numpy array.
-    return np.array(gaes[::-1])
+    return compute_gae(rewards, values, dones, gamma=gamma, decay=decay)
 
   def randomize_training_data_order(self, buffer):
       '''
       Randomizes the order of the training data in the buffer.
+      The returns in buffer[2] are already computed in time order by generate_n_rollouts.
       '''
 
       # Create a list of indices
@@ -189,8 +282,7 @@ class PPO_Buffer():
       # Update the buffer with the randomized order
       states = torch.tensor(buffer[0][permute_indices], dtype=torch.float32, device=DEVICE)
       actions = torch.tensor(buffer[1][permute_indices], dtype=torch.float32, device=DEVICE)
-      returns = self.compute_discounted_rewards(buffer[2][permute_indices], gamma=0.99)
-      returns = torch.tensor(returns, dtype=torch.float32, device=DEVICE)
+      returns = torch.tensor(buffer[2][permute_indices], dtype=torch.float32, device=DEVICE)
       gaes = torch.tensor(buffer[3][permute_indices], dtype=torch.float32, device=DEVICE)
       log_probs = torch.tensor(buffer[4][permute_indices], dtype=torch.float32, device=DEVICE)
 
@@ -199,59 +291,288 @@ class PPO_Buffer():
   
   def generate_n_rollouts(self, model, env, max_steps=1000, n=4):
       """
-      Performs n rollouts using the specified model and environment, and computes GAE advantages.
-      Returns training data in the shape (n_steps, observation_shape) and the cumulative reward.
+      Performs n rollouts using the specified model and environment, and computes returns and GAE advantages.
+      Returns training data (observations, actions, returns, advantages, log probs) in the shape
+      (n_steps, observation_shape) and the cumulative reward.
       """
       train_data = [[], [], [], [], []]  # Initialize lists to store training data
+      dones = []  # Last step of every rollout, returns and advantages do not cross these
       ep_reward = 0  # Initialize cumulative reward
       for _ in range(n):
         obs = env.reset()
-        for _ in range(max_steps):
+        for step in range(max_steps):
             # Take an action according to the policy and record the results
-            logits, val = model(torch.tensor([obs], dtype=torch.float32,device=DEVICE))
+            with autocast(self.precision, DEVICE):
+                logits, val = model(torch.tensor([obs], dtype=torch.float32,device=DEVICE))
+            logits, val = logits.float(), val.float()
             act_distribution = Categorical(logits=logits)
             act = act_distribution.sample()
             act_log_prob = act_distribution.log_prob(act).item()
             act, val = act.item(), val.item()
             next_obs, reward, done, _ = env.step(act)
 
-            # Store the training data for this time step
+            # Store the training data for this time step, a rollout cut at max_steps also ends its episode
             for i, item in enumerate((obs, act, reward, val, act_log_prob)):
               train_data[i].append(item)
+            dones.append(done or step == max_steps - 1)
 
             obs = next_obs
             ep_reward += reward
             if done:
                 break
 
-      # Convert the training data to numpy arrays and compute the GAE advantages
+      # Convert the training data to numpy arrays and compute the returns and GAE advantages in time order
       train_data = [np.asarray(x) for x in train_data]
-      train_data[3] = self.compute_advantages_gae(train_data[2], train_data[3])
+      dones = np.asarray(dones)
+      train_data[3] = self.compute_advantages_gae(train_data[2], train_data[3], dones)
+      train_data[2] = self.compute_discounted_rewards(train_data[2], dones)
 
       # Return the training data and the cumulative reward
       return train_data, ep_reward / n
 
+  def generate_batched_rollouts(self, model, envs, max_steps=1000, storage=None, device=DEVICE):
+      """
+      Performs one rollout in every environment of `envs` at the same time, with one batched forward pass
+      and one Categorical sample per step over the environments that are still running. Finished
+      environments drop out of the batch while the others continue.
+      Returns the same training data and average cumulative reward as generate_n_rollouts with n=len(envs).
+      If a RolloutStorage is given, the 2048 environments' board exponents and the step data are written into it
+      instead, and the storage is returned in place of the training data.
+      The observations are moved to `device`, the device of `model` (rollout workers pass 'cpu').
+      """
+      n = len(envs)
+      if storage is not None:
+          return self._fill_rollout_storage(model, envs, storage, max_steps, device)
+
+      # observations of all environments, rows of finished environments are no longer read
+      obs = np.stack([np.asarray(env.reset(), dtype=np.float32) for env in envs])
+      live = np.arange(n)
+      ep_rewards = np.zeros(n)
+      steps = []  # per step: environment ids, observations, actions, rewards, values, log probs
+
+      for step in range(max_steps):
+          acts, vals, act_log_probs = self._sample_actions(model, torch.from_numpy(obs[live]).to(device))
+          acts = acts.cpu().numpy()
+          vals = vals.cpu().numpy()
+          act_log_probs = act_log_probs.cpu().numpy()
+
+          # step every live environment and write its next observation into its row
+          step_obs = obs[live]
+          rewards = np.zeros(len(live))
+          dones = np.zeros(len(live), dtype=bool)
+          for j, i in enumerate(live):
+              obs[i], rewards[j], dones[j], _ = envs[i].step(int(acts[j]))
+          ep_rewards[live] += rewards
+          steps.append((live, step_obs, acts, rewards, vals, act_log_probs))
+
+          live = live[~dones]
+          if len(live) == 0:
+              break
+
+      # regroup the steps by environment, keeping time order inside every rollout
+      env_ids = np.concatenate([s[0] for s in steps])
+      train_data = [np.concatenate(column) for column in list(zip(*steps))[1:]]
+      order = np.argsort(env_ids, kind='stable')
+      env_ids = env_ids[order]
+      train_data = [x[order] for x in train_data]
+
+      # the last step of every rollout ends its episode, whether the game ended or max_steps cut it off
+      dones = np.append(env_ids[1:] != env_ids[:-1], True)
+      train_data[3] = self.compute_advantages_gae(train_data[2], train_data[3], dones)
+      train_data[2] = self.compute_discounted_rewards(train_data[2], dones)
+
+      # Return the training data and the cumulative reward
+      return train_data, ep_rewards.mean()
+
+  def _sample_actions(self, model, obs):
+      # One batched forward pass and one Categorical sample for all observations
+      with torch.no_grad():
+          with autocast(self.precision, obs.device):
+              logits, vals = model(obs)
+          logits, vals = logits.float(), vals.float()
+          act_distribution = Categorical(logits=logits)
+          acts = act_distribution.sample()
+          return acts, vals.squeeze(-1), act_distribution.log_prob(acts)
+
+  def _fill_rollout_storage(self, model, envs, storage, max_steps, device):
+      # Batched rollouts that keep board exponents in a preallocated observation buffer and write every step into storage
+      n = len(envs)
+      storage.reset()
+      exps = np.zeros((n, 16), dtype=np.uint8)
+      for i, env in enumerate(envs):
+          env.reset()
+          exps[i] = env.board.state.reshape(16)
+      if storage.sparse_input:
+          net_input = torch.zeros((n, 16), dtype=torch.long)
+      else:
+          net_input = torch.zeros((n, OBS_SIZE), dtype=torch.float32)
+      live = np.arange(n)
+      ep_rewards = np.zeros(n)
+
+      for step in range(max_steps):
+          k = len(live)
+          if storage.sparse_input:
+              net_input[:k] = torch.from_numpy(exps[live])
+          else:
+              one_hot(exps[live], out=net_input[:k].numpy())
+          acts, vals, act_log_probs = self._sample_actions(model, net_input[:k].to(device))
+          acts_cpu = acts.cpu().numpy()
+
+          # step every live environment and read its next board
+          step_exps = exps[live]
+          rewards = np.zeros(k)
+          dones = np.zeros(k, dtype=bool)
+          for j, i in enumerate(live):
+              _, rewards[j], dones[j], _ = envs[i].step(int(acts_cpu[j]))
+              exps[i] = envs[i].board.state.reshape(16)
+          ep_rewards[live] += rewards
+          storage.insert(live, step_exps, acts, act_log_probs, vals, rewards)
+
+          live = live[~dones]
+          if len(live) == 0:
+              break
+
+      storage.compute_returns_and_advantages()
+      return storage, ep_rewards.mean()
+
+# sets up preallocated storage for 2048 rollouts, filled in place by PPO_Buffer.generate_batched_rollouts
+class RolloutStorage():
+    """
+    Fixed-capacity flat storage of rollout steps. Observations are kept as uint8 board exponents and only
+    encoded for the minibatches that are drawn, every other field is one preallocated tensor.
+
+    Attributes:
+    - obs (torch.Tensor): (capacity, 16) uint8 board exponents
+    - actions, rewards, values, log_probs, returns, advantages (torch.Tensor): (capacity,) per-step values
+    - dones (torch.Tensor): (capacity,) True on the last step of every rollout
+    - env_ids (torch.Tensor): (capacity,) environment that produced every step
+    - size (int): number of steps stored since the last reset
+    """
+    def __init__(self, capacity, device=DEVICE, sparse_input=False):
+        """
+        Args:
+        - capacity (int): maximum number of steps stored, e.g. number of environments * max_steps
+        - device (str): the device the tensors live on
+        - sparse_input (bool): whether minibatch observations are the exponents themselves instead of one-hot vectors (default: False)
+        """
+        self.capacity = capacity
+        self.device = device
+        self.sparse_input = sparse_input
+        self.obs = torch.zeros((capacity, 16), dtype=torch.uint8, device=device)
+        self.actions = torch.zeros(capacity, dtype=torch.long, device=device)
+        self.rewards = torch.zeros(capacity, dtype=torch.float32, device=device)
+        self.values = torch.zeros(capacity, dtype=torch.float32, device=device)
+        self.log_probs = torch.zeros(capacity, dtype=torch.float32, device=device)
+        self.returns = torch.zeros(capacity, dtype=torch.float32, device=device)
+        self.advantages = torch.zeros(capacity, dtype=torch.float32, device=device)
+        self.dones = torch.zeros(capacity, dtype=torch.bool, device=device)
+        self.env_ids = torch.zeros(capacity, dtype=torch.long, device=device)
+        self.size = 0
+
+    def reset(self):
+        # Start filling from the beginning again, nothing is reallocated
+        self.size = 0
+
+    def share_memory_(self):
+        # Moves every tensor to shared memory so a worker process can fill the storage in place
+        for tensor in vars(self).values():
+            if torch.is_tensor(tensor):
+                tensor.share_memory_()
+        return self
+
+    def append(self, other):
+        """
+        Copies the steps of another storage whose returns and advantages are already computed after the steps of this one.
+        """
+        rows = slice(self.size, self.size + other.size)
+        for name in ('obs', 'actions', 'rewards', 'values', 'log_probs', 'returns', 'advantages', 'dones', 'env_ids'):
+            getattr(self, name)[rows] = getattr(other, name)[:other.size].to(self.device)
+        self.size += other.size
+
+    def insert(self, env_ids, obs, actions, log_probs, values, rewards):
+        """
+        Writes one step of several environments in place.
+
+        Args:
+        - env_ids (np.ndarray): the environments that took the step
+        - obs (np.ndarray): (k, 16) exponents the actions were chosen from
+        - actions, log_probs, values (torch.Tensor): outputs of the batched forward pass
+        - rewards (np.ndarray): rewards of the step
+        """
+        k = len(env_ids)
+        rows = slice(self.size, self.size + k)
+        self.env_ids[rows] = torch.from_numpy(env_ids).to(self.device)
+        self.obs[rows] = torch.from_numpy(obs).to(self.device)
+        self.actions[rows] = actions
+        self.log_probs[rows] = log_probs
+        self.values[rows] = values
+        self.rewards[rows] = torch.from_numpy(rewards).to(self.device)
+        self.size += k
+
+    def compute_returns_and_advantages(self, gamma=0.99, decay=0.95):
+        """
+        Marks the last step of every rollout as done and computes returns and GAE advantages in time order.
+        Steps are stored interleaved across environments, so the scan runs over a stable per-environment ordering.
+        """
+        n = self.size
+        env_ids = self.env_ids[:n].cpu().numpy()
+        order = np.argsort(env_ids, kind='stable')
+        dones = np.append(env_ids[order][1:] != env_ids[order][:-1], True)
+
+        rewards = self.rewards[:n].cpu().numpy()[order]
+        values = self.values[:n].cpu().numpy()[order]
+        index = torch.from_numpy(order).to(self.device)
+        self.dones[:n] = False
+        self.dones[index] = torch.from_numpy(dones).to(self.device)
+        self.returns[index] = torch.from_numpy(discounted_cumsum(rewards, gamma, dones)).float().to(self.device)
+        self.advantages[index] = torch.from_numpy(compute_gae(rewards, values, dones, gamma=gamma, decay=decay)).float().to(self.device)
+
+    def observations(self, index):
+        """
+        Returns the network input of the steps in `index`, one-hot encoded unless sparse_input is set.
+        """
+        obs = self.obs[index]
+        if self.sparse_input:
+            return obs.long()
+        return one_hot_torch(obs, device=self.device)
+
+    def minibatches(self, num_minibatches=1, shuffle=True):
+        """
+        Yields (states, actions, returns, advantages, log_probs) for random disjoint minibatches covering the
+        stored steps. Only the drawn rows are gathered, the storage itself is never copied.
+        """
+        n = self.size
+        index = torch.randperm(n, device=self.device) if shuffle else torch.arange(n, device=self.device)
+        for batch in index.chunk(num_minibatches):
+            yield (self.observations(batch), self.actions[batch], self.returns[batch],
+                   self.advantages[batch], self.log_probs[batch])
+
 ### HELPER FUNCTIONS ###
 
 def train_ppo(env, model, ppo_trainer, ppo_buffer, n_episodes=N_EPISODES, num_rollouts=NUM_ROLLOUTS,
               print_freq=PRINT_FREQ, save_freq=SAVE_FREQ, save_model=True, model_path="cartpole_model",
-              stats_path="cartpole_stats.json", load_from_checkpoint=False):
+              stats_path="cartpole_stats.jsonl", load_from_checkpoint=False, storage=None, flush_every=100,
+              checkpoint_dir=None, keep_checkpoints=3):
     """
     Trains a PPO model on a given environment using the provided trainer and buffer.
 
     Args:
-    - env (gym.Env): the environment to train the model on
+    - env (gym.Env, list or RolloutWorkerPool): the environment to train the model on, a list of environments whose rollouts are collected in one batch, or a pool of rollout worker processes
     - model (nn.Module): the PPO model to be trained
     - ppo_trainer (PPOTrainer): the PPO trainer used for training
     - ppo_buffer (PPOBuffer): the PPO buffer used for collecting training data
     - n_episodes (int): the number of episodes to run for (default: N_EPISODES)
-    - num_rollouts (int): the number of rollouts to generate per episode (default: NUM_ROLLOUTS)
+    - num_rollouts (int): the number of rollouts to generate per episode, len(env) for a list of environments (default: NUM_ROLLOUTS)
     - print_freq (int): how often to print episode statistics (default: PRINT_FREQ)
     - save_freq (int): how often to save the model (default: SAVE_FREQ)
     - save_model (bool): whether to save the model or not (default: True)
     - model_path (str): the path to save the model to (default: "cartpole_model")
-    - stats_path (str): the path to save the episode statistics to (default: "cartpole_stats.json")
-    - load_from_checkpoint (bool): whether to load from a checkpoint (default: False)
+    - stats_path (str): the .jsonl or .csv metrics log the episode statistics are appended to (default: "cartpole_stats.jsonl")
+    - load_from_checkpoint (bool): whether to resume from the latest full checkpoint (the log is truncated to the records written up to it), or else continue the step count of the existing metrics log; without it an existing log is moved aside and a new one started (default: False)
+    - storage (RolloutStorage): optional preallocated storage the batched rollouts of 2048 environments are written into (default: None)
+    - flush_every (int): the number of statistics records buffered before they are appended to the log (default: 100)
+    - checkpoint_dir (str): the directory of the full training checkpoints (default: model_path + "_checkpoints")
+    - keep_checkpoints (int): the number of most recent full checkpoints kept on disk (default: 3)
 
     Returns:
     - None
@@ -259,63 +580,102 @@ def train_ppo(env, model, ppo_trainer, ppo_buffer, n_episodes=N_EPISODES, num_ro
 
     # Initialize variables
     num_steps = 0
+    start_episode = 0
     ep_rewards = []
-    stats = {"avg_reward": [], "num_steps": []}
-
-    # Load from checkpoint if flag is set
-    if load_from_checkpoint:
-        num_steps = 84284936
-        with open('ppo_2048_stats_rewardfinal13.json') as f:
-            stats = json.load(f)
+    metrics_records = None
+    checkpoints = CheckpointManager(checkpoint_dir or f"{model_path}_checkpoints", prefix="ppo", keep=keep_checkpoints)
+
+    # Resume from the latest full checkpoint if flag is set, or continue the step count of the existing log
+    if load_from_checkpoint and checkpoints.latest() is not None:
+        checkpoint = checkpoints.load(map_location=DEVICE)
+        model.load_state_dict(checkpoint["model"])
+        ppo_trainer.load_state_dict(checkpoint["ppo_trainer"])
+        num_steps = checkpoint["num_steps"]
+        start_episode = checkpoint["episode"]
+        ep_rewards = checkpoint["ep_rewards"]
+        # one record is logged every print_freq episodes, which older checkpoints without the count fall back to
+        metrics_records = checkpoint.get("metrics_records", start_episode // print_freq)
+        set_rng_state(checkpoint["rng"])
+    elif load_from_checkpoint and os.path.exists(stats_path):
+        num_steps = int(read_metrics(stats_path).get("num_steps", [0])[-1])
+    else:
+        # a fresh run starts a new log, the old one is kept aside
+        rotate_metrics(stats_path)
+    metrics = MetricsWriter(stats_path, flush_every=flush_every)
+
+    # Drop the records logged after the checkpoint, their episodes are run again
+    if metrics_records is not None:
+        metrics.truncate(metrics_records)
 
     # Run the training loop
-    for step in range(n_episodes):
-
-        # Generate rollouts and collect training data
-        train_data, reward = ppo_buffer.generate_n_rollouts(model, env, n=num_rollouts)
+    for step in range(start_episode, n_episodes):
+
+        # Generate rollouts and collect training data, all at once when env is a list of environments
+        if hasattr(env, 'collect'):
+            env.publish(model)
+            storage, reward = env.collect()
+            n_new_steps = storage.size
+        elif storage is not None:
+            storage, reward = ppo_buffer.generate_batched_rollouts(model, env, storage=storage)
+            n_new_steps = storage.size
+        elif isinstance(env, (list, tuple)):
+            train_data, reward = ppo_buffer.generate_batched_rollouts(model, env)
+            n_new_steps = len(train_data[0])
+        else:
+            train_data, reward = ppo_buffer.generate_n_rollouts(model, env, n=num_rollouts)
+            n_new_steps = len(train_data[0])
         ep_rewards.append(reward)
 
-        # Randomize the order of the training data
-        states, actions, rewards, gaes, log_probs = ppo_buffer.randomize_training_data_order(train_data)
+        # Randomize the order of the training data, minibatched updates draw their own minibatches from storage
+        if storage is None:
+            states, actions, returns, gaes, log_probs = ppo_buffer.randomize_training_data_order(train_data)
+        elif not ppo_trainer.num_minibatches:
+            states, actions, returns, gaes, log_probs = next(storage.minibatches())
 
-        # Train the PPO model
-        ppo_trainer.train_policy(states, actions, log_probs, gaes)
-        ppo_trainer.train_value(states, rewards)
+        # Train the PPO model, with minibatched fused updates when the trainer is configured for them
+        if ppo_trainer.num_minibatches:
+            ppo_trainer.train_fused(storage if storage is not None else (states, actions, returns, gaes, log_probs))
+        else:
+            ppo_trainer.train_policy(states, actions, log_probs, gaes)
+            ppo_trainer.train_value(states, returns)
 
         # Update number of steps taken
-        num_steps += len(train_data[0])
+        num_steps += n_new_steps
 
         # Print statistics every `print_freq` episodes
         if (step + 1) % print_freq == 0:
-            avg_reward = np.mean(ep_rewards[-print_freq:])
-            stats["avg_reward"].append(avg_reward)
-            stats["num_steps"].append(num_steps)
+            avg_reward = float(np.mean(ep_rewards[-print_freq:]))
+            metrics.write(avg_reward=avg_reward, num_steps=num_steps)
 
             print(f"Episode {step+1} | Avg Reward {avg_reward:.1f} | NumSteps {num_steps}")
 
-            # Save model every `save_freq` episodes
+            # Save model and a full training checkpoint every `save_freq` episodes, with the statistics logged so far.
+            # Both are written by a background thread
             if save_model and (step + 1) % save_freq == 0:
-                torch.save(model.state_dict(), f"{model_path}_{step+1}.pt")
+                checkpoints.write(model.state_dict(), f"{model_path}_{step+1}.pt")
+                checkpoints.save({"model": model.state_dict(), "ppo_trainer": ppo_trainer.state_dict(), "num_steps": num_steps,
+                                  "episode": step + 1, "ep_rewards": ep_rewards, "rng": rng_state(),
+                                  "metrics_records": metrics.num_records}, step + 1)
+                metrics.flush()
 
-            # Save statistics to JSON file
-            with open(stats_path, "w") as f:
-                json.dump(stats, f)
+    # Write the remaining statistics and checkpoints
+    metrics.close()
+    checkpoints.close()
 
-def plot_training_stats(stats_file='cartpole_stats.json', w_size=20, dpi=300):
+def plot_training_stats(stats_file='cartpole_stats.jsonl', w_size=20, dpi=300):
     """
     Generates a line plot of the average reward over the number of steps taken during training.
 
     Args:
-    - stats_file (str): the path to the JSON file containing the training statistics (default: 'cartpole_stats.json')
+    - stats_file (str): the path to the metrics log containing the training statistics (default: 'cartpole_stats.jsonl')
     - w_size (int): the window size for smoothing the data (default: 20)
     - dpi (int): the resolution of the saved image (default: 300)
 
     Returns:
     - None
     """
-    # Load the statistics from the JSON file
-    with open(stats_file, "r") as f:
-        stats = json.load(f)
+    # Load the statistics from the metrics log
+    stats = read_metrics(stats_file)
 
     # Smooth the data with a rolling average
     window_size = w_size 
@@ -375,12 +735,11 @@ def evaluate_trained_model(model_path, env_name, num_episodes=1000):
 
     return avg_reward
 
-def plot_2048_training(stats_file='ppo_2048_stats.json', w_size=20, dpi=300):
+def plot_2048_training(stats_file='ppo_2048_stats.jsonl', w_size=20, dpi=300):
     """
     Generate a line plot of the average reward over the number of steps taken during training.
     """
-    with open(stats_file, "r") as f:
-        stats = json.load(f)
+    stats = read_metrics(stats_file)
 
     window_size = w_size 
     rolling_avg_reward = np.convolve(stats["avg_reward"], np.ones(window_size)/window_size, mode='valid')
@@ -402,13 +761,16 @@ class AgentPPO():
     - device (str): the device to run the model on (e.g. 'cpu' or 'cuda')
     - actions (np.ndarray): an array of the possible actions that can be taken
     - model (ActorCritic): the PPO model used to select actions
-    - prev_state (np.ndarray): the previous state that was observed
-    - count (int): the number of times the same state has been observed consecutively
+    - obs (torch.Tensor): preallocated network input (one-hot, or exponents with sparse_input)
+    - batch_obs (torch.Tensor): preallocated network input of choose_actions, grown to the largest batch
+    - runtime (InferenceRuntime): runs the model in eval and inference mode, as a frozen traced graph with trace
 
     Methods:
-    - choose_action(state) -> int: chooses an action to take based on the current state
+    - choose_action(state, legal) -> int: chooses an action to take based on the current state
+    - choose_actions(states, legal) -> np.ndarray: chooses the actions of a batch of states with one forward pass
     """
-    def __init__(self, obs_space_size, act_space_size, hidden_layer_size, num_shared_layers, activation_function, device, model_path='ppo_2048_model.th'):
+    def __init__(self, obs_space_size, act_space_size, hidden_layer_size, num_shared_layers, activation_function, device, model_path='ppo_2048_model.th', sparse_input=False, precision='fp32',
+                 num_threads=None, trace=True):
         """
         Initializes the AgentPPO instance with the specified parameters.
 
@@ -420,46 +782,85 @@ class AgentPPO():
         - activation_function (function): the activation function used in the model
         - device (str): the device to run the model on (e.g. 'cpu' or 'cuda')
         - model_path (str): the path to the saved model weights (default: 'ppo_2048_model.th')
+        - sparse_input (bool): whether to convert the saved dense weights to the exponent embedding input layer (default: False)
+        - precision (str): 'fp32', or 'bf16' to run the model under bfloat16 autocast (default: 'fp32')
+        - num_threads (int): the number of torch intra-op threads to pin, 1 in simulator worker processes (default: None, unchanged)
+        - trace (bool): whether to run the model as a frozen traced graph (default: True)
         """
         self.device = device
         self.actions = np.array([0, 1, 2, 3])
+        self.sparse_input = sparse_input
 
         # Create and load the PPO model
-        self.model = ActorCritic(obs_space_size, act_space_size, hidden_layer_size, num_shared_layers, activation_function)
+        self.model = ActorCritic(obs_space_size, act_space_size, hidden_layer_size, num_shared_layers, activation_function, sparse_input)
         self.model = self.model.to(self.device)
-        self.model.load_state_dict(torch.load(model_path, map_location=self.device))
+        self.model.load_dense_state_dict(torch.load(model_path, map_location=self.device))
 
-        self.prev_state = None
-        self.count = 0
+        # preallocated network input
+        if sparse_input:
+            self.obs = torch.zeros(1, 16, dtype=torch.long, device=self.device)
+        else:
+            self.obs = torch.zeros(1, obs_space_size, device=self.device)
+        self.batch_obs = self.obs
+        self.runtime = InferenceRuntime(self.model, self.obs, trace=trace, num_threads=num_threads, precision=precision)
 
-    def choose_action(self, state):
+    def choose_action(self, state, legal=None):
         """
         Chooses an action to take based on the current state.
+        Moves that would not change the board are masked out of the logits.
 
         Args:
-        - state (np.ndarray): the current state
+        - state (np.ndarray): the current state as a 4x4 array of tile exponents
+        - legal (np.ndarray): optional mask of the moves that change the board, e.g. Board.legal_actions(), computed if not given
 
         Returns:
         - act (int): the action to take
         """
-        # If the same state has been observed more than 5 times, choose a random action
-        if self.prev_state is not None and (self.prev_state == state).all():
-            self.count += 1
+        if legal is None:
+            legal = legal_moves(state)
+
+        # Write the state into the input buffer (exponents or one-hot) and pass it through the model to get the logits
+        if self.sparse_input:
+            self.obs.copy_(torch.from_numpy(state.reshape(1, 16)))
         else:
-            self.prev_state = state.copy()
-            self.count = 0
-        
-        if self.count > 5:
-            return np.random.choice(self.actions)
+            one_hot_torch(state, out=self.obs)
+        logits = self.runtime(self.obs)[0][0].cpu().numpy()
+        if legal.any():
+            logits = np.where(legal, logits, -np.inf)
+        act = int(np.argmax(logits))
+        return act
+
+    def choose_actions(self, states, legal=None):
+        """
+        Chooses the actions of a batch of states with one forward pass.
+        Moves that would not change a board are masked out of its logits.
+
+        Args:
+        - states (np.ndarray): the current states as an (M,4,4) array of tile exponents
+        - legal (np.ndarray): optional (M,4) mask of the moves that change each board, computed if not given
+
+        Returns:
+        - acts (np.ndarray): the (M,) actions to take
+        """
+        states = np.asarray(states)
+        m = len(states)
+        if legal is None:
+            legal = legal_moves_batch(states)
+
+        # Grow the input buffer to the largest batch seen so far and write the states into its first m rows
+        if len(self.batch_obs) < m:
+            self.batch_obs = self.obs.new_zeros((m,) + self.obs.shape[1:])
+        obs = self.batch_obs[:m]
+        if self.sparse_input:
+            obs.copy_(torch.from_numpy(states.reshape(m, 16)))
         else:
-            # Preprocess the state and pass it through the model to get the logits
-            state = np.log2(state, out=np.zeros_like(state), where=(state != 0)).reshape(-1).astype(int)
-            state = np.eye(18)[state]
-            state = torch.tensor(state.flatten(), dtype=torch.float32).unsqueeze(0)
+            one_hot_torch(states, out=obs)
+
+        logits = self.runtime(obs)[0].cpu().numpy()
 
-            logits, _ = self.model(torch.tensor(state.flatten(), dtype=torch.float32, device=self.device))
-            act = torch.argmax(logits).item()
-            return act
+        # Boards without a legal move keep all actions, as in choose_action
+        mask = ~legal & legal.any(axis=1, keepdims=True)
+        return np.where(mask, -np.inf, logits).argmax(axis=1)
 
 if __name__ == "__main__":
   
@@ -496,7 +897,7 @@ if __name__ == "__main__":
   ###  PLOTS TRAINING AND EVALUATES TRAINED MODEL FOR PROXIMAL POLICY OPTIMIZATION ###
 
   # plot the training cartpole stats
-  plot_training_stats('cartpole_stats.json')
+  plot_training_stats('cartpole_stats.jsonl')
 
   # evaluate the model
   evaluate_trained_model(model_path="cartpole_model_1000.pt", env_name = 'CartPole-v1', num_episodes=1000)
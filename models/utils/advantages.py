@@ -0,0 +1,107 @@
+import numpy as np
+
+
+def _chunk_size(discount):
+    """
+    Longest chunk (at most 1024 steps) over which discount**length stays above 1e-12, so the
+    rescaled suffix sums below keep their float64 precision.
+    """
+    if discount >= 1:
+        return 1024
+    return int(np.clip(-12 / np.log10(discount), 1, 1024))
+
+
+def discounted_cumsum(x, discount, dones=None):
+    """
+    Reverse discounted cumulative sum that restarts after every episode end,
+    y[t] = x[t] + discount * (1 - dones[t]) * y[t+1].
+
+    The buffer is cut into chunks. Inside a chunk every suffix sum is one reversed cumsum of
+    discount**j * x[j], cut at the episode ends. The values carried over chunk borders then follow
+    from one short recurrence over the chunks, so the only Python loop is over chunks, not steps.
+
+    Parameters
+    ----------
+    x : np.ndarray
+      Flat array of per-step values
+    discount : float
+      Discount per step
+    dones : np.ndarray
+      Optional flat boolean array, True on the last step of every episode.
+      By default the whole buffer is one episode
+
+    Returns
+    -------
+    np.ndarray
+      float64 array with the same length as x
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n = len(x)
+    if dones is None:
+        dones = np.zeros(n, dtype=bool)
+    dones = np.asarray(dones, dtype=bool)
+    if n == 0 or discount == 0:
+        return x.copy()
+
+    # pad the buffer to whole chunks, padded steps are zero-valued episode ends
+    size = min(_chunk_size(discount), n)
+    n_chunks = -(-n // size)
+    pad = n_chunks * size - n
+    x = np.concatenate([x, np.zeros(pad)]).reshape(n_chunks, size)
+    dones = np.concatenate([dones, np.ones(pad, dtype=bool)]).reshape(n_chunks, size)
+
+    powers = discount ** np.arange(size + 1, dtype=np.float64)
+    positions = np.arange(size)
+
+    # suffix[c, j] = sum_{k >= j} discount**k * x[c, k], with one extra zero column at the end
+    suffix = np.zeros((n_chunks, size + 1))
+    suffix[:, :size] = np.cumsum((x * powers[:size])[:, ::-1], axis=1)[:, ::-1]
+
+    # index of the first episode end at or after every step of its chunk (size if there is none)
+    ends = np.where(dones, positions, size)
+    ends = np.minimum.accumulate(ends[:, ::-1], axis=1)[:, ::-1]
+    stop = np.minimum(ends + 1, size)
+    local = (suffix[:, :size] - np.take_along_axis(suffix, stop, axis=1)) / powers[:size]
+
+    # steps whose episode runs past the end of their chunk continue into the next chunk
+    open_steps = ends == size
+    carry = np.zeros(n_chunks + 1)
+    for c in reversed(range(n_chunks)):
+        carry[c] = local[c, 0] + open_steps[c, 0] * powers[size] * carry[c + 1]
+    y = local + open_steps * powers[size - positions] * carry[1:, None]
+    return y.reshape(-1)[:n]
+
+
+def compute_gae(rewards, values, dones=None, gamma=0.99, decay=0.95):
+    """
+    Generalized Advantage Estimation over a flat buffer of episodes.
+
+    Parameters
+    ----------
+    rewards : np.ndarray
+      Flat array of rewards
+    values : np.ndarray
+      Value predictions of the same steps
+    dones : np.ndarray
+      Optional flat boolean array, True on the last step of every episode.
+      By default the whole buffer is one episode
+    gamma : float
+      Discount factor
+    decay : float
+      GAE lambda
+
+    Returns
+    -------
+    np.ndarray
+      The advantages
+    """
+    rewards = np.asarray(rewards, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    if dones is None:
+        dones = np.zeros(len(rewards), dtype=bool)
+    dones = np.asarray(dones, dtype=bool)
+
+    # the value after the last step of an episode is 0
+    next_values = np.concatenate([values[1:], [0.0]]) * ~dones
+    deltas = rewards + gamma * next_values - values
+    return discounted_cumsum(deltas, gamma * decay, dones)
@@ -0,0 +1,132 @@
+import copy
+import glob
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    """
+    Deep copy of a (nested) training state with every tensor cloned to CPU and every numpy array copied,
+    so training can keep modifying the originals while the copy is written.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, np.ndarray):
+        return obj.copy()
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+def rng_state():
+    '''returns the state of the global torch, cuda, numpy and python random generators'''
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'random': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    '''restores the generators saved by rng_state'''
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointManager():
+    """
+    Writes checkpoints from a background thread and keeps the last `keep` of them.
+
+    save() only takes a CPU snapshot of the state, the torch.save happens on the writer thread. Every file is
+    written to a temporary name first and moved into place with os.replace, so a crash mid-write never leaves
+    a truncated checkpoint behind.
+    """
+
+    def __init__(self, directory, prefix='checkpoint', keep=3):
+        """
+        Parameters
+        ----------
+        directory : str
+          Directory the checkpoints are written to, created if needed
+        prefix : str
+          File name prefix, checkpoints are named <prefix>_<step>.pt
+        keep : int
+          Number of most recent checkpoints kept on disk
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def _writer(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            obj, path, rotate = job
+            try:
+                tmp_path = path + '.tmp'
+                torch.save(obj, tmp_path)
+                os.replace(tmp_path, path)
+                if rotate:
+                    for old in self.checkpoints()[:-self.keep]:
+                        os.remove(old)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('writing a checkpoint failed') from error
+
+    def save(self, state, step):
+        '''snapshots `state` and queues it to be written as checkpoint number `step`, returns the checkpoint path'''
+        self._check()
+        path = os.path.join(self.directory, f'{self.prefix}_{step:010d}.pt')
+        self.queue.put((snapshot(state), path, True))
+        return path
+
+    def write(self, obj, path):
+        '''snapshots `obj` and queues it to be written atomically to `path`, outside the rotation (e.g. exported weights)'''
+        self._check()
+        self.queue.put((snapshot(obj), path, False))
+
+    def checkpoints(self):
+        '''returns the paths of the checkpoints on disk, oldest first'''
+        return sorted(glob.glob(os.path.join(self.directory, f'{self.prefix}_*.pt')))
+
+    def latest(self):
+        '''returns the path of the most recent checkpoint, or None'''
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def load(self, path=None, map_location='cpu'):
+        '''loads a checkpoint, the most recent one by default'''
+        path = path or self.latest()
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+    def wait(self):
+        '''blocks until every queued checkpoint is on disk'''
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
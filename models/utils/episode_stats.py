@@ -0,0 +1,74 @@
+import numpy as np
+
+
+def _count(hist, value):
+    # adds one count to bin `value`, growing the histogram geometrically when the bin is past its end
+    if value >= len(hist):
+        grown = np.zeros(max(2 * len(hist), value + 1), dtype=np.int64)
+        grown[:len(hist)] = hist
+        hist = grown
+    hist[value] += 1
+    return hist
+
+
+def _add(a, b):
+    # bin-wise sum of two histograms of any lengths
+    if len(a) < len(b):
+        a, b = b, a
+    out = a.copy()
+    out[:len(b)] += b
+    return out
+
+
+class EpisodeStats():
+    """
+    Histograms of the final score, max tile and number of steps of finished games, kept as plain NumPy
+    bin counts so a worker process updates them locally without any IPC. Workers send their histograms
+    to the parent, which merges them bin by bin.
+    """
+
+    def __init__(self):
+        self.scores = np.zeros(4096, dtype=np.int64)
+        self.max_exponents = np.zeros(18, dtype=np.int64)
+        self.steps = np.zeros(1024, dtype=np.int64)
+
+    def __len__(self):
+        return int(self.steps.sum())
+
+    def add(self, score, max_exponent, n_steps):
+        """
+        Counts one finished game.
+
+        Parameters
+        ----------
+        score : float
+          Final score, scores are whole numbers and are binned exactly
+        max_exponent : int
+          log2 exponent of the largest tile
+        n_steps : int
+          Number of moves the game lasted
+        """
+        self.scores = _count(self.scores, int(score))
+        self.max_exponents = _count(self.max_exponents, int(max_exponent))
+        self.steps = _count(self.steps, int(n_steps))
+
+    def merge(self, other):
+        '''adds the counts of another EpisodeStats to this one, returns self'''
+        self.scores = _add(self.scores, other.scores)
+        self.max_exponents = _add(self.max_exponents, other.max_exponents)
+        self.steps = _add(self.steps, other.steps)
+        return self
+
+    def as_dicts(self):
+        """
+        Returns
+        -------
+        (dict, dict, dict)
+          {score: count}, {max tile value: count} and {number of steps: count} over the non-empty bins,
+          the format Plotter takes
+        """
+        def nonzero(hist, key):
+            return {key(value): int(hist[value]) for value in np.flatnonzero(hist)}
+        return (nonzero(self.scores, float),
+                nonzero(self.max_exponents, lambda e: float(2 ** e) if e else 0.0),
+                nonzero(self.steps, int))
@@ -0,0 +1,59 @@
+import warnings
+
+import torch
+
+from .precision import autocast, check_precision
+
+
+class InferenceRuntime():
+    """
+    Runs a trained network for action selection only.
+
+    The model is switched to eval mode, traced on an example input and frozen, so every call is one
+    TorchScript graph with the weights folded in as constants instead of a walk over nn.Module calls.
+    Calls run under torch.inference_mode, which records no autograd graph and skips version counting.
+    The traced graph works for any batch size of the example input's layout. With bf16 the model runs
+    eagerly under autocast instead, since autocast casts the weights at call time and a frozen graph
+    would have to hold them as constants.
+    """
+
+    def __init__(self, model, example_input, trace=True, num_threads=None, precision='fp32'):
+        """
+        Parameters
+        ----------
+        model : nn.Module
+          The network, used as is when tracing is off or fails
+        example_input : tensor
+          Input of the layout the runtime is called with, e.g. the agent's preallocated observation
+        trace : bool
+          Default True, if False (or with bf16) the eval-mode module runs without TorchScript
+        num_threads : int
+          Optional number of intra-op threads of this process, 1 in every worker process avoids
+          oversubscribing the cores when several simulations run side by side
+        precision : str
+          'fp32' or 'bf16', the compute precision of the forward pass. Outputs are always float32
+        """
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        self.precision = check_precision(precision)
+        self.device = example_input.device
+        self.model = model.eval()
+        self.traced = False
+
+        if trace and self.precision == 'fp32':
+            try:
+                # newer torch releases flag TorchScript as deprecated, it is still supported
+                with torch.no_grad(), warnings.catch_warnings():
+                    warnings.simplefilter('ignore', FutureWarning)
+                    self.model = torch.jit.freeze(torch.jit.trace(model, example_input.clone()))
+                self.traced = True
+            except Exception as e:
+                warnings.warn(f'tracing the model failed, running it eagerly: {e}')
+
+    def __call__(self, obs):
+        '''forward pass of the network on `obs`, returns its output(s) as float32'''
+        with torch.inference_mode(), autocast(self.precision, self.device):
+            out = self.model(obs)
+        if isinstance(out, tuple):
+            return tuple(x.float() for x in out)
+        return out.float()
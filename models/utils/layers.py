@@ -0,0 +1,85 @@
+import math
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+
+class ExponentEmbedding(nn.Module):
+    """
+    Sparse replacement for the dense nn.Linear(288, out_features) input layer.
+
+    The one-hot board has exactly one non-zero entry per cell, so the dense layer just adds up
+    16 columns of its weight. This layer takes the 16 cell exponents directly and sums the matching
+    16 rows with one embedding_bag call, which gives the same output without building the one-hot vector.
+    """
+
+    def __init__(self, out_features, n_cells=16, n_exponents=18):
+        """
+        Parameters
+        ----------
+        out_features : int
+          Width of the layer output
+        n_cells : int
+          Number of board cells per observation
+        n_exponents : int
+          Number of distinct exponents a cell can hold
+        """
+        super(ExponentEmbedding, self).__init__()
+        self.n_cells = n_cells
+        self.n_exponents = n_exponents
+        self.in_features = n_cells * n_exponents
+        self.out_features = out_features
+
+        # row 18*i + e is the contribution of cell i holding exponent e, i.e. the transposed dense weight
+        self.weight = nn.Parameter(torch.empty(self.in_features, out_features))
+        self.bias = nn.Parameter(torch.empty(out_features))
+        self.register_buffer('offsets', torch.arange(n_cells) * n_exponents, persistent=False)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        """
+        Uses the same initialization bounds as nn.Linear(288, out_features).
+        """
+        bound = 1 / math.sqrt(self.in_features)
+        nn.init.uniform_(self.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, exps):
+        """
+        Parameters
+        ----------
+        exps : tensor
+          Integer tensor of cell exponents with shape (..., 16)
+
+        Returns
+        -------
+        tensor
+          Output tensor of shape (..., out_features)
+        """
+        batch = exps.shape[:-1]
+        indices = exps.reshape(-1, self.n_cells).long() + self.offsets
+        out = F.embedding_bag(indices, self.weight, mode='sum') + self.bias
+        return out.reshape(batch + (self.out_features,))
+
+
+def convert_dense_state_dict(state_dict, layer):
+    """
+    Converts a state dict saved with a dense nn.Linear input layer to the ExponentEmbedding layout.
+
+    Parameters
+    ----------
+    state_dict : dict
+      State dict of a model whose input layer is nn.Linear(288, out_features)
+    layer : str
+      Key prefix of that input layer, e.g. 'Q_net.0' for DoubleDQN or 'shared_layers.0' for ActorCritic
+
+    Returns
+    -------
+    dict
+      A copy of the state dict with the input layer weight transposed
+    """
+    state_dict = state_dict.copy()
+    state_dict[layer + '.weight'] = state_dict[layer + '.weight'].t().contiguous()
+    return state_dict
+
@@ -0,0 +1,146 @@
+import csv
+import json
+import os
+import time
+
+
+class MetricsWriter():
+    """
+    Buffered, append-only metrics log. Records are kept in memory and appended to the file every
+    `flush_every` records, so logging one record costs O(1) no matter how long the run is.
+
+    The format follows the file extension: one JSON object per line for .jsonl, a header plus
+    one row per record for .csv.
+    """
+
+    def __init__(self, path, flush_every=100):
+        """
+        Parameters
+        ----------
+        path : str
+          File the records are appended to, created if needed. Existing records are kept, so a resumed
+          run continues the same log
+        flush_every : int
+          Number of records buffered before they are written
+        """
+        self.path = path
+        self.flush_every = flush_every
+        self.csv = path.endswith('.csv')
+        self.fieldnames = None
+        self.pending = []
+
+        # records logged so far, written or buffered, saved in checkpoints so a resume can truncate the log to them
+        self.num_records = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            lines = self._read_lines()
+            if self.csv:
+                self.fieldnames = next(csv.reader(lines[:1]))
+            self.num_records = len(lines) - self.csv
+
+    def _read_lines(self):
+        # the non-empty lines of the file, the header first for .csv
+        with open(self.path, newline='') as f:
+            return [line for line in f if line.strip()]
+
+    def write(self, **record):
+        '''buffers one record, e.g. write(num_steps=1000, avg_reward=512.0), and flushes when the buffer is full'''
+        self.pending.append(record)
+        self.num_records += 1
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        '''appends the buffered records to the file'''
+        if not self.pending:
+            return
+        with open(self.path, 'a', newline='') as f:
+            if self.csv:
+                if self.fieldnames is None:
+                    self.fieldnames = list(self.pending[0])
+                    csv.writer(f).writerow(self.fieldnames)
+                csv.DictWriter(f, self.fieldnames).writerows(self.pending)
+            else:
+                f.writelines(json.dumps(record) + '\n' for record in self.pending)
+        self.pending = []
+
+    def truncate(self, num_records):
+        """
+        Drops every record after the first num_records, e.g. the records a run logged after the checkpoint it
+        resumes from, which the resumed run logs again. A log with fewer records is left as it is.
+
+        Parameters
+        ----------
+        num_records : int
+          Number of records kept, the num_records saved with the checkpoint
+        """
+        self.flush()
+        if self.num_records <= num_records:
+            return
+        lines = self._read_lines()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', newline='') as f:
+            f.writelines(lines[:num_records + self.csv])
+        os.replace(tmp_path, self.path)
+        self.num_records = num_records
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def rotate_metrics(path):
+    """
+    Moves an existing metrics log aside so a fresh (not resumed) run starts a new one instead of appending to it.
+    The old log keeps its extension and gets the time it was last written, e.g. ddqn_metrics_20260101-120000.jsonl.
+
+    Returns
+    -------
+    str
+      The path the old log was moved to, or None if there was none
+    """
+    if not os.path.exists(path):
+        return None
+    root, ext = os.path.splitext(path)
+    rotated = f"{root}_{time.strftime('%Y%m%d-%H%M%S', time.localtime(os.path.getmtime(path)))}{ext}"
+    os.replace(path, rotated)
+    return rotated
+
+
+def read_metrics(path):
+    """
+    Rebuilds the series of a metrics log.
+
+    Parameters
+    ----------
+    path : str
+      A .jsonl or .csv file written by MetricsWriter, or a legacy .json stats file holding a dict of lists
+
+    Returns
+    -------
+    dict
+      One list per metric name, e.g. {'avg_reward': [...], 'num_steps': [...]}
+    """
+    if path.endswith('.json'):
+        with open(path) as f:
+            return json.load(f)
+
+    series = {}
+    if path.endswith('.csv'):
+        with open(path, newline='') as f:
+            records = [{key: float(value) for key, value in row.items()} for row in csv.DictReader(f)]
+    else:
+        with open(path) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    for record in records:
+        for key, value in record.items():
+            series.setdefault(key, []).append(value)
+    return series
@@ -0,0 +1,39 @@
+import contextlib
+
+import torch
+
+# compute dtype of every precision mode, weights and optimizer state always stay float32
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16}
+
+
+def check_precision(precision):
+    '''raises a ValueError for an unknown precision mode and returns it otherwise'''
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {sorted(PRECISIONS)}, got {precision!r}")
+    return precision
+
+
+def autocast(precision='fp32', device='cpu'):
+    """
+    Context manager that runs the forward passes inside it at the compute dtype of `precision`.
+
+    With 'bf16' the matmuls run in bfloat16 through torch.autocast while the parameters, their
+    gradients and the optimizer state keep their float32 master copies, so backward() and the
+    optimizer step are unchanged. Outputs may be bfloat16 and should be cast with .float()
+    before losses, distributions or argmax ties are computed from them. 'fp32' is a no-op.
+
+    Parameters
+    ----------
+    precision : str
+      'fp32' or 'bf16'
+    device : str or torch.device
+      Device the forward passes run on
+
+    Returns
+    -------
+    context manager
+    """
+    dtype = PRECISIONS[check_precision(precision)]
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype)
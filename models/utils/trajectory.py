@@ -0,0 +1,82 @@
+import numpy as np
+
+
+class TrajectoryRecorder():
+    """
+    Records the frames of one game into preallocated arrays: the board exponents, the action that led
+    to the board, the score after it and the cell the new tile spawned in.
+
+    The arrays grow in whole chunks and at least double whenever they are full, so recording a step costs
+    amortized O(1) however long the game is. They are kept across episodes, so once the longest game has
+    been seen no more memory is allocated. Frame 0 is the initial board, with action -1 and spawn -1.
+    """
+
+    def __init__(self, chunk_size=256):
+        """
+        Parameters
+        ----------
+        chunk_size : int
+          Number of frames allocated up front, the capacity is always a multiple of it
+        """
+        self.chunk_size = chunk_size
+        self.size = 0
+        self._allocate(chunk_size)
+
+    def _allocate(self, capacity):
+        self.capacity = capacity
+        self.boards = np.zeros((capacity, 4, 4), dtype=np.uint8)
+        self.actions = np.zeros(capacity, dtype=np.int8)
+        self.scores = np.zeros(capacity, dtype=np.float64)
+        self.spawns = np.zeros(capacity, dtype=np.int8)
+
+    def _grow(self):
+        # copy the recorded frames into arrays of at least twice the capacity, rounded up to whole chunks
+        old = (self.boards, self.actions, self.scores, self.spawns)
+        chunks = -(-2 * self.capacity // self.chunk_size)
+        self._allocate(chunks * self.chunk_size)
+        for new, recorded in zip((self.boards, self.actions, self.scores, self.spawns), old):
+            new[:self.size] = recorded[:self.size]
+
+    def reset(self, state):
+        '''starts a new episode at the initial board `state`, overwriting the previous one'''
+        self.size = 0
+        self.record(state, -1, 0, -1)
+
+    def record(self, state, action, score, spawn=-1):
+        """
+        Appends one frame.
+
+        Parameters
+        ----------
+        state : np.ndarray
+          4x4 board of exponents after the move, copied into the buffer
+        action : int
+          Move that led to the board (0 : up, 1 : down, 2 : left, 3 : right)
+        score : float
+          Score after the move
+        spawn : int
+          Cell (4 * row + col) the new tile spawned in, -1 if none did
+        """
+        if self.size == self.capacity:
+            self._grow()
+        self.boards[self.size] = state
+        self.actions[self.size] = action
+        self.scores[self.size] = score
+        self.spawns[self.size] = spawn
+        self.size += 1
+
+    def __len__(self):
+        return self.size
+
+    def trajectory(self):
+        """
+        Returns the recorded frames as views into the buffer, without copying. The views are overwritten
+        by the next episode, copy them to keep a trajectory.
+
+        Returns
+        -------
+        dict
+          'boards' (n,4,4) uint8 exponents, 'actions' (n,) int8, 'scores' (n,) float64 and 'spawns' (n,) int8
+        """
+        return {'boards': self.boards[:self.size], 'actions': self.actions[:self.size],
+                'scores': self.scores[:self.size], 'spawns': self.spawns[:self.size]}
@@ -1,31 +1,62 @@
 import time 
+import queue
+import traceback
 import multiprocessing as mp
-from models.env.board import Board
+from models.env.board import Board, TILE_VALUES
+from models.env.vec_board import VecBoard
 from models.agent_random import AgentRandom
 from models.train_ppo_base import AgentPPO
 from models.agent_ddqn import AgentDoubleDQN
+from models.utils.episode_stats import EpisodeStats
 from models.utils.plotting import Plotter
+from models.utils.trajectory import TrajectoryRecorder
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import os
 import torch
 import torch.nn as nn 
 
+def guided_chunks(num_episodes, num_workers, min_chunk=1):
+    '''
+    episode chunk sizes of guided scheduling: every chunk is the remaining episodes divided by twice the number
+    of workers, but at least min_chunk. the chunks add up to num_episodes exactly.
+    '''
+    chunks = []
+    remaining = num_episodes
+    while remaining > 0:
+        chunk = min(remaining, max(min_chunk, remaining // (2 * num_workers)))
+        chunks.append(chunk)
+        remaining -= chunk
+    return chunks
+
 class Simulator():
 
     VISUAL_X_COORD = 0
 
-    def __init__(self, agent=None):
+    def __init__(self, agent=None, flush_every=None):
 
         # selects which agent to run simulations from
         self.agent =  agent
 
-        # stores simulation info for plotting
-        self.game_scores = mp.Manager().dict()
-        self.max_scores = mp.Manager().dict() 
-        self.num_steps = mp.Manager().dict()
+        # histograms of the finished games. Every worker keeps its own and sends it to the parent at the end,
+        # or every flush_every episodes if set, where they are merged
+        self.stats = EpisodeStats()
+        self.flush_every = flush_every
+
+        # throughput and latency report of every worker of the last run_episodes
+        self.worker_reports = {}
+
+        # stores simulation info for plotting, rebuilt from the merged histograms
+        self.game_scores = {}
+        self.max_scores = {}
+        self.num_steps = {}
+
+        # records the boards, moves, scores and spawns of the current game
+        self.recorder = TrajectoryRecorder()
 
-        # stores a tensor of the game states
+        # views of the last game's frames, and its boards as a tensor
+        self.trajectory = None
         self.gameplay_tensor = None
     
     def run_episode(self):
@@ -34,7 +65,8 @@ class Simulator():
 
         n_steps = 0 
 
-        current_game = torch.zeros(1, 4, 4)
+        # the first frame is the initial board, with no move
+        self.recorder.reset(game.get_state())
 
         # runs an episode until termination 
         while not game.is_terminal_state() and n_steps < 1200:
@@ -42,42 +74,157 @@ class Simulator():
             # gets state, and makes action based on state
             state = game.get_state() 
 
-            #choose action
-            action = self.agent.choose_action(state)
+            #choose action, with the legal-move mask the board already keeps
+            action = self.agent.choose_action(state, game.legal_actions())
 
             # updates game board steps
             game.move(action)
             n_steps += 1
 
-            # Save a tensor in the game sequence
-            # newStats = torch.tensor([game.get_score(), game.get_last_move()])
-            newState = torch.from_numpy(state).reshape([1, 4, 4])
-            current_game = torch.cat((current_game, newState), dim = 0)
+            # Record the board after the move, with the move, the score and where the new tile spawned
+            self.recorder.record(game.get_state(), action, game.get_score(), game.last_spawn)
 
-        self.gameplay_tensor = current_game
+        # zero-copy views of the recorded frames, overwritten by the next episode
+        self.trajectory = self.recorder.trajectory()
+        self.gameplay_tensor = torch.from_numpy(self.trajectory['boards'])
 
-        # updates simulation info dictionaries 
-        self.num_steps[n_steps] = self.num_steps.get(n_steps, 0) + 1
-        self.max_scores[game.get_max()] = self.max_scores.get(game.get_max(), 0) + 1
-        self.game_scores[game.score] = self.game_scores.get(game.score, 0) + 1
+        # updates the local simulation histograms
+        self.stats.add(game.score, game.get_state().max(), n_steps)
+        return n_steps
     
-    def run_episodes(self, num_episodes=100, num_procs=1):
+    def run_episodes(self, num_episodes=100, num_procs=1, agent_factory=None, min_chunk=1, seed=None):
+        """
+        Runs num_episodes episodes on num_procs worker processes and merges their statistics.
+
+        The episodes are cut into guided chunks (each chunk is the remaining episodes divided by twice the number
+        of workers) that workers pull from a shared task queue, so long episodes early on are balanced out by
+        small chunks at the end and every worker stays busy until the queue is empty.
+
+        Parameters
+        ----------
+        num_episodes : int
+            Total number of episodes, all of them are run
+        num_procs : int
+            Number of worker processes
+        agent_factory : callable
+            Optional, called once in every worker to build its agent (e.g. AgentDoubleDQN), by default the workers
+            play a copy of self.agent
+        min_chunk : int
+            Smallest number of episodes handed out at once
+        seed : int
+            Optional base seed of the workers' games, worker i is seeded with (seed, i). By default every worker
+            draws a fresh seed, so forked workers never replay the same games
+
+        Raises
+        ------
+        RuntimeError
+            If a worker fails (e.g. agent_factory raises) or dies, with the worker's traceback. The other workers
+            are stopped
+        """
         start = time.time()
 
-        # divide episodes among processes
-        episodes_per_proc = num_episodes // num_procs
-        procs = []
+        # queue every chunk up front, followed by one stop signal per worker
+        tasks = mp.Queue()
+        for chunk in guided_chunks(num_episodes, num_procs, min_chunk):
+            tasks.put(chunk)
         for _ in range(num_procs):
-            proc = mp.Process(target=self.run_episodes_worker, args=(episodes_per_proc,))
+            tasks.put(None)
+
+        results = mp.Queue()
+        procs = []
+        for worker_id in range(num_procs):
+            proc = mp.Process(target=self.scheduled_worker, args=(worker_id, tasks, results, agent_factory, seed))
             proc.start()
             procs.append(proc)
 
+        # merge the workers' histograms as they arrive, until every worker has sent its report
+        self.worker_reports = {}
+        while len(self.worker_reports) < num_procs:
+            try:
+                worker_id, stats, report = results.get(timeout=1.0)
+            except queue.Empty:
+                # a worker killed without raising (e.g. out of memory) never reports, so check on the processes
+                for worker_id, proc in enumerate(procs):
+                    if worker_id not in self.worker_reports and proc.exitcode not in (None, 0):
+                        self._stop_workers(procs)
+                        raise RuntimeError(f"worker {worker_id} exited with code {proc.exitcode}")
+                continue
+            self.stats.merge(stats)
+            if report is None:
+                continue
+            if 'error' in report:
+                self._stop_workers(procs)
+                raise RuntimeError(f"worker {worker_id} failed:\n{report['error']}")
+            self.worker_reports[worker_id] = report
+
         # wait for processes to finish
         for proc in procs:
             proc.join()
+        self.game_scores, self.max_scores, self.num_steps = self.stats.as_dicts()
 
         end = time.time()
         print(f"It took {end-start:.3f} seconds to run {num_episodes} simulations.")
+        self.print_worker_reports()
+
+    def scheduled_worker(self, worker_id, tasks, results, agent_factory=None, seed=None):
+        """
+        Worker process loop of run_episodes. Builds the agent once, then runs chunks of episodes from `tasks` until
+        it receives None. Histograms are sent through `results` every flush_every episodes (if set) and at the end,
+        followed by a report of the worker's episodes, moves, busy time and per-episode latencies.
+        """
+        # one intra-op thread per worker, so num_procs workers do not oversubscribe the cores
+        torch.set_num_threads(1)
+        np.random.seed(None if seed is None else [seed, worker_id])
+        self.stats = EpisodeStats()
+
+        latencies = []
+        n_moves = 0
+        try:
+            if agent_factory is not None:
+                self.agent = agent_factory()
+            while True:
+                chunk = tasks.get()
+                if chunk is None:
+                    break
+                for _ in range(chunk):
+                    episode_start = time.perf_counter()
+                    n_moves += self.run_episode()
+                    latencies.append(time.perf_counter() - episode_start)
+
+                    # a sent histogram is replaced, not cleared, since the queue pickles it in the background
+                    if self.flush_every and len(latencies) % self.flush_every == 0:
+                        results.put((worker_id, self.stats, None))
+                        self.stats = EpisodeStats()
+        except Exception:
+            # the parent waits for a report from every worker, so a failure is reported instead of lost
+            results.put((worker_id, self.stats, {'error': traceback.format_exc()}))
+            self.stats = EpisodeStats()
+            return
+
+        report = {'episodes': len(latencies), 'moves': n_moves, 'busy': float(np.sum(latencies)),
+                  'latencies': np.asarray(latencies)}
+        results.put((worker_id, self.stats, report))
+        self.stats = EpisodeStats()
+
+    @staticmethod
+    def _stop_workers(procs):
+        # the remaining workers would keep taking chunks of a run that is abandoned
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+
+    def print_worker_reports(self):
+        # throughput and episode latency percentiles of every worker of the last run_episodes
+        print(f"{'worker':>6} {'episodes':>8} {'moves/s':>9} {'episodes/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        for worker_id, report in sorted(self.worker_reports.items()):
+            busy = max(report['busy'], 1e-9)
+            if report['episodes']:
+                p50, p95, p99, top = np.percentile(report['latencies'], [50, 95, 99, 100]) * 1000
+            else:
+                p50 = p95 = p99 = top = float('nan')
+            print(f"{worker_id:>6} {report['episodes']:>8} {report['moves'] / busy:>9.0f} {report['episodes'] / busy:>10.1f} "
+                  f"{p50:>8.1f} {p95:>8.1f} {p99:>8.1f} {top:>8.1f}")
 
     def run_episodes_worker(self, num_episodes):
         print(f"Starting {num_episodes} episodes...")
@@ -85,6 +232,64 @@ class Simulator():
             if i % 10 == 0:
                 print(f"Episode: {i}")
             self.run_episode()
+        self.game_scores, self.max_scores, self.num_steps = self.stats.as_dicts()
+
+    def run_episodes_lockstep(self, num_episodes=100, num_games=256, max_steps=1200, seed=None):
+        """
+        Plays num_episodes episodes in this process, num_games at a time in lockstep on a VecBoard. Every step the
+        boards of all running games go through one batched agent.choose_actions call, so a neural agent makes
+        one forward pass per step for all of them. A finished game is restarted as long as episodes remain.
+        Trajectories are not recorded in this mode.
+
+        The games run on the VecBoard engine, not on Board as in run_episode. Both apply the same move, merge and
+        score rules up to the 2**15 tile cap of VecBoard (checked against each other in tests/test_move_rules.py),
+        but the tile spawns come from a different random stream, so the statistics match run_episodes in
+        distribution, not game by game.
+
+        Parameters
+        ----------
+        num_episodes : int
+            Total number of episodes
+        num_games : int
+            Number of games played side by side
+        max_steps : int
+            Episodes are cut off after this many moves, as in run_episode
+        seed : int
+            Optional seed of the tile spawns
+        """
+        start = time.time()
+        num_games = min(num_games, num_episodes)
+        envs = VecBoard(num_games, seed=seed)
+        running = np.ones(num_games, dtype=bool)
+        started = num_games
+        n_moves = 0
+
+        while running.any():
+            # one batched decision for every running game, finished slots only keep their last board
+            live = np.flatnonzero(running)
+            legal = envs.legal_actions()
+            actions = np.zeros(num_games, dtype=np.int64)
+            actions[live] = self.agent.choose_actions(envs.state[live], legal[live])
+            _, dones = envs.move(actions)
+            n_moves += len(live)
+
+            # count the games that ended or ran out of moves, then restart them while episodes remain
+            finished = running & (dones | (envs.n_steps >= max_steps))
+            for i in np.flatnonzero(finished):
+                self.stats.add(envs.score[i], envs.state[i].max(), envs.n_steps[i])
+            restart = np.flatnonzero(finished)[:num_episodes - started]
+            running[finished] = False
+            if len(restart):
+                mask = np.zeros(num_games, dtype=bool)
+                mask[restart] = True
+                envs.reset(mask)
+                running[restart] = True
+                started += len(restart)
+
+        self.game_scores, self.max_scores, self.num_steps = self.stats.as_dicts()
+        end = time.time()
+        print(f"It took {end-start:.3f} seconds to run {num_episodes} simulations in lockstep "
+              f"({n_moves / (end - start):.0f} moves/s).")
 
     def get_simulation_info(self):
         print('\nTHIS WAS THE SIMULATION INFO:')
@@ -103,13 +308,14 @@ class Simulator():
         plt.rcParams['figure.autolayout'] = True
         fig, ax = plt.subplots(facecolor ='white')
         ax.axis('off')
-        df = pd.DataFrame(stateTensor.numpy(), columns = ['0', '1', '2', '3'])
+        tiles = TILE_VALUES[stateTensor.numpy()]
+        df = pd.DataFrame(tiles, columns = ['0', '1', '2', '3'])
         table = ax.table(cellText = df.values, loc = 'center', cellLoc='center')
         fig.tight_layout()
         max_number = 0
         for i in range(4):
             for j in range(4):
-                data = stateTensor[i, j]
+                data = tiles[i, j]
                 max_number = max(data, max_number)
                 color = Board.CELL_BACKGROUND_COLOR_DICT[data]
                 table[(i, j)].set_facecolor(color)
@@ -138,6 +344,14 @@ if __name__ == "__main__":
     NUM_SHARED_LAYERS = 1
     ACTIVATION = nn.Tanh()
 
+    # worker processes of run_episodes, each one loads its own copy of the agent
+    NUM_PROCS = os.cpu_count() or 1
+
+    # play the games in lockstep in this process instead, with one batched forward pass per step.
+    # Lockstep games run on the VecBoard engine instead of Board, see run_episodes_lockstep
+    LOCKSTEP = False
+    NUM_GAMES = 256
+
     ppo_agent = AgentPPO(obs_space_size=16*18, 
                          act_space_size=4, 
                          hidden_layer_size=SHARED_HIDDEN_LAYER_SIZE,
@@ -149,7 +363,10 @@ if __name__ == "__main__":
 
     #S1 = Simulator(ppo_agent)  
     S1 = Simulator(AgentDoubleDQN()) 
-    S1.run_episodes(num_episodes=100)
+    if LOCKSTEP:
+        S1.run_episodes_lockstep(num_episodes=100, num_games=NUM_GAMES)
+    else:
+        S1.run_episodes(num_episodes=100, num_procs=NUM_PROCS, agent_factory=AgentDoubleDQN)
     # S1.get_simulation_info()
     S1.plt_sim()
 